@@ -0,0 +1,213 @@
+import re
+
+from functools import lru_cache
+
+# Value of each hexadecimal digit, indexed by byte (0xFF when not a hexadecimal digit)
+HEX_VALUES = bytearray( b"\xFF"*256 )
+for _digit in b"0123456789":
+	HEX_VALUES[_digit] = _digit-0x30
+for _digit in b"ABCDEF":
+	HEX_VALUES[_digit] = _digit-0x37
+	HEX_VALUES[_digit+0x20] = _digit-0x37 # lower case
+HEX_VALUES = bytes( HEX_VALUES )
+HEX_DIGITS = b"0123456789ABCDEFabcdef"
+del _digit
+
+class ATMALineDecoderRegex():
+	"""
+	Decoder of the lines received during ATMA operation, based on regular expressions
+	It is the reference implementation of ATMA lines decoding.
+	decode() returns:
+	- a tuple (identifier, isExtended, isRTR, DLC, data) for a valid frame,
+	- False for a corrupted frame,
+	- None when the line cannot be decoded.
+	decode() throws:
+	- a MemoryError if received "BUFFER FULL",
+	- a InterruptedError if received "STOPPED",
+	- a ChildProcessError if unexpected reboot.
+	Note: lines must be spaceless.
+	Note: receiving a 29-bit frame on an 11-bit CAN bus & vice-versa are not documented but seem to be accepted, so they are handled as they come.
+	"""
+	canFrameRegex11 = re.compile( b"^([0-7][0-9A-F]{2})([0-9A-F])(?:(RTR)|([0-9A-F]*))", re.IGNORECASE )
+	canFrameRegex29 = re.compile( b"^([0-1][0-9A-F]{7})([0-9A-F])(?:(RTR)|([0-9A-F]*))", re.IGNORECASE )
+	
+	def __init__( self, canBusIsExtended, allowMixedIdentifiers ):
+		self.canBusIsExtended = canBusIsExtended
+		self.allowMixedIdentifiers = allowMixedIdentifiers
+		if allowMixedIdentifiers:
+			self.identifierLengths = (canBusIsExtended, not canBusIsExtended)
+		else:
+			self.identifierLengths = (canBusIsExtended,)
+	
+	@staticmethod
+	def decodeStatus( line ):
+		""" Handle the alerts of the ELM327, return None if the line is not an alert """
+		if b"ELM327" in line:
+			raise ChildProcessError( "ELM327: Detected a reboot during ATMA processing!" )
+		elif b"BUFFERFULL" in line:
+			raise MemoryError( "ELM327: Received a BUFFER FULL alert during ATMA processing!" )
+		elif b"STOPPED" in line:
+			raise InterruptedError( "ELM327: Received a STOPPED alert during ATMA processing!" )
+		elif b"<RXERROR" in line:
+			return False # corrupted frame (ignored frame)
+		# Warning: incorrect CRCs may produce "<DATA ERROR" but no way to distinguish them!
+		return None
+	
+	def decode( self, line ):
+		canFrame = self.decodeStatus( line )
+		if canFrame is not None:
+			return canFrame
+		canFrameIsRTR = False
+		if b"RTR" in line:
+			canFrameIsRTR = True
+		# Try parsing the frame with both identifier lengths
+		for canFrameIsExtended in self.identifierLengths:
+			canFrameRegex = canFrameIsExtended and self.canFrameRegex29 or self.canFrameRegex11
+			canFramePieces = canFrameRegex.match( line )
+			if canFramePieces:
+				canFrameData = None
+				try:
+					if canFrameIsRTR:
+						canFrameData = b''
+					else:
+						canFrameData = bytes.fromhex( canFramePieces.group( 4 ).decode( "ascii", "replace" ) )
+					# Note: canFrameData must have a maximum of 8 bytes, otherwise readings are incorrect.
+				except ValueError:
+					# The 11-bit identifier has an odd number of digits.
+					# The 29-bit identifier has an even number of digits.
+					# This exception is raised for wrong identifier sizes + for some incomplete lines.
+					continue # incomplete byte in frame (ignored frame)
+				canFrameIdentifier = int( canFramePieces.group( 1 ), base=16 )
+				if canFrameIdentifier>( canFrameIsExtended and 0x1FFFFFFF or 0x7FF ):
+					continue # invalid identifier (over maximum)
+				elif canFrameIdentifier<0:
+					continue # invalid identifier (negative)
+				canFrameDLC = int( canFramePieces.group( 2 ), base=16 )
+				if not canFrameIsRTR:
+					canFrameLengthActual = len( canFrameData )
+					if canFrameLengthActual>8:
+						continue # impossible frame containing more than 8 bytes (ignored frame)
+					canFrameLength = ( canFrameDLC<=8 ) and canFrameDLC or 8 # DLC, truncated to 8 bytes (max transmitted length)
+					if canFrameLengthActual<canFrameLength:
+						continue # DLC comparison: missing bytes in frame (ignored frame)
+					if canFrameLengthActual>canFrameLength:
+						continue # impossible: data length longer than DLC
+				return (canFrameIdentifier, canFrameIsExtended, canFrameIsRTR, canFrameDLC, canFrameData)
+		return None
+
+class ATMALineDecoder( ATMALineDecoderRegex ):
+	"""
+	Decoder of the lines received during ATMA operation, without regular expressions
+	The position of the fields is known from the line length and the DLC digit, and the digits are looked up in a table.
+	Lines are memoized in a bounded LRU cache because periodic CAN frames repeat identical lines.
+	It gives the same results as ATMALineDecoderRegex.
+	"""
+	
+	def __init__( self, canBusIsExtended, allowMixedIdentifiers, cacheSize=1024 ):
+		ATMALineDecoderRegex.__init__( self, canBusIsExtended, allowMixedIdentifiers )
+		self.accepts11 = allowMixedIdentifiers or not canBusIsExtended
+		self.accepts29 = allowMixedIdentifiers or canBusIsExtended
+		if cacheSize:
+			# Exceptions (alerts) are never cached.
+			self.decode = lru_cache( maxsize=cacheSize )( self.decodeUncached )
+		else:
+			self.decode = self.decodeUncached
+	
+	def cacheInfo( self ):
+		""" Return the statistics of the cache, or None if disabled """
+		try:
+			return self.decode.cache_info()
+		except AttributeError:
+			return None
+	
+	@staticmethod
+	def decode11( line, canFrameIsRTR ):
+		""" Decode a line as a frame with an 11-bit identifier """
+		lineLen = len( line )
+		if lineLen<4:
+			return None
+		hexValues = HEX_VALUES
+		canFrameDLC = hexValues[line[3]]
+		if hexValues[line[0]]>0x7 or hexValues[line[1]]>0xF or hexValues[line[2]]>0xF or canFrameDLC>0xF:
+			return None
+		canFrameIdentifier = ( hexValues[line[0]]<<8 )|( hexValues[line[1]]<<4 )|hexValues[line[2]]
+		if canFrameIsRTR:
+			return (canFrameIdentifier, False, True, canFrameDLC, b'')
+		canFrameLength = ( canFrameDLC<=8 ) and canFrameDLC or 8 # DLC, truncated to 8 bytes (max transmitted length)
+		dataEnd = 4+2*canFrameLength
+		if lineLen<dataEnd:
+			return None # missing bytes in frame (ignored frame)
+		if lineLen>dataEnd and hexValues[line[dataEnd]]<=0xF:
+			return None # data length longer than DLC
+		try:
+			canFrameData = bytes.fromhex( line[4:dataEnd].decode( "latin_1" ) )
+		except ValueError:
+			return None # incomplete byte in frame (ignored frame)
+		if len( canFrameData )!=canFrameLength:
+			return None # whitespaces skipped by fromhex()
+		return (canFrameIdentifier, False, False, canFrameDLC, canFrameData)
+	
+	@staticmethod
+	def decode29( line, canFrameIsRTR ):
+		""" Decode a line as a frame with a 29-bit identifier """
+		lineLen = len( line )
+		if lineLen<9:
+			return None
+		hexValues = HEX_VALUES
+		canFrameDLC = hexValues[line[8]]
+		if hexValues[line[0]]>0x1 or canFrameDLC>0xF:
+			return None
+		try:
+			canFrameIdentifier = bytes.fromhex( line[0:8].decode( "latin_1" ) )
+		except ValueError:
+			return None
+		if len( canFrameIdentifier )!=4:
+			return None # whitespaces skipped by fromhex()
+		canFrameIdentifier = int.from_bytes( canFrameIdentifier, "big" )
+		if canFrameIsRTR:
+			return (canFrameIdentifier, True, True, canFrameDLC, b'')
+		canFrameLength = ( canFrameDLC<=8 ) and canFrameDLC or 8 # DLC, truncated to 8 bytes (max transmitted length)
+		dataEnd = 9+2*canFrameLength
+		if lineLen<dataEnd:
+			return None # missing bytes in frame (ignored frame)
+		if lineLen>dataEnd and HEX_VALUES[line[dataEnd]]<=0xF:
+			return None # data length longer than DLC
+		try:
+			canFrameData = bytes.fromhex( line[9:dataEnd].decode( "latin_1" ) )
+		except ValueError:
+			return None # incomplete byte in frame (ignored frame)
+		if len( canFrameData )!=canFrameLength:
+			return None # whitespaces skipped by fromhex()
+		return (canFrameIdentifier, True, False, canFrameDLC, canFrameData)
+	
+	def decodeUncached( self, line ):
+		if not line.translate( None, HEX_DIGITS ):
+			# Only hexadecimal digits (usual case): the parity of the line length tells the identifier length.
+			lineLen = len( line )
+			if lineLen&1:
+				if lineLen<9 or not self.accepts29:
+					return None
+				canFrameDLC = HEX_VALUES[line[8]]
+				if lineLen!=9+2*( ( canFrameDLC<=8 ) and canFrameDLC or 8 ) or HEX_VALUES[line[0]]>0x1:
+					return None
+				return (int( line[0:8], 16 ), True, False, canFrameDLC, bytes.fromhex( line[9:].decode( "latin_1" ) ))
+			else:
+				if lineLen<4 or not self.accepts11:
+					return None
+				canFrameDLC = HEX_VALUES[line[3]]
+				if lineLen!=4+2*( ( canFrameDLC<=8 ) and canFrameDLC or 8 ) or HEX_VALUES[line[0]]>0x7:
+					return None
+				return (int( line[0:3], 16 ), False, False, canFrameDLC, bytes.fromhex( line[4:].decode( "latin_1" ) ))
+		# Alerts, RTR frames and frames followed by other characters:
+		canFrame = self.decodeStatus( line )
+		if canFrame is not None:
+			return canFrame
+		canFrameIsRTR = b"RTR" in line
+		for canFrameIsExtended in self.identifierLengths:
+			if canFrameIsExtended:
+				canFrame = self.decode29( line, canFrameIsRTR )
+			else:
+				canFrame = self.decode11( line, canFrameIsRTR )
+			if canFrame is not None:
+				return canFrame
+		return None
@@ -0,0 +1,370 @@
+import threading
+import multiprocessing
+import struct
+
+from traceback import format_exc
+from utility import printT
+from ATMADecoder import ATMALineDecoder
+from FilterSnapshot import FilterSnapshot
+
+try:
+	from multiprocessing import shared_memory # Python 3.8+
+except ImportError:
+	shared_memory = None
+
+# Record of a raw ATMA line: time (ns), line length, line (without <CR>)
+LINE_RECORD = struct.Struct( "<qB" )
+LINE_MAX_LEN = 127
+LINE_SLOT_SIZE = LINE_RECORD.size+LINE_MAX_LEN
+
+# Record of a decoded CAN frame: identifier, flags (1 = extended, 2 = RTR), DLC, data (padded to 8 bytes), time (ns)
+# With the flag FRAME_FLAG_FILTERED, the record counts the frames of the identifier rejected by the filters since its previous such record:
+# the count replaces the time, DLC & data are 0. It feeds the rates of identifiers, which include unwanted identifiers.
+FRAME_RECORD = struct.Struct( "<IBB2x8sq" )
+FRAME_FLAG_EXTENDED = 0x01
+FRAME_FLAG_RTR = 0x02
+FRAME_FLAG_FILTERED = 0x04
+
+class SharedMemoryRing():
+	"""
+	Ring of fixed-size records in shared memory, with 1 producer process and 1 consumer process
+	Records are written & read in place with struct, without pickling.
+	Header (64 bytes): producer count, consumer count, consumer waiting flag, free room for statistics
+	Each count is only written by its owner, after the records it covers.
+	"""
+	
+	headerSize = 64
+	counter = struct.Struct( "<Q" )
+	OFFSET_WRITTEN = 0
+	OFFSET_READ = 8
+	OFFSET_WAITING = 16
+	OFFSET_STATS = 24 # 5 counters of 8 bytes
+	
+	def __init__( self, slotSize, slotCount, wakeUp, name=None ):
+		"""
+		- slotSize, slotCount: record size and count of records
+		- wakeUp: multiprocessing.Semaphore released by the producer when the consumer waits
+		- name: name of the shared memory to attach to, None to create it
+		"""
+		self.slotSize = slotSize
+		self.slotCount = slotCount
+		self.wakeUp = wakeUp
+		if name is None:
+			self.shm = shared_memory.SharedMemory( create=True, size=self.headerSize+slotSize*slotCount )
+			self.shm.buf[0:self.headerSize] = bytes( self.headerSize )
+		else:
+			self.shm = shared_memory.SharedMemory( name=name )
+		self.name = self.shm.name
+		self.buf = self.shm.buf
+		# Local copies of the counts:
+		self.written = self.getCounter( self.OFFSET_WRITTEN )
+		self.read = self.getCounter( self.OFFSET_READ )
+	
+	def getCounter( self, offset ):
+		return self.counter.unpack_from( self.buf, offset )[0]
+	
+	def setCounter( self, offset, value ):
+		self.counter.pack_into( self.buf, offset, value )
+	
+	def close( self, unlink=False ):
+		self.buf = None
+		self.shm.close()
+		if unlink:
+			self.shm.unlink()
+	
+	## Producer side
+	
+	def writeSlotOffset( self ):
+		""" Offset of the next free record, None if the ring is full """
+		if self.written-self.read>=self.slotCount:
+			self.read = self.getCounter( self.OFFSET_READ )
+			if self.written-self.read>=self.slotCount:
+				return None
+		return self.headerSize+( self.written%self.slotCount )*self.slotSize
+	
+	def commitWrite( self ):
+		""" Publish the record written at writeSlotOffset() """
+		self.written += 1
+		self.setCounter( self.OFFSET_WRITTEN, self.written )
+	
+	def notifyConsumer( self ):
+		""" Wake up the consumer if it is waiting for records """
+		if self.buf[self.OFFSET_WAITING]:
+			self.buf[self.OFFSET_WAITING] = 0
+			self.wakeUp.release()
+	
+	## Consumer side
+	
+	def available( self ):
+		""" Count of records ready to be read """
+		self.written = self.getCounter( self.OFFSET_WRITTEN )
+		return self.written-self.read
+	
+	def readSlotOffset( self, index=0 ):
+		""" Offset of the record following the next one to read by index """
+		return self.headerSize+( ( self.read+index )%self.slotCount )*self.slotSize
+	
+	def commitRead( self, count=1 ):
+		""" Release records that have been read """
+		self.read += count
+		self.setCounter( self.OFFSET_READ, self.read )
+	
+	def waitForRecords( self, timeout ):
+		""" Sleep until records are published or timeout, return the count of available records """
+		self.buf[self.OFFSET_WAITING] = 1
+		count = self.available()
+		if not count:
+			self.wakeUp.acquire( timeout=timeout )
+			count = self.available()
+		self.buf[self.OFFSET_WAITING] = 0
+		return count
+	
+	## Statistics (written by 1 process only)
+	
+	def getStat( self, index ):
+		return self.getCounter( self.OFFSET_STATS+8*index )
+	
+	def setStat( self, index, value ):
+		self.setCounter( self.OFFSET_STATS+8*index, value )
+
+# Statistics of the parser process, stored in the header of the lines ring:
+STAT_DECODED_FRAMES = 0
+STAT_INVALID_LINES = 1
+STAT_FILTERED_FRAMES = 2
+STAT_DROPPED_FRAMES = 3
+
+def parserProcessMain( linesRingInfo, framesRingInfo, controlQueue ):
+	""" Entry point of the parser process: decode raw ATMA lines into frame records
+	The process exits when its parent process is dead (crash or killed), checked while no line comes. """
+	parentProcess = multiprocessing.parent_process()
+	linesRingName, linesSlotCount, linesWakeUp = linesRingInfo
+	framesRingName, framesSlotCount, framesWakeUp = framesRingInfo
+	lines = SharedMemoryRing( LINE_SLOT_SIZE, linesSlotCount, linesWakeUp, name=linesRingName )
+	frames = SharedMemoryRing( FRAME_RECORD.size, framesSlotCount, framesWakeUp, name=framesRingName )
+	decoder = None
+	filters = FilterSnapshot()
+	decodedFrames = 0
+	invalidLines = 0
+	filteredFrames = 0
+	filteredCounts = {} # identifier: count of rejected frames not sent yet
+	droppedFrames = 0
+	lineRecordUnpack = LINE_RECORD.unpack_from
+	lineRecordSize = LINE_RECORD.size
+	frameRecordPack = FRAME_RECORD.pack_into
+	try:
+		while True:
+			# Apply the new configuration:
+			while not controlQueue.empty():
+				message = controlQueue.get()
+				if message[0]=="decoder":
+					decoder = ATMALineDecoder( *message[1:] )
+				elif message[0]=="filters":
+					filters = message[1]
+				elif message[0]=="stop":
+					return
+			count = lines.available()
+			if not count:
+				count = lines.waitForRecords( 0.1 )
+				if not count:
+					if not parentProcess.is_alive():
+						return # orphan
+					continue
+			if decoder is None:
+				lines.commitRead( count ) # no known bus yet
+				continue
+			linesBuf = lines.buf
+			decode = decoder.decode
+			for index in range( count ):
+				offset = lines.readSlotOffset( index )
+				lineTime, lineLen = lineRecordUnpack( linesBuf, offset )
+				line = bytes( linesBuf[offset+lineRecordSize:offset+lineRecordSize+lineLen] )
+				try:
+					canFrame = decode( line )
+				except Exception:
+					canFrame = False # alerts are handled by the reader
+				if not canFrame:
+					invalidLines += 1
+					if canFrame is None:
+						printT( "ELM327: Cannot decode ATMA line: %s"%(str( line ),) )
+					continue
+				decodedFrames += 1
+				identifier, isExtended, isRTR, DLC, data = canFrame
+				if not filters.passes( identifier ):
+					filteredFrames += 1
+					filteredCounts[identifier] = filteredCounts.get( identifier, 0 )+1
+					continue
+				frameOffset = frames.writeSlotOffset()
+				if frameOffset is None:
+					droppedFrames += 1
+					continue
+				frameRecordPack( frames.buf, frameOffset, identifier, ( isExtended and FRAME_FLAG_EXTENDED or 0 )|( isRTR and FRAME_FLAG_RTR or 0 ), DLC, data, lineTime )
+				frames.commitWrite()
+			for identifier in list( filteredCounts.keys() ):
+				frameOffset = frames.writeSlotOffset()
+				if frameOffset is None:
+					break # sent after the next lines
+				frameRecordPack( frames.buf, frameOffset, identifier, FRAME_FLAG_FILTERED, 0, b"", filteredCounts.pop( identifier ) )
+				frames.commitWrite()
+			lines.commitRead( count )
+			frames.notifyConsumer()
+			lines.setStat( STAT_DECODED_FRAMES, decodedFrames )
+			lines.setStat( STAT_INVALID_LINES, invalidLines )
+			lines.setStat( STAT_FILTERED_FRAMES, filteredFrames )
+			lines.setStat( STAT_DROPPED_FRAMES, droppedFrames )
+	except KeyboardInterrupt:
+		pass
+	finally:
+		lines.close()
+		frames.close()
+
+class ATMAParserProcess():
+	"""
+	Parser process decoding ATMA lines on another CPU core
+	The reader thread pushes raw lines into a shared memory ring, the parser process decodes & filters them,
+	then a thread of this process turns the resulting frame records into CANFrame objects for the frame handler,
+	or into batches of frames (batchClass) while the capture source enables them (canBusFrameBatchesEnabled).
+	Frames rejected by the filters in the parser process are still counted in the rates of identifiers of the capture source.
+	"""
+	
+	def __init__( self, canSource, frameClass, batchClass=None, linesSlotCount=4096, framesSlotCount=4096 ):
+		if shared_memory is None:
+			raise NotImplementedError( "The parser process requires Python 3.8 or greater (multiprocessing.shared_memory)" )
+		self.canSource = canSource
+		self.frameClass = frameClass
+		self.batchClass = batchClass
+		context = multiprocessing.get_context( "spawn" ) # no fork of a multithreaded process
+		self.lines = SharedMemoryRing( LINE_SLOT_SIZE, linesSlotCount, context.Semaphore( 0 ) )
+		self.frames = None
+		try:
+			self.frames = SharedMemoryRing( FRAME_RECORD.size, framesSlotCount, context.Semaphore( 0 ) )
+			self.controlQueue = context.Queue()
+			self.droppedLines = 0
+			self.process = context.Process(
+				target=parserProcessMain,
+				args=(
+					(self.lines.name, linesSlotCount, self.lines.wakeUp),
+					(self.frames.name, framesSlotCount, self.frames.wakeUp),
+					self.controlQueue,
+				),
+				name="ATMAParserProcess",
+				daemon=True,
+			)
+			self.stopping = False
+			self.process.start()
+		except:
+			# No shared memory left behind:
+			self.lines.close( unlink=True )
+			if self.frames is not None:
+				self.frames.close( unlink=True )
+			raise
+		self.recordsThread = threading.Thread( target=self.runRecordsReader, name="ATMAParserProcess records" )
+		self.recordsThread.daemon = True
+		self.recordsThread.start()
+	
+	def setDecoder( self, canBusIsExtended, allowMixedIdentifiers, cacheSize ):
+		self.controlQueue.put( ("decoder", canBusIsExtended, allowMixedIdentifiers, cacheSize) )
+	
+	def setFilters( self, filterSnapshot ):
+		self.controlQueue.put( ("filters", filterSnapshot) )
+	
+	def pushLine( self, line, lineTime ):
+		"""
+		Send a raw ATMA line (spaceless, without <CR>) to the parser process
+		The parser process is not woken up until flush() is called, to save a system call per line.
+		- lineTime: arrival time of the line in nanoseconds since the epoch
+		"""
+		lines = self.lines
+		offset = lines.writeSlotOffset()
+		if offset is None:
+			self.droppedLines += 1
+			return
+		lineLen = min( len( line ), LINE_MAX_LEN )
+		LINE_RECORD.pack_into( lines.buf, offset, lineTime, lineLen )
+		offset += LINE_RECORD.size
+		lines.buf[offset:offset+lineLen] = line[:lineLen]
+		lines.commitWrite()
+	
+	def flush( self ):
+		""" Wake up the parser process for the lines pushed so far """
+		self.lines.notifyConsumer()
+	
+	def runRecordsReader( self ):
+		""" Turn frame records into CANFrame objects or batches (thread of this process) """
+		frames = self.frames
+		frameClass = self.frameClass
+		batchClass = self.batchClass
+		frameRecordUnpack = FRAME_RECORD.unpack_from
+		while not self.stopping:
+			count = frames.available()
+			if not count:
+				count = frames.waitForRecords( 0.1 )
+				if not count:
+					continue
+			if batchClass is not None and self.canSource.canBusFrameBatchesEnabled:
+				try:
+					batch, filteredCounts = batchClass.fromRing( frames, count, frameClass ).splitFilteredCounts()
+					if filteredCounts:
+						self.countFilteredFrames( filteredCounts )
+					if len( batch ):
+						self.canSource.handleNewBatch( batch )
+				except Exception:
+					printT( format_exc() )
+				frames.commitRead( count )
+				continue
+			framesBuf = frames.buf
+			filteredCounts = []
+			for index in range( count ):
+				identifier, flags, DLC, data, frameTime = frameRecordUnpack( framesBuf, frames.readSlotOffset( index ) )
+				if flags&FRAME_FLAG_FILTERED:
+					filteredCounts.append( (identifier, frameTime) )
+					continue
+				isRTR = ( flags&FRAME_FLAG_RTR )!=0
+				if isRTR:
+					data = b''
+				elif DLC<8:
+					data = data[:DLC]
+				try:
+					self.canSource.handleNewFrame( frameClass(
+						identifier=identifier,
+						isExtended=( flags&FRAME_FLAG_EXTENDED )!=0,
+						isRTR=isRTR,
+						DLC=DLC,
+						data=data,
+						timestamp=frameTime,
+					) )
+				except Exception:
+					printT( format_exc() )
+			if filteredCounts:
+				self.countFilteredFrames( filteredCounts )
+			frames.commitRead( count )
+	
+	def countFilteredFrames( self, identifierCounts ):
+		""" Count the frames rejected by the filters in the parser process, given as (identifier, count of frames) """
+		identifierRateMeter = self.canSource.identifierRateMeter
+		if identifierRateMeter is not None:
+			try:
+				identifierRateMeter.countIdentifiers( identifierCounts )
+			except Exception:
+				printT( format_exc() )
+	
+	def getStats( self ):
+		lines = self.lines
+		return {
+			"processAlive": self.process.is_alive(),
+			"pendingLines": lines.getCounter( lines.OFFSET_WRITTEN )-lines.getCounter( lines.OFFSET_READ ),
+			"droppedLines": self.droppedLines,
+			"decodedFrames": lines.getStat( STAT_DECODED_FRAMES ),
+			"invalidLines": lines.getStat( STAT_INVALID_LINES ),
+			"filteredFrames": lines.getStat( STAT_FILTERED_FRAMES ),
+			"droppedFrames": lines.getStat( STAT_DROPPED_FRAMES ),
+		}
+	
+	def stop( self ):
+		self.stopping = True
+		self.controlQueue.put( ("stop",) )
+		self.process.join( 2 )
+		if self.process.is_alive():
+			self.process.terminate()
+		self.recordsThread.join()
+		self.lines.close( unlink=True )
+		self.frames.close( unlink=True )
@@ -0,0 +1,83 @@
+class ATMAAccumulationTuner():
+	"""
+	Controller of the accumulation of ATMA input: minimum fill (in bytes) and wait time (in seconds) of read operations
+	A read operation ends when the minimum fill is reached or when the wait time is over, whichever comes first.
+	This duration is both the latency added to frames and the period of read operations (CPU usage).
+	The controller targets the duration that keeps read operations under maxReadsPerSecond, without exceeding maxLatency.
+	It is fed about once per second with the counters of received bytes, read operations and ATMA lines.
+	"""
+	
+	smoothing = 0.5 # weight of the newest measurement in moving averages
+	waitTimeStep = 0.0005 # wait times are rounded, because changing the I/O timeout may reconfigure the serial port
+	waitTimeMargin = 2. # the wait time is longer than the expected filling time, so that filling normally ends read operations
+	minFillMax = 4096
+	
+	def __init__( self, minFill, waitTime, maxLatency, maxReadsPerSecond ):
+		self.minFill = minFill
+		self.waitTime = waitTime
+		self.maxLatency = maxLatency
+		self.maxReadsPerSecond = maxReadsPerSecond
+		self.reason = "initial parameters"
+		self.lastUpdate = None
+		self.lastCounters = None
+		# Measured rates (moving averages):
+		self.byteRate = 0.
+		self.lineRate = 0.
+		self.readRate = 0.
+	
+	def update( self, now, receivedBytesCount, readsCount, linesCount, serialByteRate ):
+		"""
+		Measure the input flow and retune the accumulation
+		- now: current time in seconds
+		- receivedBytesCount, readsCount, linesCount: total counters since any origin
+		- serialByteRate: maximum byte rate of the serial link
+		Return True if minFill or waitTime changed
+		"""
+		counters = (receivedBytesCount, readsCount, linesCount)
+		lastUpdate = self.lastUpdate
+		lastCounters = self.lastCounters
+		self.lastUpdate = now
+		self.lastCounters = counters
+		if lastUpdate is None:
+			return False
+		elapsed = now-lastUpdate
+		if elapsed<=0. or any( counters[i]<lastCounters[i] for i in range( 3 ) ):
+			return False # counters reset
+		smoothing = self.smoothing
+		self.byteRate += smoothing*( min( ( receivedBytesCount-lastCounters[0] )/elapsed, serialByteRate )-self.byteRate )
+		self.readRate += smoothing*( ( readsCount-lastCounters[1] )/elapsed-self.readRate )
+		self.lineRate += smoothing*( ( linesCount-lastCounters[2] )/elapsed-self.lineRate )
+		# Select the duration of read operations:
+		duration = 1./self.maxReadsPerSecond
+		if self.byteRate<=self.maxReadsPerSecond:
+			# Even reading every byte separately meets the CPU target.
+			minFill = 1
+			waitTime = self.maxLatency
+			reason = "light load: no accumulation"
+		else:
+			if duration>self.maxLatency:
+				duration = self.maxLatency
+				reason = "heavy load: accumulation limited by maxLatency, the CPU target is not met"
+			else:
+				reason = "heavy load: accumulation for maxReadsPerSecond"
+			minFill = max( 1, min( round( self.byteRate*duration ), self.minFillMax ) )
+			waitTime = min( duration*self.waitTimeMargin, self.maxLatency )
+		waitTime = max( self.waitTimeStep, round( waitTime/self.waitTimeStep )*self.waitTimeStep )
+		self.reason = reason
+		if minFill!=self.minFill or abs( waitTime-self.waitTime )>self.waitTimeStep/2:
+			self.minFill = minFill
+			self.waitTime = waitTime
+			return True
+		return False
+	
+	def getState( self ):
+		return {
+			"minFill": self.minFill,
+			"waitTime": self.waitTime,
+			"reason": self.reason,
+			"maxLatency": self.maxLatency,
+			"maxReadsPerSecond": self.maxReadsPerSecond,
+			"byteRate": self.byteRate,
+			"lineRate": self.lineRate,
+			"readRate": self.readRate,
+		}
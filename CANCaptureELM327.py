@@ -12,6 +12,7 @@ DEBUG_DISCONNECTED_CAN_BUS = False # dev (ELM327 dialog only)
 
 import threading
 import serial
+import gc
 import re
 
 from datetime import datetime
@@ -21,7 +22,26 @@ from time import perf_counter
 from traceback import format_exc
 from sys import exc_info
 from threading import Lock
+from collections import deque
+from operator import itemgetter
 from CANCaptureFrameHandler import CANCaptureFrameHandler
+from ATMADecoder import ATMALineDecoder
+from ATMADecoder import ATMALineDecoderRegex
+from SerialInput import SerialRingBuffer
+from SerialInput import SerialReaderThread
+from SerialInput import SerialEpollInput
+from ATMAParserProcess import ATMAParserProcess
+from CANFrameBatch import CANFrameBatch
+from ATMATuner import ATMAAccumulationTuner
+from LinkStateCache import LinkStateCache
+from FilterPlanner import IdentifierRateMeter
+from FilterPlanner import planFilter
+from FilterPlanner import FilterSurvey
+from FilterSnapshot import IdentifierSet
+from FilterSnapshot import FilterSnapshot
+from SerialRecording import SerialRecorder
+from OBDScheduler import OBDPollingScheduler
+from CANTransmitQueue import CANTransmitQueue
 
 from utility import execfile
 from utility import execfileIfNeeded
@@ -29,33 +49,53 @@ from utility import printT
 from utility import setConsoleColorWindows
 from utility import setConsoleTitle
 from utility import bytes_hex
+from utility import timeNs
 
-from configselector import parametersFile
-from configselector import sequenceFile
+from configselector import parametersFile as defaultParametersFile
+from configselector import sequenceFile as defaultSequenceFile
 
 MAX_OBD_NEGOCIATION_TIME = 60
+INIT_COMMANDS = ( # idempotent output & CAN bus settings sent after each reset, with their descriptions
+	(b"ATE0", "no echo"),
+	(b"ATL0", "no <LF> after <CR>"),
+	(b"ATS0", "no spaces"),
+	(b"ATR1", "wait for response after sending message"),
+	(b"ATD1", "display DLC of CAN frames between identifier & data"),
+	(b"ATCAF0", "raw CAN data formatting"),
+	(b"ATH1", "send CAN headers (otherwise identifiers not shown!)"),
+	(b"ATJHF0", "send J1939 SAE identifiers as ordinary CAN identifiers"),
+	(b"ATJS", "disable byte-reordering for J1939 SAE"),
+	(b"ATCSM1", "CAN spy mode"),
+)
+READ_BUFFER_COMPACT_SIZE = 4096 # consumed bytes kept at the beginning of the local buffer before being dropped
+SINGLE_BYTES = tuple( bytes( (i,) ) for i in range( 256 ) ) # avoids creating a bytes object per read byte
 
 class CANFrame( tuple ):
 	"""
-	Represents a valid CAN frame
-	The type and its components should be immutable (thread-safety).
+	Represents a valid CAN frame: (identifier, isExtended, isRTR, DLC, data, timeNs)
+	The type and its components are immutable (thread-safety), with no instance dictionary.
+	Fields are read by C-level accessors (operator.itemgetter), which cost no Python call.
 	"""
-	identifier = property( lambda self: self[0] )
-	isExtended = property( lambda self: self[1] )
-	isRTR = property( lambda self: self[2] )
-	DLC = property( lambda self: self[3] )
-	data = property( lambda self: self[4] )
-	time = property( lambda self: self._time )
-	def __new__( cls, identifier, isExtended, isRTR, DLC, data ):
-		obj = super().__new__( cls, (
-			int( identifier ),
-			bool( isExtended ),
-			bool( isRTR ),
-			int( DLC ),
-			bytes( data ), # immutable conversion
-		) )
-		obj._time = time()
-		return obj
+	__slots__ = ()
+	identifier = property( itemgetter( 0 ) ) # int
+	isExtended = property( itemgetter( 1 ) ) # bool
+	isRTR = property( itemgetter( 2 ) ) # bool
+	DLC = property( itemgetter( 3 ) ) # int
+	data = property( itemgetter( 4 ) ) # bytes
+	timeNs = property( itemgetter( 5 ) ) # nanoseconds since the epoch (int)
+	time = property( lambda self: self[5]/1000000000. ) # seconds since the epoch
+	def __new__( cls, identifier, isExtended, isRTR, DLC, data, timestamp=None ):
+		"""
+		The arguments are stored as they are given, so they must have the types of the fields, except data (immutable conversion).
+		timestamp: time of the frame in nanoseconds since the epoch, now if None
+		"""
+		if timestamp is None:
+			timestamp = timeNs()
+		if type( data ) is not bytes:
+			data = bytes( data )
+		return tuple.__new__( cls, (identifier, isExtended, isRTR, DLC, data, timestamp) )
+	def __getnewargs__( self ):
+		return tuple( self ) # copy & pickle
 	def __str__( self ):
 		info = (self.identifier, self.isRTR, self.DLC, bytes_hex( self.data ))
 		if self.isExtended:
@@ -66,16 +106,45 @@ class CANFrame( tuple ):
 class CANCaptureELM327Thread( threading.Thread ):
 	daemon = True # exit immediatly on program exit
 	
-	def __init__( self, vehicleData ):
+	def __init__( self, vehicleData, parametersFile=None, sequenceFile=None, busName=None ):
+		"""
+		- parametersFile, sequenceFile: files of this bus, the ones selected on the command line by default
+		- busName: name of this bus in multi-bus mode, None otherwise
+		"""
 		threading.Thread.__init__( self )
+		self.parametersFile = parametersFile or defaultParametersFile
+		self.sequenceFile = sequenceFile or defaultSequenceFile
+		self.busName = busName
+		if busName is not None:
+			self.name = "CAN bus "+busName
 		self.readBuffer = bytearray()
+		self.readBufferPos = 0 # cursor of the next byte to read in readBuffer
+		self.readAnchors = [] # (position, arrival time in ns) at the end of each chunk in readBuffer
+		self.readAnchorIndex = 0 # index in readAnchors of the last estimated arrival time
+		self.receivedBytesCount = 0 # total count of bytes fetched from the serial port
+		self.fetchCount = 0 # total count of read operations
+		self.atmaLinesCount = 0 # total count of lines read during ATMA operation
 		self.parametersFileInfo = {}
 		self.sequenceFileInfo = {}
 		self.pidResponseCallbacks = {}
 		self.lastResponseDatas = {}
 		self.ser = None
+		self.serialReader = None # dedicated thread reading the serial port, if enabled
+		self.serialEpollInput = None # epoll backend reading the serial port (Linux), if enabled
+		self.readTimeout = None # I/O timeout of read operations when using serialReader or serialEpollInput
 		self.sequence = []
 		self.filter1RemoteLock = Lock()
+		self.parserProcessLock = Lock()
+		self.surveyLock = Lock()
+		self.downtimeLock = Lock()
+		self.downtimeTotal = 0. # cumulative time spent out of ATMA after interruptions (seconds)
+		self.downtimeByReason = {} # reason: {"count", "total", "max"}
+		self.downtimeRecent = deque( maxlen=32 ) # last interruptions
+		self.monitoring = False # ATMA has been sent and not interrupted since
+		self.monitoringInterruptedAt = None # time of the current ATMA interruption (perf_counter)
+		self.monitoringInterruptedReason = None
+		self.identifierRateMeter = IdentifierRateMeter() # frames per second of each identifier, fed by frameHandler
+		self.transmitQueue = CANTransmitQueue()
 		self.frameHandler = CANCaptureFrameHandler( self )
 		try:
 			self.frameHandler.start()
@@ -83,12 +152,19 @@ class CANCaptureELM327Thread( threading.Thread ):
 			pass
 	
 	canExporter = None
-	def attachCanExporter( self, canExporter ):
+	canExporterBusIndex = None
+	loadSharingGroup = None # CANLoadSharingGroup of the scanners sharing the bus, if any
+	def attachCanExporter( self, canExporter, busIndex=None ):
+		"""
+		Attach the exporter of the captured frames
+		- busIndex: index of this bus in the exporter (multi-bus mode), None if this bus configures the exporter with its own parameters
+		"""
 		self.canExporter = canExporter
+		self.canExporterBusIndex = busIndex
 	
 	def reloadParameters( self ):
 		parameters = {}
-		if execfileIfNeeded( parametersFile, parameters, self.parametersFileInfo ):
+		if execfileIfNeeded( self.parametersFile, parameters, self.parametersFileInfo ):
 			### Serial port ###
 			self.serialPort = parameters["serialPort"]
 			self.serialBaudRateInitial = parameters["serialBaudRateInitial"]
@@ -99,12 +175,43 @@ class CANCaptureELM327Thread( threading.Thread ):
 				self.serialLocalBufferAccuATMA = parameters["serialLocalBufferAccuATMA"]
 				self.serialLocalBufferMinFillATMA = parameters["serialLocalBufferMinFillATMA"]
 				self.serialLocalBufferWaitTimeATMA = parameters["serialLocalBufferWaitTimeATMA"]
+				if self.serialLocalBufferAccuATMA and parameters.get( "serialLocalBufferAutoTuneATMA", False ):
+					self.accumulationTuner = ATMAAccumulationTuner(
+						self.serialLocalBufferMinFillATMA,
+						self.serialLocalBufferWaitTimeATMA,
+						parameters.get( "serialLocalBufferMaxLatencyATMA", 0.010 ),
+						parameters.get( "serialLocalBufferMaxReadsATMA", 200 ),
+					)
+				else:
+					self.accumulationTuner = None
+				self.serialLocalBufferLinesATMA = parameters.get( "serialLocalBufferLinesATMA", True )
+				self.serialReaderThreadEnabled = parameters.get( "serialReaderThreadEnabled", False )
+				self.serialReaderRingSize = parameters.get( "serialReaderRingSize", 65536 )
+				self.serialReaderRealTime = self.serialReaderThreadEnabled and parameters.get( "serialReaderRealTime", False )
+				self.serialReaderRealTimeCpu = parameters.get( "serialReaderRealTimeCpu", None )
+				self.serialReaderRealTimePriority = parameters.get( "serialReaderRealTimePriority", 10 )
+				self.serialEpollEnabled = parameters.get( "serialEpollEnabled", False )
 			else:
 				self.serialLocalBufferAccuATMA = None
 				self.serialLocalBufferMinFillATMA = None
 				self.serialLocalBufferWaitTimeATMA = None
+				self.accumulationTuner = None
+				self.serialLocalBufferLinesATMA = None
+				self.serialReaderThreadEnabled = False
+				self.serialReaderRingSize = None
+				self.serialReaderRealTime = False
+				self.serialEpollEnabled = False
+			self.updateRealTimeMode()
+			self.serialPipelinedInit = parameters.get( "serialPipelinedInit", False )
+			linkStateFile = parameters.get( "serialLinkStateFile", None )
+			if linkStateFile is None:
+				self.linkStateCache = None
+			elif self.linkStateCache is None or self.linkStateCache.filename!=linkStateFile:
+				self.linkStateCache = LinkStateCache( linkStateFile )
 			self.serialShowSentBytes = parameters["serialShowSentBytes"]
 			self.serialShowReceivedBytes = parameters["serialShowReceivedBytes"]
+			self.serialRecordFile = parameters.get( "serialRecordFile", None )
+			self.updateSerialRecorder()
 			
 			### CAN bus ###
 			self.testObdCompliant = parameters["canBusTestObdCompliant"]
@@ -114,15 +221,44 @@ class CANCaptureELM327Thread( threading.Thread ):
 			if scannerATBRD>0xFF:
 				printT( "The parameter serialBaudRateDesired is set to an insufficient value!" )
 			self.scannerATBRD = b"ATBRD"+bytes( "%.2X"%round( 4000000/self.serialBaudRateDesired ), "ascii" )+b"\x0D" # desired baudrate
-			if self.canExporter is not None:
+			self.serialBaudRateCalibration = parameters.get( "serialBaudRateCalibration", False )
+			self.serialBaudRateCalibrationRates = parameters.get( "serialBaudRateCalibrationRates", [115200, 230400, 250000, 333333, 400000, 500000] )
+			self.serialBaudRateCalibrationSoak = parameters.get( "serialBaudRateCalibrationSoak", 3. )
+			self.serialBaudRateCalibrationMaxInvalid = parameters.get( "serialBaudRateCalibrationMaxInvalid", 0.001 )
+			self.applyCalibratedBaudRate()
+			if self.canExporter is not None and self.canExporterBusIndex is None:
 				self.canExporter.setParameters( parameters )
+			self.frameHandler.setParameters( parameters )
 			self.allowMixedIdentifiers = parameters["canBusAllowMixedIdentifiers"]
+			self.canBusDecoderTableDriven = parameters.get( "canBusDecoderTableDriven", True )
+			self.canBusDecoderCacheSize = parameters.get( "canBusDecoderCacheSize", 1024 )
+			self.atmaDecoder = None # rebuilt with new parameters
+			self.canBusParserProcessEnabled = parameters.get( "canBusParserProcessEnabled", False )
+			self.canBusFrameBatchesEnabled = parameters.get( "canBusFrameBatchesEnabled", False )
+			if self.canBusFrameBatchesEnabled and not CANFrameBatch.available:
+				printT( "Frame batches require NumPy: frames are handled one by one." )
+				self.canBusFrameBatchesEnabled = False
 			self.inactivityTimeout = parameters["canBusInactivityTimeout"]
 			if DEBUG_DISCONNECTED_CAN_BUS:
 				self.inactivityTimeout = 20.
 			self.stopMonitoringWait = parameters["canBusStopMonitoringWait"]
 			self.stopMonitoringMaxAttempts = parameters["canBusStopMonitoringMaxAttempts"]
+			self.pipelinedRestart = parameters.get( "canBusPipelinedRestart", False )
+			self.surveyPartitionBits = parameters.get( "canBusSurveyPartitionBits", 4 )
+			self.surveyDwell = parameters.get( "canBusSurveyDwell", 2. )
+			self.surveyRounds = parameters.get( "canBusSurveyRounds", 1 )
+			self.transmitQueue.maxSize = parameters.get( "canBusTransmitQueueSize", 1024 )
+			self.transmitWindowMaxDuration = parameters.get( "canBusTransmitWindowMaxDuration", 0.05 )
+			self.transmitMinMonitoringTime = parameters.get( "canBusTransmitMinMonitoringTime", 0.2 )
 			self.maxStraightInvalidFrames = parameters["canBusMaxStraightInvalidFrames"]
+			self.obdPollingBlindTimeBudget = parameters.get( "obdPollingBlindTimeBudget", 0.1 )
+			self.obdPollingMaxBatchDuration = parameters.get( "obdPollingMaxBatchDuration", 0.3 )
+			self.obdPollingTimeout = parameters.get( "obdPollingTimeout", 0.2 )
+			self.obdRequestAddress = parameters.get( "obdRequestAddress", None )
+			self.obdResponseAddress = parameters.get( "obdResponseAddress", None )
+			if self.obdScheduler is not None:
+				self.obdScheduler.blindTimeBudget = self.obdPollingBlindTimeBudget
+				self.obdScheduler.maxBatchDuration = self.obdPollingMaxBatchDuration
 			self.maskOver = parameters["canBusMaskOver"]
 			if self.maskOver is None:
 				self.maskOver = 0x1FFFFFFF
@@ -149,7 +285,7 @@ class CANCaptureELM327Thread( threading.Thread ):
 			printT( "[CANCaptureELM327.py] Parameters have been reloaded." )
 	
 	def reloadSequence( self ):
-		if execfileIfNeeded( sequenceFile, {"canBus":self}, self.sequenceFileInfo ):
+		if execfileIfNeeded( self.sequenceFile, {"canBus":self}, self.sequenceFileInfo ):
 			printT( "The CAN sequence has been reloaded." )
 	
 	## Filters
@@ -163,90 +299,825 @@ class CANCaptureELM327Thread( threading.Thread ):
 			self.filter1RemoteChanged = True
 			self.filter1RemoteMask = mask or 0x00000000
 			self.filter1RemoteResult = maskingResult or 0x00000000
+		self.updateFilterSnapshot()
 	
 	def getFilter1Remote( self ):
 		""" Get filter mask used ELM327-side & computer-side """
 		with self.filter1RemoteLock:
 			return (self.filter1RemoteMask, self.filter1RemoteResult)
 	
-	filter1Whitelist = None # please copy locally; type: set / NoneType
-	def setFilter1Local( self, whitelist ):
-		""" Set new filter whitelist to be used computer-side """
+	filter1Whitelist = None # type: IdentifierSet (immutable) / NoneType
+	def setFilter1Local( self, whitelist, ranges=(), masks=() ):
+		"""
+		Set new filter whitelist to be used computer-side
+		- whitelist: identifiers or IdentifierSet, None for no whitelist (unless ranges or masks are given)
+		- ranges: (first, last) identifiers, masks: (mask, maskingResult) of identifiers added to the whitelist
+		"""
 		# No lock required (filter1Whitelist never modified)
-		if whitelist is not None:
-			self.filter1Whitelist = set( whitelist )
-		else:
-			self.filter1Whitelist = None
+		self.filter1Whitelist = IdentifierSet.build( whitelist, ranges, masks )
+		self.updateFilterSnapshot()
 	
 	def getFilter1Local( self ):
-		""" Get filter whitelist used computer-side """
-		try:
-			return set( self.filter1Whitelist )
-		except TypeError:
-			return None
+		""" Get filter whitelist used computer-side: IdentifierSet / None """
+		return self.filter1Whitelist
 	
-	def setFilter1( self, whitelist ):
-		""" Set new filter whitelist to be used both computer-side and ELM327-side """
+	def setFilter1( self, whitelist, ranges=(), masks=() ):
+		""" Set new filter whitelist to be used both computer-side and ELM327-side (arguments of setFilter1Local()) """
+		whitelist = IdentifierSet.build( whitelist, ranges, masks )
 		if whitelist is not None:
-			op1 = 0x1FFFFFFF
-			op2 = 0x1FFFFFFF
-			op3 = 0x00000000
-			for identifier in whitelist:
-				op1 &= identifier
-				op2 &= ~identifier
-				op3 |= identifier
-			mask = ( op1|op2 )&0x1FFFFFFF
-			result = op3&mask
+			allSet, allCleared = whitelist.getCommonBits()
+			mask = ( allSet|allCleared )&0x1FFFFFFF
+			result = allSet&mask
 		else:
 			mask = 0x00000000
 			result = 0x00000000
 		self.setFilter1Remote( mask, result )
 		self.setFilter1Local( whitelist )
 	
-	filter2Blacklist = None # please copy locally; type: set / NoneType
-	def setFilter2( self, blacklist ):
-		""" Set new filter blacklist to be used computer-side """
+	filter2Blacklist = None # type: IdentifierSet (immutable) / NoneType
+	def setFilter2( self, blacklist, ranges=(), masks=() ):
+		""" Set new filter blacklist to be used computer-side (arguments like setFilter1Local()) """
 		# No lock required (filter2Blacklist never modified)
-		if blacklist is not None:
-			self.filter2Blacklist = set( blacklist )
-		else:
-			self.filter2Blacklist = None
+		self.filter2Blacklist = IdentifierSet.build( blacklist, ranges, masks )
+		self.updateFilterSnapshot()
 	
 	def getFilter2( self ):
-		""" Get filter blacklist used computer-side """
-		try:
-			return set( self.filter2Blacklist )
-		except TypeError:
-			return None
+		""" Get filter blacklist used computer-side: IdentifierSet / None """
+		return self.filter2Blacklist
+	
+	filterSnapshot = FilterSnapshot() # compiled filters, replaced on change
+	def updateFilterSnapshot( self ):
+		""" Compile the filters in place into a new snapshot """
+		with self.filter1RemoteLock:
+			self.filterSnapshot = FilterSnapshot(
+				self.filter1RemoteMask,
+				self.filter1RemoteResult,
+				self.filter1Whitelist,
+				self.filter2Blacklist,
+				self.filterSnapshot.version+1,
+			)
+		self.updateParserProcessFilters()
 	
 	def passesFilters( self, frame ):
 		""" Indicates if a frame passes the filters in place
+		This method must be thread-safe! (immutable snapshot, no lock)
+		"""
+		return self.filterSnapshot.passes( frame.identifier )
+	
+	def passesFiltersBatch( self, batch ):
+		""" Same as passesFilters() for a CANFrameBatch, return an array of booleans
 		This method must be thread-safe!
 		"""
-		identifier = frame.identifier
-		
-		with self.filter1RemoteLock:
-			filter1RemoteMask = self.filter1RemoteMask
-			filter1RemoteResult = self.filter1RemoteResult
-		if ( identifier&filter1RemoteMask )!=filter1RemoteResult:
-			return False
-		
+		return batch.passesFilters( self.filterSnapshot )
+	
+	def planFilter1( self, apply=False ):
+		"""
+		Plan the ELM327-side filter from the measured rates of identifiers, and optionally install it
+		Wanted identifiers are the computer-side whitelist if set, or else measured identifiers minus the computer-side blacklist.
+		Ranges & masks of the whitelist only bring their measured identifiers.
+		In the 2nd case, identifiers never measured may be excluded: measure with an open filter first.
+		Return the plan (see FilterPlanner.planFilter) with the expected admitted rate of the installed filter
+		Throws a ValueError if there is no wanted identifier
+		"""
+		rates = self.identifierRateMeter.getRates()
 		filter1Whitelist = self.filter1Whitelist
-		if ( filter1Whitelist is not None ) and ( identifier not in filter1Whitelist ):
+		if filter1Whitelist is not None:
+			# Explicit identifiers, and measured identifiers within ranges & masks:
+			wanted = set( filter1Whitelist.identifiers )
+			wanted.update( identifier for identifier in rates.keys() if identifier in filter1Whitelist )
+			wantedSource = "whitelist"
+		else:
+			wanted = set( rates.keys() )
+			filter2Blacklist = self.filter2Blacklist
+			if filter2Blacklist is not None:
+				wanted = {identifier for identifier in wanted if identifier not in filter2Blacklist}
+			wantedSource = "measured"
+		plan = planFilter( rates, wanted, self.maskOver )
+		plan["wantedSource"] = wantedSource
+		mask, maskingResult = self.getFilter1Remote()
+		mask &= self.maskOver
+		maskingResult &= self.maskOver
+		plan["installedAdmittedRate"] = sum( rate for identifier, rate in rates.items() if ( identifier&mask )==maskingResult )
+		if apply:
+			self.setFilter1Remote( plan["mask"], plan["maskingResult"] )
+		plan["applied"] = apply
+		return plan
+	
+	def getIdentifierRates( self ):
+		""" Get the measured rates of identifiers received from the ELM327: {identifier: frames per second} """
+		return self.identifierRateMeter.getRates()
+	
+	## END Filters
+	
+	## Parser process
+	
+	parserProcess = None
+	def updateParserProcess( self ):
+		""" Start or stop the parser process according to parameters """
+		with self.parserProcessLock:
+			if self.canBusParserProcessEnabled and self.parserProcess is None:
+				try:
+					self.parserProcess = ATMAParserProcess( self, CANFrame, CANFrameBatch )
+					printT( "The ATMA parser process has been started." )
+				except NotImplementedError as e:
+					printT( e )
+					self.canBusParserProcessEnabled = False
+			elif not self.canBusParserProcessEnabled and self.parserProcess is not None:
+				self.parserProcess.stop()
+				self.parserProcess = None
+				printT( "The ATMA parser process has been stopped." )
+		self.atmaDecoder = None # decoder settings to be sent to the parser process
+		self.updateParserProcessFilters()
+	
+	def updateParserProcessFilters( self ):
+		"""
+		Send the snapshot of the filters to the parser process
+		During a survey, the whitelist & blacklist are left to the frame handler: the survey records the frames before them.
+		"""
+		with self.parserProcessLock:
+			if self.parserProcess is not None:
+				filterSnapshot = self.filterSnapshot
+				if self.survey is not None:
+					filterSnapshot = FilterSnapshot( filterSnapshot.mask, filterSnapshot.maskingResult, version=filterSnapshot.version )
+				self.parserProcess.setFilters( filterSnapshot )
+	
+	def getParserProcessStats( self ):
+		""" Get the statistics of the parser process """
+		parserProcess = self.parserProcess
+		if parserProcess is None:
+			return None
+		return parserProcess.getStats()
+	
+	## END Parser process
+	
+	## Accumulation tuning
+	
+	accumulationTuner = None
+	def tuneAccumulationATMA( self ):
+		""" Retune the accumulation of ATMA input from the measured flow (about once per second) """
+		accumulationTuner = self.accumulationTuner
+		if accumulationTuner is not None:
+			if accumulationTuner.update( perf_counter(), self.receivedBytesCount, self.fetchCount, self.atmaLinesCount, self.ser.baudrate/10. ):
+				self.serialLocalBufferMinFillATMA = accumulationTuner.minFill
+				self.serialLocalBufferWaitTimeATMA = accumulationTuner.waitTime
+	
+	def getAccumulationTuning( self ):
+		""" Get the accumulation of ATMA input, with the measured flow if tuned automatically """
+		accumulationTuner = self.accumulationTuner
+		if accumulationTuner is None:
+			return {
+				"autoTune": False,
+				"minFill": self.serialLocalBufferMinFillATMA,
+				"waitTime": self.serialLocalBufferWaitTimeATMA,
+			}
+		state = accumulationTuner.getState()
+		state["autoTune"] = True
+		return state
+	
+	## END Accumulation tuning
+	
+	## Baud rate calibration
+	
+	baudRateCalibration = None # result of the last calibration: {"serialPort", "baudRate" (None if failed), "failed", "steps"}
+	calibrationMinLines = 100 # minimum count of lines in a soak to judge a baud rate faster than the starting one
+	calibrationAlertRegex = re.compile( b"ERROR|BUSBUSY|NODATA|LVRESET|ACTALERT|OUTOFMEMORY|^ERR[0-9]{2}$|^\\?$" ) # ELM327 alerts, spaceless
+	
+	def getATBRD( self, baudRate ):
+		return b"ATBRD"+bytes( "%.2X"%round( 4000000/baudRate ), "ascii" )+b"\x0D"
+	
+	def applyCalibratedBaudRate( self ):
+		""" Use the calibrated baud rate of the serial port as desired baud rate, if calibration is enabled """
+		if not self.serialBaudRateCalibration:
+			return
+		baudRateCalibration = self.baudRateCalibration
+		if baudRateCalibration is None or baudRateCalibration["serialPort"]!=self.serialPort:
+			baudRateCalibration = None
+			if self.linkStateCache is not None:
+				linkState = self.linkStateCache.get( self.serialPort )
+				if linkState is not None:
+					baudRateCalibration = linkState.get( "baudRateCalibration" )
+			self.baudRateCalibration = baudRateCalibration
+		if baudRateCalibration is not None and baudRateCalibration["baudRate"] is not None:
+			self.serialBaudRateDesired = baudRateCalibration["baudRate"]
+			self.scannerATBRD = self.getATBRD( self.serialBaudRateDesired )
+	
+	def soakBaudRate( self, duration ):
+		"""
+		Monitor with ATMA for a while at the current baud rate
+		Return the counts of lines, invalid lines, other ELM327 alerts and BUFFER FULL alerts
+		Only serial-level corruption counts as invalid: bus-side alerts (like CAN ERROR or <RX ERROR) do not tell about the baud rate.
+		"""
+		atmaDecoder = self.atmaDecoder
+		if atmaDecoder is None:
+			atmaDecoder = self.buildATMADecoder()
+		linesCount = 0
+		invalidLinesCount = 0
+		alertsCount = 0
+		bufferFullCount = 0
+		self.setReadTimeout( 0.1 )
+		self.write( b"ATMA\x0D" )
+		endAt = perf_counter()+duration
+		while perf_counter()<endAt:
+			try:
+				line = self.readLineATMA( 128 )
+				if line is None:
+					continue # nothing received
+				linesCount += 1
+				if not line or not atmaDecoder.decode( line ):
+					if self.calibrationAlertRegex.search( line ):
+						alertsCount += 1
+					else:
+						invalidLinesCount += 1 # neither a frame nor an alert
+			except ValueError: # illegal byte or line too long
+				linesCount += 1
+				invalidLinesCount += 1
+			except MemoryError:
+				bufferFullCount += 1
+				self.waitForPrompt( "No prompt after BUFFER FULL during the calibration!", 64, noSilentTest=True )
+				self.setReadTimeout( 0.1 )
+				self.write( b"ATMA\x0D" )
+			except InterruptedError:
+				self.waitForPrompt( "No prompt after STOPPED during the calibration!", 64, noSilentTest=True )
+				self.setReadTimeout( 0.1 )
+				self.write( b"ATMA\x0D" )
+			except ConnectionAbortedError: # prompt received
+				self.write( b"ATMA\x0D" )
+		self.write( b"\x0D" ) # stop monitoring
+		self.setReadTimeout( 0.5 )
+		self.waitForPrompt( "No prompt after stopping ATMA during the calibration!", 1048576, noSilentTest=True )
+		return linesCount, invalidLinesCount, alertsCount, bufferFullCount
+	
+	def calibrateBaudRate( self ):
+		"""
+		Walk up the calibration baud rates with an ATMA soak at each one, and select the fastest clean one
+		A baud rate is clean if its ratio of invalid lines does not exceed serialBaudRateCalibrationMaxInvalid, and BUFFER FULL alerts do not increase.
+		The starting baud rate already works, so it is judged without calibrationMinLines: a quiet bus keeps it.
+		The result is saved in the link state cache, including a failure, so that reconnecting does not calibrate again.
+		"""
+		if not self.serialLocalBufferEnabled:
+			printT( "The baud rate calibration needs serialLocalBufferEnabled." )
+			return
+		printT( "Calibrating the baud rate..." )
+		steps = []
+		bestBaudRate = None
+		bestBufferFullCount = None
+		baudRates = [self.ser.baudrate]+sorted( baudRate for baudRate in self.serialBaudRateCalibrationRates if baudRate>self.ser.baudrate )
+		for baudRate in baudRates:
+			if baudRate!=self.ser.baudrate:
+				if not self.switchBaudRate( baudRate, self.getATBRD( baudRate ) ):
+					steps.append( {"baudRate": baudRate, "clean": False, "reason": "ATBRD failed"} )
+					break
+			linesCount, invalidLinesCount, alertsCount, bufferFullCount = self.soakBaudRate( self.serialBaudRateCalibrationSoak )
+			step = {
+				"baudRate": baudRate,
+				"lines": linesCount,
+				"invalidLines": invalidLinesCount,
+				"alerts": alertsCount,
+				"bufferFull": bufferFullCount,
+				"clean": False,
+			}
+			steps.append( step )
+			printT( "Calibration at %u b/s: %u lines, %u invalid, %u alerts, %u BUFFER FULL"%(baudRate, linesCount, invalidLinesCount, alertsCount, bufferFullCount) )
+			if bestBaudRate is not None and linesCount<self.calibrationMinLines:
+				step["reason"] = "not enough CAN traffic"
+				break
+			if invalidLinesCount>linesCount*self.serialBaudRateCalibrationMaxInvalid:
+				step["reason"] = "too many invalid lines"
+				break
+			if bestBufferFullCount is not None and bufferFullCount>bestBufferFullCount:
+				step["reason"] = "more BUFFER FULL alerts"
+				break
+			step["clean"] = True
+			bestBaudRate = baudRate
+			bestBufferFullCount = bufferFullCount
+		self.baudRateCalibration = {"serialPort": self.serialPort, "baudRate": bestBaudRate, "failed": bestBaudRate is None, "steps": steps}
+		if self.linkStateCache is not None:
+			self.linkStateCache.update( self.serialPort, baudRateCalibration=self.baudRateCalibration )
+		if bestBaudRate is None:
+			printT( "The baud rate calibration failed, keeping serialBaudRateDesired." )
+			return
+		printT( "Calibrated baud rate: %u b/s"%(bestBaudRate,) )
+		self.serialBaudRateDesired = bestBaudRate
+		self.scannerATBRD = self.getATBRD( bestBaudRate )
+	
+	def getBaudRateCalibration( self ):
+		""" Get the result of the last calibration of the baud rate (failed or not), None if none """
+		return self.baudRateCalibration
+	
+	## END Baud rate calibration
+	
+	## Monitoring downtime
+	
+	def interruptedMonitoring( self, reason ):
+		""" Note the start of an ATMA interruption (the 1st reason is kept until ATMA is sent again) """
+		if self.monitoring:
+			self.monitoring = False
+			self.monitoringInterruptedAt = perf_counter()
+			self.monitoringInterruptedReason = reason
+			survey = self.survey
+			if survey is not None:
+				survey.pause( self.monitoringInterruptedAt, reason )
+	
+	def resumedMonitoring( self ):
+		""" Note that ATMA has been sent again, measuring the downtime of the interruption """
+		self.monitoring = True
+		survey = self.survey
+		if survey is not None:
+			survey.resume( perf_counter() )
+		interruptedAt = self.monitoringInterruptedAt
+		if interruptedAt is None:
+			return # not an interruption (1st ATMA)
+		duration = perf_counter()-interruptedAt
+		if self.obdBatch is not None:
+			self.obdBatch = None
+			self.obdScheduler.batchDone( duration, self.obdBatchRequestsDuration )
+		reason = self.monitoringInterruptedReason
+		self.monitoringInterruptedAt = None
+		self.monitoringInterruptedReason = None
+		with self.downtimeLock:
+			self.downtimeTotal += duration
+			reasonStats = self.downtimeByReason.get( reason )
+			if reasonStats is None:
+				reasonStats = {"count": 0, "total": 0., "max": 0.}
+				self.downtimeByReason[reason] = reasonStats
+			reasonStats["count"] += 1
+			reasonStats["total"] += duration
+			if duration>reasonStats["max"]:
+				reasonStats["max"] = duration
+			self.downtimeRecent.append( {"reason": reason, "time": time()-duration, "duration": duration} )
+	
+	def getMonitoringDowntime( self ):
+		""" Get the time spent out of ATMA after interruptions: cumulative, by reason and for the last interruptions """
+		with self.downtimeLock:
+			return {
+				"total": self.downtimeTotal,
+				"count": sum( reasonStats["count"] for reasonStats in self.downtimeByReason.values() ),
+				"byReason": {reason: dict( reasonStats ) for reason, reasonStats in self.downtimeByReason.items()},
+				"recent": list( self.downtimeRecent ),
+			}
+	
+	## END Monitoring downtime
+	
+	## Survey
+	
+	survey = None # FilterSurvey in progress
+	lastSurvey = None # last FilterSurvey, kept for its table
+	surveyFilter1Backup = None # ELM327-side filter to restore at the end of the survey
+	def startSurvey( self, partitionBits=None, dwell=None, rounds=None ):
+		"""
+		Start a survey of the identifiers of the bus, replacing the ELM327-side filter until it is finished
+		Default arguments come from parameters canBusSurveyPartitionBits, canBusSurveyDwell & canBusSurveyRounds.
+		Throws a ValueError if the CAN bus is not found yet, or if partitionBits exceeds FilterSurvey.maxPartitionBits
+		"""
+		canBusIsExtended = getattr( self, "canBusIsExtended", None )
+		if canBusIsExtended is None:
+			raise ValueError( "The CAN bus is not found yet" )
+		survey = FilterSurvey(
+			canBusIsExtended and 29 or 11,
+			partitionBits if partitionBits is not None else self.surveyPartitionBits,
+			dwell if dwell is not None else self.surveyDwell,
+			rounds if rounds is not None else self.surveyRounds,
+		)
+		with self.surveyLock:
+			if self.survey is None:
+				self.surveyFilter1Backup = self.getFilter1Remote()
+			self.survey = survey
+			self.lastSurvey = survey
+			self.setFilter1Remote( *survey.getFilter() )
+		printT( "Started a survey of %u partitions, %.1f s each"%(survey.partitionsCount, survey.dwell) )
+	
+	def stopSurvey( self ):
+		""" Stop the survey in progress and restore the ELM327-side filter """
+		with self.surveyLock:
+			if self.survey is not None:
+				self.survey.pause( perf_counter() ) # monitoring time of the last visit, before the filter change interrupts ATMA
+				self.survey = None
+				self.setFilter1Remote( *self.surveyFilter1Backup )
+				self.surveyFilter1Backup = None
+				printT( "The survey has been stopped." )
+	
+	def rotateSurvey( self ):
+		""" Install the next partition of the survey in progress once the dwell time is over """
+		survey = self.survey
+		if survey is None or not survey.isDwellOver( perf_counter() ):
+			return
+		with self.surveyLock:
+			if self.survey is not survey:
+				return # stopped meanwhile
+			if survey.next():
+				self.setFilter1Remote( *survey.getFilter() ) # ATMA is restarted by the monitoring loop
+				return
+		printT( "The survey is finished." )
+		self.stopSurvey()
+	
+	def getSurvey( self ):
+		""" Get the state and the table of identifiers of the last survey, None if none """
+		survey = self.lastSurvey
+		if survey is None:
+			return None
+		state = survey.getState()
+		state["running"] = survey is self.survey
+		state["identifiers"] = survey.getTable()
+		return state
+	
+	## END Survey
+	
+	## OBD polling
+	
+	obdScheduler = None # OBDPollingScheduler, created by setObdPids()
+	obdBatch = None # requests of the batch in progress
+	obdBatchRequestsDuration = 0. # time spent sending requests and reading answers in the batch in progress
+	def setObdPids( self, requests ):
+		"""
+		Set the OBD requests to poll between ATMA monitoring sessions (for the sequence file)
+		- requests: {request: target refresh rate in Hz}, request like "010C" (mode & PID in hexadecimal)
+		Answers are stored in lastResponseDatas (data after the mode & PID) and passed to pidResponseCallbacks.
+		Only single-frame answers from obdResponseAddress are supported.
+		"""
+		normalized = {}
+		for request, rate in requests.items():
+			if type( request ) is str:
+				request = request.encode( "ascii" )
+			request = request.replace( b" ", b"" ).upper()
+			if len( request )<4 or len( request )>14 or len( request )%2!=0:
+				raise ValueError( "Invalid OBD request: %s"%(request,) )
+			bytes.fromhex( request.decode( "ascii" ) ) # throws a ValueError if invalid
+			if rate<=0.:
+				raise ValueError( "Invalid refresh rate for OBD request %s: %s"%(request, rate) )
+			normalized[request] = rate
+		if self.obdScheduler is None:
+			if not normalized:
+				return
+			self.obdScheduler = OBDPollingScheduler( self.obdPollingBlindTimeBudget, self.obdPollingMaxBatchDuration )
+		self.obdScheduler.setRequests( normalized, perf_counter() )
+	
+	def setPidResponseCallback( self, request, callback ):
+		""" Set the function called as callback( request, data ) for each answer to an OBD request, None to remove it """
+		if type( request ) is str:
+			request = request.encode( "ascii" )
+		request = request.replace( b" ", b"" ).upper()
+		if callback is None:
+			self.pidResponseCallbacks.pop( request, None )
+		else:
+			self.pidResponseCallbacks[request] = callback
+	
+	def getObdRequestAddress( self ):
+		if self.obdRequestAddress is not None:
+			return self.obdRequestAddress
+		return self.canBusIsExtended and 0x18DB33F1 or 0x7DF
+	
+	def getObdResponseAddress( self ):
+		if self.obdResponseAddress is not None:
+			return self.obdResponseAddress
+		return self.canBusIsExtended and 0x18DAF110 or 0x7E8
+	
+	def pollObdIfDue( self ):
+		"""
+		Send a batch of due OBD requests if the blind time budget allows it (during ATMA operation)
+		Return True if ATMA has been left, so that the monitoring loop restarts it
+		"""
+		scheduler = self.obdScheduler
+		if scheduler is None:
 			return False
-		
-		filter2Blacklist = self.filter2Blacklist
-		if ( filter2Blacklist is not None ) and ( identifier in filter2Blacklist ):
+		batch = scheduler.planBatch( perf_counter() )
+		if not batch:
 			return False
-		
+		self.leaveMonitoring( "OBD polling" )
+		self.setTransmitHeader( self.getObdRequestAddress(), self.canBusIsExtended )
+		# Only the answers pass the ELM327-side filter:
+		if self.canBusIsExtended:
+			self.write( b"ATCRA "+bytes( "%.8X"%(self.getObdResponseAddress(),), "ascii" )+b"\x0D" )
+		else:
+			self.write( b"ATCRA "+bytes( "%.3X"%(self.getObdResponseAddress(),), "ascii" )+b"\x0D" )
+		self.waitForPrompt( "No prompt after ATCRA!", noSilentTest=True )
+		requestsStartedAt = perf_counter()
+		for request in batch:
+			requestStartedAt = perf_counter()
+			data = self.sendObdRequest( request )
+			requestEndedAt = perf_counter()
+			scheduler.requestDone( request, requestEndedAt, requestEndedAt-requestStartedAt, data is not None )
+		self.obdBatchRequestsDuration = perf_counter()-requestsStartedAt
+		# Restore the ELM327-side filter:
+		with self.filter1RemoteLock:
+			commandATCF = b"ATCF "+bytes( "%.8X"%(self.filter1RemoteResult&self.maskOver,), "ascii" )+b"\x0D"
+			commandATCM = b"ATCM "+bytes( "%.8X"%(self.filter1RemoteMask&self.maskOver,), "ascii" )+b"\x0D"
+		self.write( commandATCF+commandATCM )
+		self.waitForPrompt( "No prompt after ATCF & ATCM!", 64, noSilentTest=True, promptsCount=2 )
+		self.obdBatch = batch # paid for when ATMA is restarted
 		return True
 	
-	## END Filters
+	def sendObdRequest( self, request ):
+		"""
+		Send an OBD request and read its answer (out of ATMA operation)
+		Return the data of the answer after the mode & PID, None if no valid answer
+		"""
+		# Raw CAN data formatting: single-frame PCI byte & padding added here
+		requestLen = len( request )//2
+		self.write( b"%.2X"%(requestLen,)+request+b"00"*( 7-requestLen )+b"\x0D" )
+		self.setReadTimeout( self.obdPollingTimeout )
+		lines = []
+		currentLine = bytearray()
+		for numByte in range( 1024 ):
+			newByte = self.read()
+			if len( newByte )==0:
+				break # no prompt (timeout)
+			if newByte==b'\x0D' or newByte==b'>':
+				if currentLine:
+					lines.append( bytes( currentLine ) )
+					currentLine = bytearray()
+				if newByte==b'>':
+					break
+			elif newByte!=b' ' and newByte!=b'\x00':
+				currentLine.extend( newByte )
+		else: # exceeded max length
+			self.flushInput( 255 )
+		self.setReadTimeout( 0.5 )
+		atmaDecoder = self.atmaDecoder
+		if atmaDecoder is None:
+			atmaDecoder = self.buildATMADecoder()
+		expectedStart = bytes( (int( request[0:2], base=16 )+0x40,) )+bytes.fromhex( request[2:].decode( "ascii" ) )
+		answerData = None
+		for line in lines:
+			try:
+				canFrame = atmaDecoder.decode( line )
+			except (MemoryError, InterruptedError):
+				continue
+			if not canFrame:
+				continue # like "NO DATA" or "CAN ERROR"
+			canFrame = CANFrame( *canFrame )
+			self.handleNewFrame( canFrame )
+			data = canFrame.data
+			if answerData is None and len( data )>=1 and data[0]<=7 and data[0]<len( data ) \
+			and data[1:1+len( expectedStart )]==expectedStart:
+				answerData = data[1+len( expectedStart ):1+data[0]]
+		if answerData is not None:
+			self.lastPid = request
+			self.lastResponseDatas[request] = answerData
+			callback = self.pidResponseCallbacks.get( request )
+			if callback is not None:
+				try:
+					callback( request, answerData )
+				except Exception:
+					printT( format_exc() )
+		return answerData
+	
+	def getObdPolling( self ):
+		""" Get the state of the OBD polling with the last answers, None if no OBD request is declared """
+		scheduler = self.obdScheduler
+		if scheduler is None:
+			return None
+		state = scheduler.getState( perf_counter() )
+		for entry in state["requests"]:
+			lastResponseData = self.lastResponseDatas.get( entry["request"].encode( "ascii" ) )
+			entry["lastResponseData"] = ( lastResponseData is not None ) and bytes_hex( lastResponseData ) or None
+		return state
+	
+	## END OBD polling
+	
+	## CAN transmission
+	
+	transmitHeader = None # (identifier, isExtended) set with ATSH & ATCP, None if unknown
+	transmitNextWindow = 0. # perf_counter() before which no transmission window starts
+	def queueTransmit( self, frames ):
+		"""
+		Queue CAN frames to transmit between ATMA monitoring sessions
+		- frames: iterable of (identifier, data) or (identifier, data, isExtended), data of 1 to 8 bytes
+		  isExtended defaults to the identifier length of the CAN bus.
+		Return the count of queued frames (the others are dropped when the queue is full)
+		Throws a ValueError if a frame is invalid or if the CAN bus is not found yet
+		"""
+		canBusIsExtended = getattr( self, "canBusIsExtended", None )
+		if canBusIsExtended is None:
+			raise ValueError( "The CAN bus is not found yet" )
+		checkedFrames = []
+		for frame in frames:
+			identifier = frame[0]
+			data = bytes( frame[1] )
+			isExtended = canBusIsExtended
+			if len( frame )>2 and frame[2] is not None:
+				isExtended = bool( frame[2] )
+			if isExtended!=canBusIsExtended and not self.allowMixedIdentifiers:
+				raise ValueError( "Mixed identifier lengths are not allowed on this CAN bus" )
+			if identifier<0 or identifier>( isExtended and 0x1FFFFFFF or 0x7FF ):
+				raise ValueError( "Invalid CAN identifier: %s"%(identifier,) )
+			if len( data )<1 or len( data )>8:
+				raise ValueError( "Invalid CAN frame length: %u"%(len( data ),) )
+			checkedFrames.append( (identifier, isExtended, data) )
+		return self.transmitQueue.push( checkedFrames )
+	
+	def setTransmitHeader( self, identifier, isExtended ):
+		""" Select the identifier of transmitted frames (out of ATMA operation), return True if it changed """
+		if self.transmitHeader==(identifier, isExtended):
+			return False
+		if isExtended:
+			# Priority bits with ATCP, then the 24 lower bits with ATSH (ELM327 v1.x)
+			commands = b"ATCP "+bytes( "%.2X"%(identifier>>24,), "ascii" )+b"\x0D"
+			commands += b"ATSH "+bytes( "%.6X"%(identifier&0xFFFFFF,), "ascii" )+b"\x0D"
+			self.write( commands )
+			self.waitForPrompt( "No prompt after ATCP & ATSH!", 64, noSilentTest=True, promptsCount=2 )
+		else:
+			self.write( b"ATSH "+bytes( "%.3X"%(identifier,), "ascii" )+b"\x0D" )
+			self.waitForPrompt( "No prompt after ATSH!", noSilentTest=True )
+		self.transmitHeader = (identifier, isExtended)
+		return True
+	
+	def transmitIfQueued( self ):
+		"""
+		Send queued frames in a transmission window if allowed (during ATMA operation)
+		The window lasts up to canBusTransmitWindowMaxDuration, and ATMA runs at least canBusTransmitMinMonitoringTime between windows.
+		Return True if ATMA has been left, so that the monitoring loop restarts it
+		"""
+		transmitQueue = self.transmitQueue
+		if not len( transmitQueue ) or perf_counter()<self.transmitNextWindow:
+			return False
+		windowStartedAt = perf_counter()
+		self.leaveMonitoring( "CAN transmission" )
+		# No wait for answers after each frame:
+		self.write( b"ATR0\x0D" )
+		self.waitForPrompt( "No prompt after ATR0!", noSilentTest=True )
+		deadline = perf_counter()+self.transmitWindowMaxDuration
+		while perf_counter()<deadline:
+			frame = transmitQueue.pop( self.transmitHeader )
+			if frame is None:
+				break
+			identifier, isExtended, data = frame
+			headerChanged = self.setTransmitHeader( identifier, isExtended )
+			self.write( bytes_hex( data ).upper().encode( "ascii" )+b"\x0D" )
+			answer = self.readAnwer()
+			success = answer is not False and "ERROR" not in answer and "?" not in answer
+			transmitQueue.countSent( success, headerChanged )
+		self.write( b"ATR1\x0D" )
+		self.waitForPrompt( "No prompt after ATR1!", noSilentTest=True )
+		windowEndedAt = perf_counter()
+		transmitQueue.countWindow( windowEndedAt-windowStartedAt )
+		self.transmitNextWindow = windowEndedAt+self.transmitMinMonitoringTime
+		return True
+	
+	def getTransmitStats( self ):
+		""" Get the counters of transmitted frames, with the time spent out of ATMA for them """
+		stats = self.transmitQueue.getStats()
+		with self.downtimeLock:
+			downtime = self.downtimeByReason.get( "CAN transmission" )
+			stats["downtime"] = ( downtime is not None ) and dict( downtime ) or {"count": 0, "total": 0., "max": 0.}
+		return stats
+	
+	## END CAN transmission
 	
 	def write( self, data ):
 		if self.serialShowSentBytes:
 			printT( "    PC :", data.decode( "ascii", "replace" ) )
+		if self.serialRecorder is not None:
+			self.serialRecorder.recordSent( data, timeNs() )
 		return self.ser.write( data )
+	def setReadTimeout( self, timeout ):
+		""" Set the I/O timeout of read operations, only reconfiguring the serial port on change """
+		if self.serialReader is not None or self.serialEpollInput is not None:
+			self.readTimeout = timeout
+		elif self.ser.timeout!=timeout:
+			self.ser.timeout = timeout
+	def fetchInput( self, minReadCount=1, idleTimeout=None ):
+		"""
+		Fetch awaiting bytes from the serial port (at least minReadCount bytes or timeout)
+		- idleTimeout: if nothing is received before the I/O timeout, keep waiting for the 1st byte up to this time
+		  Only the serial reader thread and the epoll backend wait so (no polling), the caller has to retry otherwise.
+		"""
+		if self.serialReader is not None:
+			newBytes = self.serialReader.ring.read( minReadCount, self.readTimeout, idleTimeout )
+		elif self.serialEpollInput is not None:
+			newBytes = self.serialEpollInput.read( minReadCount, self.readTimeout, idleTimeout )
+		else:
+			newBytes = self.ser.read( max( minReadCount, self.ser.in_waiting ) )
+		self.fetchCount += 1
+		self.receivedBytesCount += len( newBytes )
+		if self.serialRecorder is not None and len( newBytes ):
+			self.recordReceived( newBytes )
+		return newBytes
+	
+	## Serial recording
+	
+	serialRecorder = None
+	def updateSerialRecorder( self ):
+		""" Start, stop or change the recording of the serial byte stream according to parameters """
+		serialRecorder = self.serialRecorder
+		if serialRecorder is not None and serialRecorder.filename!=self.serialRecordFile:
+			self.serialRecorder = None
+			serialRecorder.close()
+			printT( "The serial recording to "+serialRecorder.filename+" has been stopped." )
+		if self.serialRecordFile is not None and self.serialRecorder is None:
+			try:
+				self.serialRecorder = SerialRecorder( self.serialRecordFile )
+				printT( "Recording the serial byte stream to "+self.serialRecordFile )
+			except OSError as e:
+				printT( "Could not open the serial recording file:", e )
+				self.serialRecordFile = None
+	
+	def recordReceived( self, newBytes ):
+		""" Record fetched bytes, chunk by chunk with their arrival time if known """
+		serialRecorder = self.serialRecorder
+		if self.serialReader is not None:
+			chunkStart = 0
+			for anchorOffset, arrivalNs in self.serialReader.ring.readAnchors:
+				serialRecorder.recordReceived( newBytes[chunkStart:anchorOffset], arrivalNs )
+				chunkStart = anchorOffset
+			if chunkStart<len( newBytes ):
+				serialRecorder.recordReceived( newBytes[chunkStart:], timeNs() )
+		else:
+			serialRecorder.recordReceived( newBytes, timeNs() )
+	
+	## END Serial recording
+	
+	def openSerialReader( self ):
+		""" Start the epoll backend and the dedicated thread reading the open serial port, if enabled """
+		self.readTimeout = self.ser.timeout
+		if self.serialEpollEnabled:
+			if SerialEpollInput.isSupported( self.ser ):
+				self.serialEpollInput = SerialEpollInput( self.ser )
+			else:
+				printT( "The epoll serial backend is not supported on this system, using pySerial instead." )
+		if self.serialReaderThreadEnabled:
+			realTime = None
+			if self.serialReaderRealTime:
+				realTime = {"cpu": self.serialReaderRealTimeCpu, "priority": self.serialReaderRealTimePriority}
+			serialReader = SerialReaderThread( self.ser, SerialRingBuffer( self.serialReaderRingSize ), self.serialEpollInput, realTime )
+			serialReader.start()
+			self.serialReader = serialReader
+	def closeSerialReader( self ):
+		""" Stop the dedicated thread and the epoll backend reading the serial port, before closing it """
+		serialReader = self.serialReader
+		serialEpollInput = self.serialEpollInput
+		if serialReader is not None:
+			self.serialReader = None
+			serialReader.stop()
+		if serialEpollInput is not None:
+			self.serialEpollInput = None
+			serialEpollInput.close()
+		if serialReader is not None or serialEpollInput is not None:
+			self.ser.timeout = self.readTimeout
+	def getSerialReaderStats( self ):
+		""" Get the statistics of the ring buffer filled by the serial reader thread, its scheduling latency and the real-time mode """
+		serialReader = self.serialReader
+		if serialReader is None:
+			return None
+		stats = serialReader.ring.getStats()
+		stats["latency"] = serialReader.latencyStats.getStats()
+		stats["driverErrors"] = serialReader.getErrorCounters()
+		stats["realTime"] = serialReader.realTimeState
+		stats["garbageCollection"] = self.getGarbageCollectionStats()
+		return stats
+	
+	## Real-time mode
+	
+	gcControlled = False # automatic garbage collection disabled, run at controlled points instead
+	gcTicks = 0
+	def updateRealTimeMode( self ):
+		"""
+		Apply the garbage collection policy of the real-time mode (serialReaderRealTime)
+		Garbage collection holds the GIL, so it can delay the serial reader thread at any time.
+		In real-time mode, the startup heap is frozen (never scanned again) and collections only run at controlled points.
+		"""
+		if self.serialReaderRealTime and not self.gcControlled:
+			gc.collect()
+			if hasattr( gc, "freeze" ):
+				gc.freeze()
+			gc.disable()
+			self.gcControlled = True
+			self.gcPauses = {"count": 0, "total": 0., "max": 0.}
+		elif not self.serialReaderRealTime and self.gcControlled:
+			if hasattr( gc, "unfreeze" ):
+				gc.unfreeze()
+			gc.enable()
+			self.gcControlled = False
+	
+	def collectGarbage( self, fullCollection=False ):
+		"""
+		Run the garbage collector at a controlled point in real-time mode, measuring its pause
+		Young generations are collected about once per second, the full collection once per minute and on reconnection.
+		"""
+		if not self.gcControlled:
+			return
+		self.gcTicks += 1
+		if self.gcTicks%60==0:
+			fullCollection = True
+		startedAt = perf_counter()
+		gc.collect( fullCollection and 2 or 1 )
+		pause = perf_counter()-startedAt
+		gcPauses = self.gcPauses
+		gcPauses["count"] += 1
+		gcPauses["total"] += pause
+		if pause>gcPauses["max"]:
+			gcPauses["max"] = pause
+	
+	def getGarbageCollectionStats( self ):
+		if not self.gcControlled:
+			return {"controlled": False}
+		stats = dict( self.gcPauses )
+		stats["controlled"] = True
+		if hasattr( gc, "get_freeze_count" ):
+			stats["frozenObjects"] = gc.get_freeze_count()
+		return stats
+	
+	## END Real-time mode
+	
 	def read( self, *, minReadCount=1, retryDelayIfEmpty=None ):
 		"""
 		Read 1 byte from the input buffer
@@ -260,43 +1131,178 @@ class CANCaptureELM327Thread( threading.Thread ):
 			Il faut par exemple ajouter un temps d'attente paramétré si self.ser.in_waiting < minReadCount (très court, de valeur éventuellement calculée par rapport au débit => durée d'envoi d'octets).
 			Attention, le code qui suit la lecture est lui aussi intensif, puisqu'il n'y avait plus d'erreurs de décodage quand la trame est mise à False.
 			'''
-			if not self.readBuffer:
+			readBuffer = self.readBuffer
+			if self.readBufferPos>=len( readBuffer ):
 				# The buffer is empty, fetching new bytes.
 				# The awaiting bytes count is not unlimited so there should be no excessive memory usage.
+				self.discardReadInput()
 				if retryDelayIfEmpty is not None:
 					readStartedAt = perf_counter()
 				while True:
-					newBytes = self.ser.read( max( minReadCount, self.ser.in_waiting ) )
-					if newBytes:
-						# bytes received: append new bytes
-						self.readBuffer.extend( newBytes )
+					if self.bufferInput( minReadCount, retryDelayIfEmpty ):
+						# bytes received: appended new bytes
 						break
 					elif retryDelayIfEmpty is None \
+					  or self.serialReader is not None or self.serialEpollInput is not None \
 					  or ( perf_counter()-readStartedAt )>retryDelayIfEmpty:
 						# nothing received
 						break
-			if self.readBuffer:
-				# The buffer contains something, taking out the first byte.
-				result = bytes( [self.readBuffer.pop( 0 )] )
+			if self.readBufferPos<len( readBuffer ):
+				# The buffer contains something, taking out the byte at the cursor.
+				result = SINGLE_BYTES[readBuffer[self.readBufferPos]]
+				self.readBufferPos += 1
 			else:
 				# The buffer contains nothing.
 				result = b""
 		else:
 			result = self.ser.read()
+			if self.serialRecorder is not None and len( result ):
+				self.serialRecorder.recordReceived( result, timeNs() )
 		if self.serialShowReceivedBytes:
 			if len( result )!=0:
 				printT( "ELM327 :", result.decode( "ascii", "replace" ) )
 			else:
 				printT( "ELM327 : <timeout>" )
 		return result
+	
+	atmaLineIllegalBytesRegex = re.compile( b"[>\x80-\xFF]" )
+	def readLineATMA( self, maxBytesPerLine, *, minReadCount=1, retryDelayIfEmpty=None ):
+		"""
+		Read a whole line from the input buffer (during ATMA operation)
+		Bytes are fetched by chunks and lines are split with a cursor, instead of 1 byte at a time.
+		- maxBytesPerLine: maximum count of bytes in a line, <CR> included
+		- minReadCount: wait for this number of bytes or a timeout (not a length guarantee)
+		- retryDelayIfEmpty: effective timeout (in seconds) when the timeout of the I/O operation is short (low delay)
+		Return the line without <CR>, spaces and nulls (incomplete line on timeout)
+		Return None if nothing read
+		The position of the line in the local buffer is put in lineStartPos.
+		Throws a ConnectionAbortedError if prompt received
+		Throws a ValueError if invalid bytes received
+		"""
+		readBuffer = self.readBuffer
+		# Drop the bytes that have been consumed already:
+		if self.readBufferPos>=len( readBuffer ) or self.readBufferPos>=READ_BUFFER_COMPACT_SIZE:
+			self.discardReadInput()
+		lineStart = self.readBufferPos
+		lineLimit = lineStart+maxBytesPerLine
+		scanFrom = lineStart
+		timedOut = False
+		tooLong = False
+		emptySince = None
+		while True:
+			lineEnd = readBuffer.find( b"\x0D", scanFrom, lineLimit )
+			if lineEnd!=-1:
+				nextPos = lineEnd+1 # <CR> consumed
+				break
+			if readBuffer.find( b">", scanFrom, lineLimit )!=-1:
+				# Prompt without <CR> after it: no need to wait for the end of the line
+				lineEnd = min( len( readBuffer ), lineLimit )
+				nextPos = lineEnd
+				break
+			scanFrom = len( readBuffer )
+			if scanFrom>=lineLimit:
+				# exceeded max length
+				tooLong = True
+				lineEnd = lineLimit
+				nextPos = lineLimit
+				break
+			if self.bufferInput( minReadCount, retryDelayIfEmpty ):
+				emptySince = None
+			elif retryDelayIfEmpty is None or self.serialReader is not None or self.serialEpollInput is not None:
+				timedOut = True # fetchInput() has waited for retryDelayIfEmpty already, or no retry
+			elif emptySince is None:
+				emptySince = perf_counter()
+			elif ( perf_counter()-emptySince )>retryDelayIfEmpty:
+				timedOut = True
+			if timedOut:
+				lineEnd = scanFrom
+				nextPos = scanFrom
+				break
+		# The prompt and illegal bytes interrupt the line where they show up:
+		illegalByte = self.atmaLineIllegalBytesRegex.search( readBuffer, lineStart, lineEnd )
+		if illegalByte is not None:
+			self.readBufferPos = illegalByte.end()
+			if readBuffer[illegalByte.start()]==0x3E: # b'>'
+				raise ConnectionAbortedError( "ELM327: Unexpected prompt during ATMA reading" )
+			else:
+				raise ValueError( "ELM327: Received an illegal byte during ATMA processing!" )
+		self.readBufferPos = nextPos
+		self.lineStartPos = lineStart
+		if tooLong:
+			raise ValueError( "ELM327: Received too many bytes in a single line during ATMA processing!" )
+		line = bytes( readBuffer[lineStart:lineEnd] ).translate( None, b"\x00 " ) # ignore spaces and nulls
+		if self.serialShowReceivedBytes:
+			if timedOut:
+				printT( "ELM327 :", line.decode( "ascii", "replace" ), "<timeout>" )
+			else:
+				printT( "ELM327 :", line.decode( "ascii", "replace" ) )
+		if timedOut and len( line )==0:
+			return None
+		return line
+	def bufferInput( self, minReadCount=1, idleTimeout=None ):
+		"""
+		Fetch awaiting bytes into the local buffer, with their arrival time
+		Return the count of new bytes
+		"""
+		newBytes = self.fetchInput( minReadCount, idleTimeout )
+		newCount = len( newBytes )
+		if newCount:
+			readBuffer = self.readBuffer
+			bufferEnd = len( readBuffer )
+			readBuffer.extend( newBytes )
+			if self.serialReader is not None:
+				# The reader thread has timestamped each chunk it received.
+				for anchorOffset, arrivalNs in self.serialReader.ring.readAnchors:
+					self.readAnchors.append( (bufferEnd+anchorOffset, arrivalNs) )
+			else:
+				self.readAnchors.append( (bufferEnd+newCount, timeNs()) )
+		return newCount
+	def discardReadInput( self ):
+		""" Drop the bytes of the local buffer that have been read already """
+		readBuffer = self.readBuffer
+		readBufferPos = self.readBufferPos
+		if readBufferPos>=len( readBuffer ):
+			readBuffer.clear()
+			self.readAnchors.clear()
+		else:
+			del readBuffer[:readBufferPos]
+			self.readAnchors = [(anchorPos-readBufferPos, arrivalNs) for anchorPos, arrivalNs in self.readAnchors if anchorPos>readBufferPos]
+		self.readBufferPos = 0
+		self.readAnchorIndex = 0
+	def getInputTimeNs( self, pos ):
+		"""
+		Estimate when the byte at the given position of the local buffer arrived (in ns since the epoch)
+		A chunk is timestamped when it is fetched, so each byte is back-dated by the transmission time of the bytes following it in its chunk.
+		Positions must be requested in ascending order until the local buffer is compacted.
+		"""
+		readAnchors = self.readAnchors
+		anchorsCount = len( readAnchors )
+		i = self.readAnchorIndex
+		while i<anchorsCount and readAnchors[i][0]<=pos:
+			i += 1
+		if i>=anchorsCount:
+			return timeNs() # unknown arrival
+		self.readAnchorIndex = i
+		anchorPos, arrivalNs = readAnchors[i]
+		byteTimeNs = 10000000000//self.ser.baudrate # 10 bits per byte (8N1)
+		byteTimeNs = arrivalNs-( anchorPos-1-pos )*byteTimeNs
+		if i>0 and byteTimeNs<readAnchors[i-1][1]:
+			byteTimeNs = readAnchors[i-1][1] # the byte was not there when fetching the previous chunk
+		return byteTimeNs
 	def flushInput( self, bytesToRead=255 ):
 		self.readBuffer.clear()
+		self.readBufferPos = 0
+		self.readAnchors.clear()
+		self.readAnchorIndex = 0
 		self.ser.reset_input_buffer()
-		self.ser.read( bytesToRead )
+		if self.serialReader is not None:
+			self.serialReader.ring.clear()
+		self.fetchInput( bytesToRead )
 	
 	# Reading of bytes until getting the prompt '>'; nothing must arrive after it.
 	# Returns True if the prompt has been found.
-	def waitForPrompt( self, errorMessageOnFailure=None, maxBytesToRead=32, noSilentTest=False ):
+	# promptsCount is the number of prompts to wait for, when several commands have been sent at once.
+	def waitForPrompt( self, errorMessageOnFailure=None, maxBytesToRead=32, noSilentTest=False, promptsCount=1 ):
 		# An exception is thrown only when exceerrorMessageOnFailure is defined (character string).
 		failure = False
 		for numByte in range( maxBytesToRead ):
@@ -305,8 +1311,10 @@ class CANCaptureELM327Thread( threading.Thread ):
 				failure = True
 				break
 			elif newByte==b'>':
-				break
-		self.ser.timeout = 0.5
+				promptsCount -= 1
+				if promptsCount<=0:
+					break
+		self.setReadTimeout( 0.5 )
 		if not failure and ( noSilentTest or len( self.read() )==0 ):
 			return True
 		elif errorMessageOnFailure is None:
@@ -343,23 +1351,50 @@ class CANCaptureELM327Thread( threading.Thread ):
 				return line
 		return lines[len( lines )-1]
 	
+	def leaveMonitoring( self, reason ):
+		""" Interrupt ATMA to send commands, handling the frames received until the prompt """
+		self.interruptedMonitoring( reason )
+		self.write( b"\x0D" )
+		while True:
+			try:
+				frame = self.readFrame()
+			except (MemoryError, InterruptedError, ConnectionAbortedError, ValueError):
+				break # prompt received
+			if frame is None:
+				break # nothing received: the prompt may have been lost
+			elif frame is True or frame==False:
+				pass
+			else:
+				self.handleNewFrame( frame )
+	
 	def stopMonitoring( self, stopMonitoringReason ):
 		""" Interrupts ATMA and displays the reason """
 		if self.stopMonitoringAttempts>self.stopMonitoringMaxAttempts:
 			raise ConnectionError( "Failed %u times to interrupt ATMA"%(self.stopMonitoringAttempts,) )
+		self.interruptedMonitoring( stopMonitoringReason or "Interrupted" )
 		self.write( b"\x0D" )
 		self.stopMonitoringAttempts += 1
 		if stopMonitoringReason:
 			printT( "Interrupted monitoring: "+stopMonitoringReason )
 	
-	canFrameRegex11 = re.compile( b"^([0-7][0-9A-F]{2})([0-9A-F])(?:(RTR)|([0-9A-F]*))", re.IGNORECASE )
-	canFrameRegex29 = re.compile( b"^([0-1][0-9A-F]{7})([0-9A-F])(?:(RTR)|([0-9A-F]*))", re.IGNORECASE )
+	atmaDecoder = None
+	def buildATMADecoder( self ):
+		""" Setup the decoder of ATMA lines for the current bus & parameters """
+		if self.canBusDecoderTableDriven:
+			self.atmaDecoder = ATMALineDecoder( self.canBusIsExtended, self.allowMixedIdentifiers, self.canBusDecoderCacheSize )
+		else:
+			self.atmaDecoder = ATMALineDecoderRegex( self.canBusIsExtended, self.allowMixedIdentifiers )
+		parserProcess = self.parserProcess
+		if parserProcess is not None:
+			parserProcess.setDecoder( self.canBusIsExtended, self.allowMixedIdentifiers, self.canBusDecoderCacheSize )
+		return self.atmaDecoder
 	
 	straightInvalidFramesCount = 0
 	def readFrame( self, maxBytesPerLine=128 ):
 		"""
 		Read a line that should contain a frame (during ATMA operation)
 		Return a CANFrame on success
+		Return True if the line has been sent to the parser process
 		Return False if invalid frame
 		Return None if nothing read
 		Throws a MemoryError if received "BUFFER FULL"
@@ -373,100 +1408,79 @@ class CANCaptureELM327Thread( threading.Thread ):
 		# Read an incoming line
 		if self.serialLocalBufferAccuATMA:
 			# short I/O timeout (several attempts until effective timeout)
-			self.ser.timeout = self.serialLocalBufferWaitTimeATMA
+			self.setReadTimeout( self.serialLocalBufferWaitTimeATMA )
 		else:
 			# I/O timeout = effective timeout
-			self.ser.timeout = self.inactivityTimeout
+			self.setReadTimeout( self.inactivityTimeout )
 		currentLine = bytearray()
+		lineTimeNs = None # arrival time of the line, when known
 		timedOutEmpty = False
 		try:
-			for numByte in range( maxBytesPerLine ):
+			if self.serialLocalBufferLinesATMA:
 				if self.serialLocalBufferAccuATMA:
-					newByte = self.read( minReadCount=self.serialLocalBufferMinFillATMA, retryDelayIfEmpty=self.inactivityTimeout )
+					currentLine = self.readLineATMA( maxBytesPerLine, minReadCount=self.serialLocalBufferMinFillATMA, retryDelayIfEmpty=self.inactivityTimeout )
 				else:
-					newByte = self.read()
-				if len( newByte )==0:
-					if len( currentLine )==0:
-						timedOutEmpty = True
-					#printT( "readFrame() - len( newByte )==0" ) # debug
-					break
-				newByteInt = newByte[0]
-				if newByte==b'\x0D':
-					break # end of line
-				elif newByte==b'>':
-					raise ConnectionAbortedError( "ELM327: Unexpected prompt during ATMA reading" )
-				elif newByte==b'\x00' or newByte==b' ':
-					pass # ignore spaces and nulls
-				elif newByteInt>0x00 and newByteInt<0x80:
-					currentLine.extend( newByte )
+					currentLine = self.readLineATMA( maxBytesPerLine )
+				if currentLine is None:
+					currentLine = b""
+					timedOutEmpty = True
 				else:
-					raise ValueError( "ELM327: Received an illegal byte during ATMA processing!" )
-			else: # exceeded max length
-				raise ValueError( "ELM327: Received too many bytes in a single line during ATMA processing!" )
+					lineTimeNs = self.getInputTimeNs( self.lineStartPos )
+			else:
+				for numByte in range( maxBytesPerLine ):
+					if self.serialLocalBufferAccuATMA:
+						newByte = self.read( minReadCount=self.serialLocalBufferMinFillATMA, retryDelayIfEmpty=self.inactivityTimeout )
+					else:
+						newByte = self.read()
+					if len( newByte )==0:
+						if len( currentLine )==0:
+							timedOutEmpty = True
+						#printT( "readFrame() - len( newByte )==0" ) # debug
+						break
+					newByteInt = newByte[0]
+					if numByte==0 and self.serialLocalBufferEnabled:
+						lineTimeNs = self.getInputTimeNs( self.readBufferPos-1 )
+					if newByte==b'\x0D':
+						break # end of line
+					elif newByte==b'>':
+						raise ConnectionAbortedError( "ELM327: Unexpected prompt during ATMA reading" )
+					elif newByte==b'\x00' or newByte==b' ':
+						pass # ignore spaces and nulls
+					elif newByteInt>0x00 and newByteInt<0x80:
+						currentLine.extend( newByte )
+					else:
+						raise ValueError( "ELM327: Received an illegal byte during ATMA processing!" )
+				else: # exceeded max length
+					raise ValueError( "ELM327: Received too many bytes in a single line during ATMA processing!" )
 			# Decode the line
 			if not timedOutEmpty:
+				self.atmaLinesCount += 1
 				# Note: spaces are removed, messages are spaceless.
-				# Note: receiving a 29-bit frame on an 11-bit CAN bus & vice-versa are not documented but seem to be accepted, so they are handled as they come.
 				if len( currentLine )==0:
 					canFrame = False # nothing on the line (like corrupted frame)
 					printT( "ELM327: Received an empty ATMA line" )
-				elif b"ELM327" in currentLine:
-					raise ChildProcessError( "ELM327: Detected a reboot during ATMA processing!" )
-				elif b"BUFFERFULL" in currentLine:
-					raise MemoryError( "ELM327: Received a BUFFER FULL alert during ATMA processing!" )
-				elif b"STOPPED" in currentLine:
-					raise InterruptedError( "ELM327: Received a STOPPED alert during ATMA processing!" )
-				elif b"<RXERROR" in currentLine:
-					canFrame = False # corrupted frame (ignored frame)
-				elif b"<DATAERROR" in currentLine:
-					# Warning: incorrect CRCs may produce "DATA ERROR" but no way to distinguish them!
-					pass
-				if canFrame is None: # frame not corrupted
-					canFrameIsRTR = False
-					if b"RTR" in currentLine:
-						canFrameIsRTR = True
-					# Try parsing the frame with both identifier lengths
-					for canFrameIsExtended in self.allowMixedIdentifiers and (self.canBusIsExtended, not self.canBusIsExtended) or (self.canBusIsExtended,):
-						canFrameRegex = canFrameIsExtended and self.canFrameRegex29 or self.canFrameRegex11
-						canFramePieces = canFrameRegex.match( currentLine )
-						if canFramePieces:
-							canFrameData = None
-							try:
-								if canFrameIsRTR:
-									canFrameData = b''
-								else:
-									canFrameData = bytes.fromhex( canFramePieces.group( 4 ).decode( "ascii", "replace" ) )
-								# Note: canFrameData must have a maximum of 8 bytes, otherwise readings are incorrect.
-							except ValueError:
-								# The 11-bit identifier has an odd number of digits.
-								# The 29-bit identifier has an even number of digits.
-								# This exception is raised for wrong identifier sizes + for some incomplete lines.
-								continue # incomplete byte in frame (ignored frame)
-							canFrameIdentifier = int( canFramePieces.group( 1 ), base=16 )
-							if canFrameIdentifier>( canFrameIsExtended and 0x1FFFFFFF or 0x7FF ):
-								continue # invalid identifier (over maximum)
-							elif canFrameIdentifier<0:
-								continue # invalid identifier (negative)
-							canFrameDLC = int( canFramePieces.group( 2 ), base=16 )
-							if not canFrameIsRTR:
-								canFrameLengthActual = len( canFrameData )
-								if canFrameLengthActual>8:
-									continue # impossible frame containing more than 8 bytes (ignored frame)
-								canFrameLength = ( canFrameDLC<=8 ) and canFrameDLC or 8 # DLC, truncated to 8 bytes (max transmitted length)
-								if canFrameLengthActual<canFrameLength:
-									continue # DLC comparison: missing bytes in frame (ignored frame)
-								if canFrameLengthActual>canFrameLength:
-									continue # impossible: data length longer than DLC
-							canFrame = CANFrame(
-								identifier=canFrameIdentifier,
-								isExtended=canFrameIsExtended,
-								isRTR=canFrameIsRTR,
-								DLC=canFrameDLC,
-								data=canFrameData,
-							)
-							# canFrame = False # debug: pretend malformed frame instead of processing it
-							break
+				else:
+					atmaDecoder = self.atmaDecoder
+					if atmaDecoder is None:
+						atmaDecoder = self.buildATMADecoder()
+					parserProcess = self.parserProcess
+					if parserProcess is not None:
+						# Only alerts are handled here, frames are decoded by the parser process.
+						canFrame = atmaDecoder.decodeStatus( currentLine )
+						if canFrame is None:
+							if lineTimeNs is None:
+								lineTimeNs = timeNs()
+							parserProcess.pushLine( bytes( currentLine ), lineTimeNs )
+							if self.readBufferPos>=len( self.readBuffer ):
+								parserProcess.flush() # no more received line to push for now
+							canFrame = True
 					else:
+						canFrame = atmaDecoder.decode( bytes( currentLine ) )
+					if canFrame is True:
+						pass
+					elif canFrame:
+						canFrame = CANFrame( *canFrame, timestamp=lineTimeNs )
+					elif canFrame is None:
 						canFrame = False
 						printT( "ELM327: Cannot decode ATMA line: %s"%(str( currentLine ),) )
 		finally:
@@ -476,124 +1490,207 @@ class CANCaptureELM327Thread( threading.Thread ):
 				self.straightInvalidFramesCount = 0
 				if timedOutEmpty:
 					# Will recover (nothing received): restore timeout
-					self.ser.timeout = 0.5
+					self.setReadTimeout( 0.5 )
 			elif exceptionType==MemoryError or exceptionType==InterruptedError:
 				# Will recover (no problem): restore timeout + wait for prompt
 				promptTimeoutMessage = None
 				if exceptionType==MemoryError:
+					self.interruptedMonitoring( "BUFFER FULL" )
 					promptTimeoutMessage = "ELM327: No prompt after BUFFER FULL alert during ATMA processing!"
 				elif exceptionType==InterruptedError:
+					self.interruptedMonitoring( "STOPPED" )
 					promptTimeoutMessage = "ELM327: No prompt after STOPPED alert during ATMA processing!"
-				self.ser.timeout = 0.5
+				self.setReadTimeout( 0.5 )
 				# The prompt may show up anywhere, wait for it when not included in currentLine:
 				if b'>' not in currentLine:
 					self.waitForPrompt( promptTimeoutMessage, 64, noSilentTest=True )
 			elif exceptionType==ValueError:
 				# Will recover (invalid bytes received): restore timeout + wait for prompt
+				self.interruptedMonitoring( "Invalid bytes" )
 				if self.straightInvalidFramesCount>self.maxStraightInvalidFrames:
 					self.stopMonitoring( "Received more than %u invalid CAN frames in a row"%(self.straightInvalidFramesCount) )
 					self.straightInvalidFramesCount = 0
-				self.ser.timeout = 0.5
+				self.setReadTimeout( 0.5 )
 				self.waitForPrompt( "ELM327: No prompt received after stopping ATMA (ValueError)", 16777215 )
 				self.straightInvalidFramesCount += 1
 			elif exceptionType==ConnectionAbortedError:
 				# Will recover (prompt received): restore timeout
-				self.ser.timeout = 0.5
+				self.interruptedMonitoring( "Unexpected prompt" )
+				self.setReadTimeout( 0.5 )
 			else:
 				# Impossible recover: restore timeout just in case
-				self.ser.timeout = 0.5
+				self.setReadTimeout( 0.5 )
 		return canFrame
 	
 	# Apply the desired baudrate
+	linkStateCache = None
+	linkStateWarm = False # True while connecting with the cached link state
+	def getLinkStateKey( self ):
+		""" Parameters that the cached CAN bus depends on """
+		return {
+			"ATSP": self.scannerATSP.decode( "ascii" ),
+			"ATPB": self.scannerATPB.decode( "ascii" ),
+		}
+	
+	def isFixedProtocol( self ):
+		""" Indicates if ATSP selects a fixed protocol, not an automatic search (0 or A...) """
+		scannerATSP = self.scannerATSP.strip().upper()
+		return scannerATSP not in (b"", b"0") and scannerATSP[:1]!=b"A"
+	
+	def sendInitCommands( self, commands ):
+		""" Send idempotent AT commands, back to back if serialPipelinedInit (prompts read afterwards) """
+		if self.serialPipelinedInit:
+			self.write( b"".join( command+b"\x0D" for command, description in commands ) )
+			self.waitForPrompt( "No prompt after the initialization commands!", 64*len( commands ), noSilentTest=True, promptsCount=len( commands ) )
+		else:
+			for command, description in commands:
+				self.write( command+b"\x0D" ) # description
+				self.waitForPrompt( "No prompt after "+command.decode( "ascii" )+"!" )
+	
+	def forgetWarmLinkState( self ):
+		""" Drop the cached link state if connecting with it failed """
+		if self.linkStateWarm:
+			self.linkStateWarm = False
+			if self.linkStateCache is not None:
+				printT( "Forgetting the link state cache of "+self.serialPort )
+				# The baud rate calibration is kept: it does not depend on the vehicle.
+				self.linkStateCache.forget( self.serialPort, "baudRate", "canBusFamily", "canBusIsExtended", "canBusRate", "ATSP", "ATPB" )
+	
+	def findCanBus( self ):
+		""" Contact the ECU and get the found CAN bus with ATDP """
+		# Attempt to contact the ECU
+		printT( "Contacting the ECU..." )
+		self.setReadTimeout( max( MAX_OBD_NEGOCIATION_TIME, self.inactivityTimeout ) ) # very conservative (1st request)
+		if not DEBUG_DISCONNECTED_CAN_BUS:
+			if self.testObdCompliant:
+				busConnectionConfirmed = False
+				while not busConnectionConfirmed:
+					self.write( b"0100\x0D" ) # test OBD request
+					busConfirmAnswer = self.readAnwer( "No prompt after 0100!" )
+					if "ERROR" in busConfirmAnswer: # BUS ERROR or CAN ERROR
+						continue
+					elif "UNABLE" in busConfirmAnswer: # UNABLE TO CONNECT
+						continue
+					else:
+						busConnectionConfirmed = True
+		# Get the found bus information
+		canBus = self.readCanBus()
+		if canBus is None:
+			raise Exception( "The found OBD bus does not seem to be a CAN bus: %s"%(self.lastBusSpecification,) )
+		self.canBusFamily, self.canBusIsExtended, self.canBusRate = canBus
+		printT( "Connected to CAN bus: %u-bit, %.2f kb/s (%s)"%(self.canBusIsExtended and 29 or 11, self.canBusRate, self.canBusFamily) )
+	
+	lastBusSpecification = None # last answer to ATDP
+	def readCanBus( self ):
+		""" Get the active CAN bus with ATDP: (canBusFamily, canBusIsExtended, canBusRate), None if not a CAN bus """
+		self.setReadTimeout( 0.5 )
+		self.write( b"ATDP\x0D" ) # return active bus protocol
+		busSpecification = self.readAnwer( "No prompt after ATDP!" )
+		self.lastBusSpecification = busSpecification
+		busSpecificationPieces = self.busSpecificationRegex.search( busSpecification )
+		if not busSpecificationPieces:
+			return None
+		canBusFamily = busSpecificationPieces.group( 1 )
+		canBusRate = float( busSpecificationPieces.group( 3 ) )
+		if "USER1" in canBusFamily and self.User1Mul8by7:
+			canBusRate *= 8./7. # ATDP reports the rate unaffected by 8/7
+		return (canBusFamily, busSpecificationPieces.group( 2 )=="29", canBusRate)
+	
 	def applyDesiredBaudRate( self ):
 		if self.ser.baudrate!=self.serialBaudRateDesired:
-			printT( "Switching baud rate (",self.scannerATBRD ,")..." )
-			self.write( b"ATBRT00\x0D" )
-			self.waitForPrompt( "No prompt after ATBRT00!" )
-			self.write( self.scannerATBRD )
-			self.ser.timeout = 2
-			receivedO = False
-			receivedOK = False
-			unsupported = False
-			newByte = None
-			# Wait for "OK"
-			for numByte in range( 8 ):
-				newByte = self.read()
-				if len( newByte )==0 or newByte==b'>':
-					raise Exception( "No answer or invalid answer while applying the desired baudrate!" )
-				elif newByte==b'?': # unsupported
-					printT( "This chip version does not support changing the serial link bitrate, or wrong argument in "+self.scannerATBRD.decode( "ascii" )+"." )
-					self.ser.timeout = 0.5
-					unsupported = True
-					self.waitForPrompt( "No prompt after unsupported ATBRD!" )
+			return self.switchBaudRate( self.serialBaudRateDesired, self.scannerATBRD )
+		return True
+	
+	# Switch to another baudrate with ATBRD (the previous baudrate is restored on failure)
+	def switchBaudRate( self, baudRate, commandATBRD ):
+		previousBaudRate = self.ser.baudrate
+		printT( "Switching baud rate (",commandATBRD ,")..." )
+		self.write( b"ATBRT00\x0D" )
+		self.waitForPrompt( "No prompt after ATBRT00!" )
+		self.write( commandATBRD )
+		self.setReadTimeout( 2 )
+		receivedO = False
+		receivedOK = False
+		unsupported = False
+		newByte = None
+		# Wait for "OK"
+		for numByte in range( 8 ):
+			newByte = self.read()
+			if len( newByte )==0 or newByte==b'>':
+				raise Exception( "No answer or invalid answer while applying the desired baudrate!" )
+			elif newByte==b'?': # unsupported
+				printT( "This chip version does not support changing the serial link bitrate, or wrong argument in "+commandATBRD.decode( "ascii" )+"." )
+				self.setReadTimeout( 0.5 )
+				unsupported = True
+				self.waitForPrompt( "No prompt after unsupported ATBRD!" )
+				break
+			elif newByte==b'O':
+				receivedO = True
+			elif newByte==b'K':
+				if receivedO:
+					receivedOK = True
 					break
-				elif newByte==b'O':
-					receivedO = True
-				elif newByte==b'K':
-					if receivedO:
-						receivedOK = True
-						break
+			else:
+				receivedO = False
+		if unsupported:
+			return False
+		elif not receivedOK:
+			raise Exception( "Invalid answer while applying the desired baudrate!" )
+		# Switch baudrate
+		self.ser.baudrate = baudRate
+		# Wait for "ELM327" (without order checking)
+		unsupported = False
+		receivedStepsATI = {
+			b'E': False,
+			b'L': False,
+			b'M': False,
+			b'3': False,
+			b'2': False,
+			b'7': False,
+		}
+		receivedATI = False
+		for numByte in range( 8 ):
+			newByte = self.read()
+			if len( newByte )==0:
+				unsupported = True
+				break
+			elif newByte==b'7':
+				receivedStepsATI[newByte] = True
+				for byte in receivedStepsATI.keys():
+					if not receivedStepsATI[byte]:
+						unsupported = True
+				if not unsupported:
+					receivedATI = True
 				else:
-					receivedO = False
-			if unsupported:
-				return False
-			elif not receivedOK:
-				raise Exception( "Invalid answer while applying the desired baudrate!" )
-			# Switch baudrate
-			self.ser.baudrate = self.serialBaudRateDesired
-			# Wait for "ELM327" (without order checking)
-			unsupported = False
-			receivedStepsATI = {
-				b'E': False,
-				b'L': False,
-				b'M': False,
-				b'3': False,
-				b'2': False,
-				b'7': False,
-			}
-			receivedATI = False
+					self.waitForPrompt()
+					self.setReadTimeout( 0.5 )
+				break
+			elif newByte in receivedStepsATI:
+				receivedStepsATI[newByte] = True
+			else:
+				for byte in receivedStepsATI.keys():
+					receivedStepsATI[byte] = False
+		# Wait for <CR>
+		receivedCR = False
+		if receivedATI and not unsupported:
 			for numByte in range( 8 ):
 				newByte = self.read()
-				if len( newByte )==0:
-					unsupported = True
+				if newByte==b"\x0D":
+					receivedCR = True
 					break
-				elif newByte==b'7':
-					receivedStepsATI[newByte] = True
-					for byte in receivedStepsATI.keys():
-						if not receivedStepsATI[byte]:
-							unsupported = True
-					if not unsupported:
-						receivedATI = True
-					else:
-						self.waitForPrompt()
-						self.ser.timeout = 0.5
-					break
-				elif newByte in receivedStepsATI:
-					receivedStepsATI[newByte] = True
-				else:
-					for byte in receivedStepsATI.keys():
-						receivedStepsATI[byte] = False
-			# Wait for <CR>
-			receivedCR = False
-			if receivedATI and not unsupported:
-				for numByte in range( 8 ):
-					newByte = self.read()
-					if newByte==b"\x0D":
-						receivedCR = True
-						break
-			if ( not receivedATI ) or ( not receivedCR ) or unsupported:
-				printT( "The communication did not work after applying the desired baudrate!" )
-				self.ser.baudrate = self.serialBaudRateInitial
-				self.waitForPrompt()
-				self.ser.timeout = 0.5
-				return False
-			# Send confirmation
-			self.write( b"\x0D" )
-			self.ser.timeout = 0.5
-			# Wait for prompt and reset waiting delay
-			self.waitForPrompt( "No prompt after setting the desired baudrate!" )
-			self.write( b"ATBRT0F\x0D" )
-			self.waitForPrompt( "No prompt after ATBRT0F!" )
+		if ( not receivedATI ) or ( not receivedCR ) or unsupported:
+			printT( "The communication did not work after applying the desired baudrate!" )
+			self.ser.baudrate = previousBaudRate
+			self.waitForPrompt()
+			self.setReadTimeout( 0.5 )
+			return False
+		# Send confirmation
+		self.write( b"\x0D" )
+		self.setReadTimeout( 0.5 )
+		# Wait for prompt and reset waiting delay
+		self.waitForPrompt( "No prompt after setting the desired baudrate!" )
+		self.write( b"ATBRT0F\x0D" )
+		self.waitForPrompt( "No prompt after ATBRT0F!" )
 		return True
 	
 	def selectATPB_rate( self, expectedRate ):
@@ -636,6 +1733,13 @@ class CANCaptureELM327Thread( threading.Thread ):
 	def handleNewFrame( self, frame ):
 		self.frameHandler.handleNewFrame( frame )
 	
+	def handleNewBatch( self, batch ):
+		self.frameHandler.handleNewBatch( batch )
+	
+	def getFrameHandlerStats( self ):
+		""" Get the statistics of the queue of the frame handler """
+		return self.frameHandler.getStats()
+	
 	def fakeProcessNoScanner( self ):
 		""" Simulates arriving CAN frames """
 		printT( "Entered %s.fakeProcessNoScanner()"%(type( self ).__name__,) )
@@ -667,6 +1771,10 @@ class CANCaptureELM327Thread( threading.Thread ):
 			# printT( "Creation duration per frame: %10.5f us"%(durationCreation*1000000./len( fakeIdentifiers ),) )
 			# printT( "Dispatch duration per frame: %10.5f us"%(durationDispatch*1000000./len( fakeIdentifiers ),) )
 	
+	def createSerial( self ):
+		""" Create the closed serial port (overridden to replay a recording) """
+		return serial.Serial( port=None, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, xonxoff=False, rtscts=False, write_timeout=None, dsrdtr=False, inter_byte_timeout=None )
+	
 	busSpecificationRegex = re.compile( r"^(.+) \(CAN (11|29)/([0-9]+)\)" )
 	
 	def run( self ):
@@ -676,15 +1784,17 @@ class CANCaptureELM327Thread( threading.Thread ):
 		self.lastPid = -1
 		if DEBUG_DISCONNECTED_SCANNER:
 			self.fakeProcessNoScanner()
-		self.ser = serial.Serial( port=None, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, xonxoff=False, rtscts=False, write_timeout=None, dsrdtr=False, inter_byte_timeout=None )
+		self.ser = self.createSerial()
 		self.ser.exclusive = True # silently fails if "exclusive" does not exist
 		isFirstAttempt = True
 		while True:
 			setConsoleColorWindows( "4F" )
 			setConsoleTitle( "ELM327 CAN "+self.serialPort+": Disconnected" )
+			self.closeSerialReader()
 			if self.ser.is_open:
 				self.ser.close()
 			if not isFirstAttempt:
+				self.collectGarbage( fullCollection=True )
 				sleep( 1 )
 			try:
 				# Startup
@@ -695,8 +1805,17 @@ class CANCaptureELM327Thread( threading.Thread ):
 					self.ser.port = self.serialPort
 					self.ser.open()
 					# Communication attempt
-					self.ser.baudrate = self.serialBaudRateInitial
-					self.ser.timeout = 0.5
+					linkState = None
+					if self.linkStateCache is not None:
+						linkState = self.linkStateCache.get( self.serialPort )
+					if linkState is not None and linkState.get( "baudRate" ) in (self.serialBaudRateInitial, self.serialBaudRateDesired):
+						# The scanner may still be at the last working baud rate.
+						self.linkStateWarm = True
+						self.ser.baudrate = linkState["baudRate"]
+					else:
+						self.ser.baudrate = self.serialBaudRateInitial
+					self.setReadTimeout( 0.5 )
+					self.openSerialReader()
 					connectionConfirmed = False
 					while not connectionConfirmed:
 						self.write( b"ATH\x0D" ) # command that does nothing
@@ -715,85 +1834,79 @@ class CANCaptureELM327Thread( threading.Thread ):
 						self.write( b"ATD\x0D" )
 					else:
 						self.write( b"ATWS\x0D" )
-					self.ser.timeout = 5
-					self.waitForPrompt( "No prompt after ATWS or ATD!" ) # resets the timeout to 0.5
+					self.setReadTimeout( 5 )
+					self.waitForPrompt( "No prompt after ATWS or ATD!", noSilentTest=self.serialPipelinedInit ) # resets the timeout to 0.5
 					# TODO - alternate rate instead of keeping serialBaudRateInitial
-					# Apply output parameters
-					self.write( b"ATE0\x0D" ) # no echo
-					self.waitForPrompt( "No prompt after ATE0!" )
-					self.write( b"ATL0\x0D" ) # no <LF> after <CR>
-					self.waitForPrompt( "No prompt after ATL0!" )
-					self.write( b"ATS0\x0D" ) # no spaces
-					self.waitForPrompt( "No prompt after ATS0!" )
-					self.write( b"ATR1\x0D" ) # wait for response after sending message
-					self.waitForPrompt( "No prompt after ATR1!" )
-					self.write( b"ATD1\x0D" ) # display DLC of CAN frames between identifier & data
-					self.waitForPrompt( "No prompt after ATD1!" )
-					self.write( b"ATCAF0\x0D" ) # raw CAN data formatting
-					self.waitForPrompt( "No prompt after ATCAF0!" )
-					self.write( b"ATH1\x0D" ) # send CAN headers (otherwise identifiers not shown!)
-					self.waitForPrompt( "No prompt after ATH1!" )
-					self.write( b"ATJHF0\x0D" ) # send J1939 SAE identifiers as ordinary CAN identifiers
-					self.waitForPrompt( "No prompt after ATJHF0!" )
-					self.write( b"ATJS\x0D" ) # disable byte-reordering for J1939 SAE
-					self.waitForPrompt( "No prompt after ATJS!" )
-					# Setup the CAN bus characteristics
-					self.write( b"ATCSM1\x0D" ) # CAN spy mode
-					self.waitForPrompt( "No prompt after ATCSM1!" )
-					self.write( b"ATPB"+self.scannerATPB+b"\x0D" ) # configuration of the USER1 CAN bus specification
-					self.waitForPrompt( "No prompt after ATPB!" )
-					self.write( b"ATSP"+self.scannerATSP+b"\x0D" ) # selection of the CAN bus specification
-					self.waitForPrompt( "No prompt after ATSP!" )
-					# Attempt to contact the ECU
-					printT( "Contacting the ECU..." )
-					self.ser.timeout = max( MAX_OBD_NEGOCIATION_TIME, self.inactivityTimeout ) # very conservative (1st request)
-					if not DEBUG_DISCONNECTED_CAN_BUS:
-						if self.testObdCompliant:
-							busConnectionConfirmed = False
-							while not busConnectionConfirmed:
-								self.write( b"0100\x0D" ) # test OBD request
-								busConfirmAnswer = self.readAnwer( "No prompt after 0100!" )
-								if "ERROR" in busConfirmAnswer: # BUS ERROR or CAN ERROR
-									continue
-								elif "UNABLE" in busConfirmAnswer: # UNABLE TO CONNECT
-									continue
-								else:
-									busConnectionConfirmed = True
-					# Get the found bus information
-					self.ser.timeout = 0.5
-					self.write( b"ATDP\x0D" ) # return active bus protocol
-					busSpecification = self.readAnwer( "No prompt after ATDP!" )
-					busSpecificationPieces = self.busSpecificationRegex.search( busSpecification )
-					if busSpecificationPieces:
-						self.canBusFamily = busSpecificationPieces.group( 1 )
-						self.canBusIsExtended = ( busSpecificationPieces.group( 2 )=="29" )
-						self.canBusRate = float( busSpecificationPieces.group( 3 ) )
-						if "USER1" in self.canBusFamily and self.User1Mul8by7:
-							self.canBusRate *= 8./7. # ATDP reports the rate unaffected by 8/7
-						printT( "Connected to CAN bus: %u-bit, %.2f kb/s (%s)"%(self.canBusIsExtended and 29 or 11, self.canBusRate, self.canBusFamily) )
+					# Apply output parameters & setup the CAN bus characteristics
+					self.sendInitCommands( INIT_COMMANDS+(
+						(b"ATPB"+self.scannerATPB, "configuration of the USER1 CAN bus specification"),
+						(b"ATSP"+self.scannerATSP, "selection of the CAN bus specification"),
+					) )
+					self.transmitHeader = None # default header after reset
+					busState = None
+					if linkState is not None and "canBusFamily" in linkState:
+						linkStateKey = self.getLinkStateKey()
+						if all( linkState.get( key )==value for key, value in linkStateKey.items() ):
+							busState = linkState # same parameters: same CAN bus
+					if busState is not None and not self.isFixedProtocol():
+						# Automatic protocol: the adapter may be on another bus, which ATDP must confirm
+						self.flushInput() # an interrupted ATMA may leave an extra prompt, which would be taken for the answer
+						if self.readCanBus()!=(busState["canBusFamily"], busState["canBusIsExtended"], busState["canBusRate"]):
+							printT( "The CAN bus does not match the link state cache: %s"%(self.lastBusSpecification,) )
+							busState = None
+					if busState is not None:
+						# Reuse the CAN bus found last time (no ECU contact, ATDP only with an automatic protocol)
+						self.canBusFamily = busState["canBusFamily"]
+						self.canBusIsExtended = busState["canBusIsExtended"]
+						self.canBusRate = busState["canBusRate"]
+						printT( "Connected to CAN bus (link state cache): %u-bit, %.2f kb/s (%s)"%(self.canBusIsExtended and 29 or 11, self.canBusRate, self.canBusFamily) )
 					else:
-						raise Exception( "The found OBD bus does not seem to be a CAN bus: %s"%(busSpecification,) )
+						self.findCanBus()
+					self.atmaDecoder = None # rebuilt for the found bus
+					if self.serialBaudRateCalibration and self.baudRateCalibration is None:
+						self.calibrateBaudRate()
 					# Apply the desired baudrate
 					if not self.applyDesiredBaudRate():
 						if self.serialBaudRateDesiredForce:
 							raise Exception( "The desired baud rate could not be selected!" )
 					printT( "Connection established at "+str( self.ser.baudrate )+" b/s" )
+					self.linkStateWarm = False
+					if self.linkStateCache is not None:
+						self.linkStateCache.update( self.serialPort,
+							baudRate=self.ser.baudrate,
+							canBusFamily=self.canBusFamily,
+							canBusIsExtended=self.canBusIsExtended,
+							canBusRate=self.canBusRate,
+							**self.getLinkStateKey()
+						)
 					setConsoleColorWindows( "2F" )
 					setConsoleTitle( "ELM327 "+self.serialPort+" CAN: "+str( self.ser.baudrate )+" b/s" )
 				# Read CAN frames until thread exit
+				self.updateParserProcess()
 				counter = 0 # counts the number of straight monitoring episodes
 				self.filter1RemoteChanged = True # unknown state: re-apply ELM327-side filter
 				while True:
 					try:
+						atmaSent = False
 						if self.filter1RemoteChanged:
 							with self.filter1RemoteLock:
-								self.write( b"ATCF "+bytes( "%.8X"%(self.filter1RemoteResult&self.maskOver,), "ascii" )+b"\x0D" )
-								self.waitForPrompt( "No prompt after ATCF!" )
-								self.write( b"ATCM "+bytes( "%.8X"%(self.filter1RemoteMask&self.maskOver,), "ascii" )+b"\x0D" )
-								self.waitForPrompt( "No prompt after ATCM!" )
+								commandATCF = b"ATCF "+bytes( "%.8X"%(self.filter1RemoteResult&self.maskOver,), "ascii" )+b"\x0D"
+								commandATCM = b"ATCM "+bytes( "%.8X"%(self.filter1RemoteMask&self.maskOver,), "ascii" )+b"\x0D"
+								if self.pipelinedRestart:
+									# Commands sent back to back, ATMA output starts after the 2nd prompt:
+									self.write( commandATCF+commandATCM+b"ATMA\x0D" )
+									self.waitForPrompt( "No prompt after ATCF & ATCM!", 64, noSilentTest=True, promptsCount=2 )
+									atmaSent = True
+								else:
+									self.write( commandATCF )
+									self.waitForPrompt( "No prompt after ATCF!" )
+									self.write( commandATCM )
+									self.waitForPrompt( "No prompt after ATCM!" )
 								self.filter1RemoteChanged = False
 						self.straightInvalidFramesCount = 0
-						self.write( b"ATMA\x0D" ) # start monitoring (may fail with "?" error, no particular handling needed)
+						if not atmaSent:
+							self.write( b"ATMA\x0D" ) # start monitoring (may fail with "?" error, no particular handling needed)
+						self.resumedMonitoring()
 						self.stopMonitoringAttempts = 0
 						stopMonitoringNextAttempt = None
 						while True:
@@ -804,6 +1917,12 @@ class CANCaptureELM327Thread( threading.Thread ):
 								else:
 									self.reloadParameters()
 								lastReloadAttempt = int( time() )
+								self.tuneAccumulationATMA()
+								self.collectGarbage()
+								if self.serialRecorder is not None:
+									self.serialRecorder.flush()
+								self.identifierRateMeter.update( perf_counter(), self.filter1RemoteMask&self.maskOver, self.filter1RemoteResult&self.maskOver )
+							self.rotateSurvey()
 							# Read the next frame
 							frame = self.readFrame()
 							stopMonitoringReason = None # if set, monitoring is stopped
@@ -811,6 +1930,8 @@ class CANCaptureELM327Thread( threading.Thread ):
 								stopMonitoringReason = "Changed identifier mask"
 							if frame is None: # nothing read
 								stopMonitoringReason = "Nothing received while monitoring"
+							elif frame is True: # dispatched to the parser process
+								pass
 							elif frame==False: # invalid frame
 								pass
 							else:
@@ -821,6 +1942,10 @@ class CANCaptureELM327Thread( threading.Thread ):
 								or stopMonitoringTime>=stopMonitoringNextAttempt:
 									self.stopMonitoring( stopMonitoringReason )
 									stopMonitoringNextAttempt = stopMonitoringTime+self.stopMonitoringWait
+							elif self.pollObdIfDue():
+								break # ATMA restarted with the ELM327-side filter
+							elif self.transmitIfQueued():
+								break # ATMA restarted
 					except BaseException as e:
 						if type( e ) in (MemoryError, InterruptedError, ConnectionAbortedError):
 							printT( e )
@@ -830,7 +1955,11 @@ class CANCaptureELM327Thread( threading.Thread ):
 					counter = counter+1
 			except serial.SerialException as e:
 				printT( e )
+				self.interruptedMonitoring( "Connection lost" )
+				self.forgetWarmLinkState()
 				isFirstAttempt = False
 			except:
 				printT( format_exc() )
+				self.interruptedMonitoring( "Connection reset" )
+				self.forgetWarmLinkState()
 				isFirstAttempt = False
@@ -1,60 +1,217 @@
 import threading
+from collections import deque
+from time import perf_counter
 from traceback import format_exc
 from utility import printT
 from CANCaptureHTTPServer import WebSocket_frames
+from CANFrameBatch import CANFrameBatch
 
 class CANCaptureFrameHandler( threading.Thread ):
 	"""
 	Thread that delegates the work of CAN frames handling for improved timings
 	Particular attention is needed for thread safety.
+	Pending frames wait in a queue bounded to queueSize frames, including the frames being handled, with a policy when the thread is late:
+	- "block": the capture waits for room in the queue (backpressure).
+	- "dropOldest": the oldest pending frames are dropped.
+	- "dropWebSocket": frames handled while over half of queueSize pending are not sent to WebSockets, but still logged;
+	  the capture waits when the queue is full.
+	The thread takes at most half of queueSize at once, so that pending frames are left to drop.
 	"""
 	
 	daemon = True
 	asyncException = None # exception caught in the process, re-raised on frame income
+	policies = ("block", "dropOldest", "dropWebSocket")
 	
 	def __init__( self, canSource ):
 		threading.Thread.__init__( self )
 		self.canSource = canSource
+		if canSource.busName is None:
+			self.webSocketClass = WebSocket_frames
+		else:
+			self.webSocketClass = WebSocket_frames.forBus( canSource.busName )
 		
-		self.pendingFrames = None
-		self.pendingFramesLock = threading.Lock()
-		
-		self.continueProcessLock = threading.Lock()
-		self.continueProcessLock.acquire()
+		self.queueSize = 65536 # frames
+		self.queuePolicy = "dropWebSocket"
+		self.pending = deque() # frames, lists of frames & batches
+		self.pendingCount = 0 # frames
+		self.inFlightCount = 0 # frames taken by this thread, not handled yet
+		self.pendingCondition = threading.Condition( threading.Lock() )
+		self.stats = {
+			"peakDepth": 0,
+			"droppedFrames": 0,
+			"webSocketSkippedFrames": 0,
+			"blocks": 0,
+			"blockedTime": 0.,
+			"handledFrames": 0,
+			"batches": 0,
+			"maxBatchSize": 0,
+		}
 	
-	def handleNewFrame( self, frame ):
+	def setParameters( self, parameters ):
+		queuePolicy = parameters.get( "frameHandlerQueuePolicy", "dropWebSocket" )
+		if queuePolicy not in self.policies:
+			printT( "Unknown frameHandlerQueuePolicy %s, using dropWebSocket"%(repr( queuePolicy ),) )
+			queuePolicy = "dropWebSocket"
+		with self.pendingCondition:
+			self.queueSize = max( 1, int( parameters.get( "frameHandlerQueueSize", 65536 ) ) )
+			self.queuePolicy = queuePolicy
+			self.pendingCondition.notify_all() # blocked producers check the new size
+	
+	## Queue
+	
+	def enqueue( self, item, count ):
+		""" Add frames to the queue according to the policy (capture side) """
 		if self.asyncException is not None:
 			asyncException = self.asyncException
 			self.asyncException = None
 			raise asyncException
-		else:
-			self.pendingFramesLock.acquire()
-			self.pendingFrames.append( frame )
-			self.pendingFramesLock.release()
+		pendingCondition = self.pendingCondition
+		with pendingCondition:
+			queueSize = self.queueSize
+			if self.pendingCount+self.inFlightCount+count>queueSize:
+				stats = self.stats
+				if self.queuePolicy=="dropOldest":
+					pending = self.pending
+					while pending and self.pendingCount+self.inFlightCount+count>queueSize:
+						droppedCount = self.countFrames( pending.popleft() )
+						self.pendingCount -= droppedCount
+						stats["droppedFrames"] += droppedCount
+				depth = self.pendingCount+self.inFlightCount
+				if depth+count>queueSize and depth:
+					# Wait for room (frames being handled cannot be dropped):
+					stats["blocks"] += 1
+					blockedAt = perf_counter()
+					while self.pendingCount+self.inFlightCount+count>self.queueSize and self.pendingCount+self.inFlightCount:
+						pendingCondition.wait()
+					stats["blockedTime"] += perf_counter()-blockedAt
+			self.pending.append( item )
+			self.pendingCount += count
+			depth = self.pendingCount+self.inFlightCount
+			if depth>self.stats["peakDepth"]:
+				self.stats["peakDepth"] = depth
+			pendingCondition.notify_all()
+	
+	@staticmethod
+	def countFrames( item ):
+		if type( item ) is list or isinstance( item, CANFrameBatch ):
+			return len( item )
+		return 1
+	
+	def handleNewFrame( self, frame ):
+		self.enqueue( frame, 1 )
+	
+	def handleNewFrames( self, frames ):
+		""" Same as handleNewFrame() for a list of frames, with a single hand-over """
+		if frames:
+			self.enqueue( frames, len( frames ) )
+	
+	def handleNewBatch( self, batch ):
+		""" Same as handleNewFrame() for a CANFrameBatch """
+		if len( batch ):
+			self.enqueue( batch, len( batch ) )
+	
+	def getStats( self ):
+		""" Get the state of the queue: live & peak depth (frames), dropped frames, size of the batches taken by this thread... """
+		with self.pendingCondition:
+			stats = dict( self.stats )
+			stats["depth"] = self.pendingCount+self.inFlightCount
+			stats["inFlight"] = self.inFlightCount
+			stats["size"] = self.queueSize
+			stats["policy"] = self.queuePolicy
+		stats["averageBatchSize"] = stats["batches"] and stats["handledFrames"]/stats["batches"] or 0.
+		return stats
+	
+	## END Queue
+	
+	def processFrames( self, frames, webSocket=True ):
+		canSource = self.canSource
+		webSocketClass = self.webSocketClass
+		if canSource.identifierRateMeter is not None:
+			canSource.identifierRateMeter.countFrames( frames )
+		survey = canSource.survey
+		if survey is not None:
+			survey.countFrames( frames )
+		for frame in frames:
 			try:
-				self.continueProcessLock.release()
-			except RuntimeError:
-				pass
+				if canSource.passesFilters( frame ) and ( canSource.loadSharingGroup is None or not canSource.loadSharingGroup.isDuplicate( canSource, frame ) ): # thread-safety required
+					if webSocket:
+						webSocketClass.broadcastFrame( frame )
+					if canSource.canExporter is not None:
+						canSource.canExporter.logFrame( frame, canSource.canExporterBusIndex or 0 )
+			except Exception as asyncException:
+				# This exception will be raised on next frame income, with an incorrect stack trace.
+				self.asyncException = asyncException
+				printT( format_exc() )
 	
-	def run( self ):
+	def processBatch( self, batch, webSocket=True ):
+		""" Same as processFrames() with array operations, the frames of the batch are only built if needed """
 		canSource = self.canSource
-		self.pendingFrames = []
+		if canSource.loadSharingGroup is not None:
+			self.processFrames( batch.toFrames(), webSocket ) # deduplication frame by frame
+			return
+		if canSource.identifierRateMeter is not None:
+			canSource.identifierRateMeter.countIdentifiers( batch.identifierCounts() )
+		survey = canSource.survey
+		if survey is not None:
+			survey.countFrames( batch.toFrames() )
+		try:
+			batch = batch.select( canSource.passesFiltersBatch( batch ) ) # thread-safety required
+			if len( batch ):
+				if webSocket:
+					self.webSocketClass.broadcastBatch( batch )
+				if canSource.canExporter is not None:
+					canSource.canExporter.logBatch( batch, canSource.canExporterBusIndex or 0 )
+		except Exception as asyncException:
+			# This exception will be raised on next frame income, with an incorrect stack trace.
+			self.asyncException = asyncException
+			printT( format_exc() )
+	
+	def run( self ):
+		pendingCondition = self.pendingCondition
+		stats = self.stats
 		while True:
-			self.continueProcessLock.acquire()
-			presentPendingFrames = True
-			while presentPendingFrames:
-				self.pendingFramesLock.acquire()
-				pendingFrames = self.pendingFrames
-				self.pendingFrames = [] # cleanup
-				self.pendingFramesLock.release()
-				presentPendingFrames = len( pendingFrames )!=0
-				for frame in pendingFrames:
-					try:
-						if canSource.passesFilters( frame ): # thread-safety required
-							WebSocket_frames.broadcastFrame( frame )
-							if canSource.canExporter is not None:
-								canSource.canExporter.logFrame( frame )
-					except Exception as asyncException:
-						# This exception will be raised on next frame income, with an incorrect stack trace.
-						self.asyncException = asyncException
-						printT( format_exc() )
+			with pendingCondition:
+				while not self.pending:
+					pendingCondition.wait()
+				depth = self.pendingCount
+				maxTakenCount = max( 1, self.queueSize//2 )
+				if depth<=maxTakenCount:
+					pending = self.pending
+					takenCount = depth
+					self.pending = deque() # cleanup
+				else:
+					# Take the oldest items up to maxTakenCount frames (at least 1 item):
+					pending = []
+					takenCount = 0
+					countFrames = self.countFrames
+					while self.pending:
+						count = countFrames( self.pending[0] )
+						if pending and takenCount+count>maxTakenCount:
+							break
+						pending.append( self.pending.popleft() )
+						takenCount += count
+				self.pendingCount -= takenCount
+				self.inFlightCount = takenCount # still counted in the depth until handled
+				webSocket = self.queuePolicy!="dropWebSocket" or depth<=self.queueSize//2
+				stats["handledFrames"] += takenCount
+				stats["batches"] += 1
+				if takenCount>stats["maxBatchSize"]:
+					stats["maxBatchSize"] = takenCount
+				if not webSocket:
+					stats["webSocketSkippedFrames"] += takenCount
+			frames = []
+			for item in pending:
+				if type( item ) is list:
+					frames.extend( item )
+				elif isinstance( item, CANFrameBatch ):
+					if frames:
+						self.processFrames( frames, webSocket )
+						frames = []
+					self.processBatch( item, webSocket )
+				else:
+					frames.append( item )
+			if frames:
+				self.processFrames( frames, webSocket )
+			with pendingCondition:
+				self.inFlightCount = 0
+				pendingCondition.notify_all() # room for blocked producers
@@ -2,9 +2,9 @@ import http.server
 import threading
 
 from io import BytesIO
-from utility import simpleDictionaryToJSON
 from utility import printT
-from utility import bytes_hex
+from FrameEncoding import frameEncoder
+from FrameEncoding import jsonFields
 from time import time
 from socketserver import ThreadingMixIn
 from websocket import WebSocketBadRequest, WebSocket
@@ -12,6 +12,8 @@ from json import dumps as json_dumps
 from json import loads as json_loads
 from urllib.parse import parse_qs
 from traceback import format_exc
+from FilterSnapshot import IdentifierSet
+from FilterPlanner import FilterSurvey
 
 try:
 	from http import HTTPStatus
@@ -23,22 +25,46 @@ class WebSocket_frames(WebSocket):
 	maxReceivedLen = 125 # only short frames
 	allowFramesBinary = False
 	allowFramesText = False
+	busName = None # name of the bus of the frames (multi-bus mode)
+	busClasses = {} # busName: WebSocket_frames class of the bus
+	busClassesLock = threading.Lock()
+	busFields = b"" # JSON members added to the frames: the bus in multi-bus mode
 	
 	def handleMessage( self, data ):
 		""" Incoming message handler: nothing allowed """
 		pass
 	
+	@classmethod
+	def forBus( self, busName ):
+		""" Get the class of the WebSocket connections receiving the frames of the given bus (multi-bus mode) """
+		with WebSocket_frames.busClassesLock:
+			busClass = WebSocket_frames.busClasses.get( busName )
+			if busClass is None:
+				busClass = type( "WebSocket_frames_"+busName, (WebSocket_frames,), {"busName": busName, "busFields": jsonFields( {b"b": busName} )} )
+				WebSocket_frames.busClasses[busName] = busClass
+		return busClass
+	
 	@classmethod
 	def broadcastFrame( self, frame ):
-		""" Broadcast a new frame (as JSON) - possible bottleneck """
-		self.broadcastMessageText( simpleDictionaryToJSON( {
-			b"t": frame.time,
-			b"i": frame.identifier,
-			b"e": frame.isExtended,
-			b"r": frame.isRTR,
-			b"l": frame.DLC,
-			b"d": bytes_hex( frame.data ),
-		} ) )
+		""" Broadcast a new frame (as JSON) - possible bottleneck
+		The message is only built if a WebSocket receives it, from the JSON members of its payload cached by frameEncoder.
+		In multi-bus mode, the frame is tagged with its bus and also sent to the merged view of all buses. """
+		instances = self.getActiveInstances()
+		if self.busName is not None:
+			instances += WebSocket_framesMerged.getActiveInstances()
+		if instances:
+			self.broadcastMessageRaw( self.buildMessageText( frameEncoder.json( frame, self.busFields ) ), instances )
+	
+	@classmethod
+	def broadcastBatch( self, batch ):
+		""" Same as broadcastFrame() for the frames of a CANFrameBatch, only built if a WebSocket receives them """
+		if self.hasActiveInstances() or ( self.busName is not None and WebSocket_framesMerged.hasActiveInstances() ):
+			for frame in batch.toFrames():
+				self.broadcastFrame( frame )
+
+class WebSocket_framesMerged(WebSocket_frames):
+	""" WebSocket connections receiving the frames of all buses (multi-bus mode) """
+	pass
 
 
 class Status( Exception ):
@@ -153,6 +179,55 @@ class CANCaptureHTTPRequestHandler( http.server.BaseHTTPRequestHandler ):
 			for identifier in identifiers_temp:
 				identifiers.add( cls.postFieldToIdentifier( identifier ) )
 		return identifiers
+	@classmethod
+	def postFieldToIdentifierPairs( cls, postData, fieldName, separator ):
+		""" Get a list of pairs of identifiers, like "first-last" in hexadecimal or [first, last], empty if the field is missing or empty """
+		pairs = postData.get( fieldName, "" )
+		if not isinstance( pairs, list ):
+			pairs = len( pairs ) and [pairs] or []
+		identifierPairs = []
+		for pair in pairs:
+			if isinstance( pair, str ):
+				pair = pair.split( separator )
+			if not isinstance( pair, list ) or len( pair )!=2:
+				raise StatusBadRequest()
+			identifierPair = (cls.postFieldToIdentifier( pair[0] ), cls.postFieldToIdentifier( pair[1] ))
+			if None in identifierPair:
+				raise StatusBadRequest()
+			identifierPairs.append( identifierPair )
+		return identifierPairs
+	@classmethod
+	def postFieldsToIdentifierSet( cls, postData, fieldName ):
+		"""
+		Get the IdentifierSet given by the fields <fieldName> (identifiers), <fieldName>Ranges ("first-last") & <fieldName>Masks ("mask/maskingResult")
+		Return None if these fields are empty
+		Throws a KeyError if these fields are missing
+		"""
+		if fieldName not in postData and fieldName+"Ranges" not in postData and fieldName+"Masks" not in postData:
+			raise KeyError( fieldName )
+		identifiers = None
+		if fieldName in postData:
+			identifiers = cls.postFieldToIdentifiersSet( postData, fieldName )
+		try:
+			return IdentifierSet.build(
+				identifiers,
+				cls.postFieldToIdentifierPairs( postData, fieldName+"Ranges", "-" ),
+				cls.postFieldToIdentifierPairs( postData, fieldName+"Masks", "/" ),
+			)
+		except ValueError: # reversed range
+			raise StatusBadRequest()
+	@classmethod
+	def identifierSetToData( cls, data, fieldName, identifierSet ):
+		""" Fill the fields <fieldName>, <fieldName>Ranges & <fieldName>Masks of the JSON data with an IdentifierSet / None """
+		if identifierSet is None:
+			data[fieldName] = None
+			data[fieldName+"Ranges"] = None
+			data[fieldName+"Masks"] = None
+		else:
+			identifierSetState = identifierSet.getState()
+			data[fieldName] = identifierSetState["identifiers"]
+			data[fieldName+"Ranges"] = identifierSetState["ranges"]
+			data[fieldName+"Masks"] = identifierSetState["masks"]
 	
 	def send_head( self, headersOnly=False ):
 		headers = {}
@@ -161,8 +236,23 @@ class CANCaptureHTTPRequestHandler( http.server.BaseHTTPRequestHandler ):
 		currentThread.name = "%s %s"%(self.command, self.path)
 		path = self.path.split( "?", 1 )[0]
 		
+		# Multi-bus mode: the pages & the API of each bus are under /bus/<name>/, the default bus is the first one.
+		canBus = self.server.thread.canBus
+		canBuses = self.server.thread.canBuses
+		webSocketClass = WebSocket_frames
+		if canBuses is not None:
+			webSocketClass = WebSocket_framesMerged
+			if path[:5]=="/bus/":
+				busName, _, path = path[5:].partition( "/" )
+				canBus = canBuses.get( busName )
+				if canBus is None:
+					path = None # not found
+				else:
+					path = "/"+path
+					webSocketClass = WebSocket_frames.forBus( busName )
+		
 		if path=="/frames.ws":
-			self.webSocketClass = WebSocket_frames
+			self.webSocketClass = webSocketClass
 			info = WebSocket.prepareHeaders( self )
 			encoded = info["encoded"]
 			response = info["response"]
@@ -199,12 +289,11 @@ class CANCaptureHTTPRequestHandler( http.server.BaseHTTPRequestHandler ):
 			encoded = b"\r\n".join( contentLines )
 			response = HTTPStatus.OK
 			contentType = "text/plain"
-		elif path[:5]=="/api/":
+		elif path is not None and path[:5]=="/api/":
 			contentType = "application/json"
 			response = HTTPStatus.OK
 			errorString = None
 			data = {}
-			canBus = self.server.thread.canBus
 			try:
 				postData = None
 				if self.command=="POST":
@@ -262,7 +351,7 @@ class CANCaptureHTTPRequestHandler( http.server.BaseHTTPRequestHandler ):
 					if postData is None:
 						raise StatusMethodNotAllowed()
 					try:
-						whitelist = self.postFieldToIdentifiersSet( postData, "whitelist" )
+						whitelist = self.postFieldsToIdentifierSet( postData, "whitelist" )
 					except KeyError:
 						raise StatusBadRequest()
 					if whitelist is None:
@@ -276,10 +365,75 @@ class CANCaptureHTTPRequestHandler( http.server.BaseHTTPRequestHandler ):
 					data["mask"] = maskInfo[0]
 					data["maskingResult"] = maskInfo[1]
 					del maskInfo
-					whitelist = canBus.getFilter1Local()
-					whitelist = ( whitelist is not None ) and list( whitelist ) or None
-					data["whitelist"] = whitelist
-					del whitelist
+					self.identifierSetToData( data, "whitelist", canBus.getFilter1Local() )
+					data["version"] = canBus.filterSnapshot.version
+				elif path=="/api/filter1/plan":
+					# GET: plan only, POST: plan and install
+					try:
+						data.update( canBus.planFilter1( apply=( postData is not None ) ) )
+					except ValueError: # no wanted identifier
+						raise StatusBadRequest()
+				elif path=="/api/survey/start":
+					if postData is None:
+						raise StatusMethodNotAllowed()
+					try:
+						partitionBits = int( postData["partitionBits"] ) if "partitionBits" in postData else None
+						dwell = float( postData["dwell"] ) if "dwell" in postData else None
+						rounds = int( postData["rounds"] ) if "rounds" in postData else None
+					except TypeError:
+						raise StatusBadRequest()
+					except ValueError:
+						raise StatusBadRequest()
+					if ( partitionBits is not None and ( partitionBits<0 or partitionBits>FilterSurvey.maxPartitionBits ) ) or ( dwell is not None and dwell<=0. ) or ( rounds is not None and rounds<1 ):
+						raise StatusBadRequest()
+					try:
+						canBus.startSurvey( partitionBits, dwell, rounds )
+					except ValueError: # CAN bus not found yet, or bad canBusSurveyPartitionBits
+						raise StatusBadRequest()
+				elif path=="/api/survey/stop":
+					if postData is None:
+						raise StatusMethodNotAllowed()
+					canBus.stopSurvey()
+				elif path=="/api/survey/get":
+					survey = canBus.getSurvey()
+					data["surveyed"] = survey is not None
+					if survey is not None:
+						data.update( survey )
+					del survey
+				elif path=="/api/getObdPolling":
+					obdPolling = canBus.getObdPolling()
+					data["polling"] = obdPolling is not None
+					if obdPolling is not None:
+						data.update( obdPolling )
+					del obdPolling
+				elif path=="/api/transmit":
+					if postData is None:
+						raise StatusMethodNotAllowed()
+					try:
+						if "frames" in postData:
+							postFrames = postData["frames"] # JSON: list of {"identifier", "data", "extended"}
+						else:
+							postFrames = [postData]
+						transmitFrames = []
+						for postFrame in postFrames:
+							extended = postFrame.get( "extended", None )
+							if isinstance( extended, str ):
+								extended = ( extended in ("1", "true") )
+							transmitFrames.append( (
+								self.postFieldToIdentifier( postFrame["identifier"] ),
+								bytes.fromhex( postFrame["data"] ),
+								extended,
+							) )
+						data["queued"] = canBus.queueTransmit( transmitFrames )
+					except (KeyError, TypeError, AttributeError, ValueError):
+						raise StatusBadRequest()
+					del transmitFrames
+				elif path=="/api/getTransmitStats":
+					data.update( canBus.getTransmitStats() )
+				elif path=="/api/getIdentifierRates":
+					identifierRates = canBus.getIdentifierRates()
+					data["rates"] = [{"identifier": identifier, "rate": identifierRates[identifier]} for identifier in sorted( identifierRates.keys() )]
+					del identifierRates
 				elif path=="/api/filter1/reset":
 					if postData is None:
 						raise StatusMethodNotAllowed()
@@ -288,15 +442,13 @@ class CANCaptureHTTPRequestHandler( http.server.BaseHTTPRequestHandler ):
 					if postData is None:
 						raise StatusMethodNotAllowed()
 					try:
-						blacklist = self.postFieldToIdentifiersSet( postData, "blacklist" )
+						blacklist = self.postFieldsToIdentifierSet( postData, "blacklist" )
 					except KeyError:
 						raise StatusBadRequest()
 					canBus.setFilter2( blacklist )
 				elif path=="/api/filter2/getExcluded":
-					blacklist = canBus.getFilter2()
-					blacklist = ( blacklist is not None ) and list( blacklist ) or None
-					data["blacklist"] = blacklist
-					del blacklist
+					self.identifierSetToData( data, "blacklist", canBus.getFilter2() )
+					data["version"] = canBus.filterSnapshot.version
 				elif path=="/api/filter2/reset":
 					if postData is None:
 						raise StatusMethodNotAllowed()
@@ -315,11 +467,52 @@ class CANCaptureHTTPRequestHandler( http.server.BaseHTTPRequestHandler ):
 					canBus.inactivityTimeout = inactivityTimeout
 				elif path=="/api/getInactivityTimeout":
 					data["timeout"] = canBus.inactivityTimeout
+				elif path=="/api/getSLCANStats":
+					if not hasattr( canBus, "getSLCANStats" ):
+						raise StatusNotFound()
+					data.update( canBus.getSLCANStats() )
+				elif path=="/api/getSerialReaderStats":
+					serialReaderStats = canBus.getSerialReaderStats()
+					data["enabled"] = serialReaderStats is not None
+					if serialReaderStats is not None:
+						data.update( serialReaderStats )
+					del serialReaderStats
+				elif path=="/api/getParserProcessStats":
+					parserProcessStats = canBus.getParserProcessStats()
+					data["enabled"] = parserProcessStats is not None
+					if parserProcessStats is not None:
+						data.update( parserProcessStats )
+					del parserProcessStats
+				elif path=="/api/getFrameHandlerStats":
+					data.update( canBus.getFrameHandlerStats() )
+				elif path=="/api/getAccumulationTuning":
+					data.update( canBus.getAccumulationTuning() )
+				elif path=="/api/getMonitoringDowntime":
+					data.update( canBus.getMonitoringDowntime() )
+				elif path=="/api/getLoadSharing":
+					loadSharingGroup = canBus.loadSharingGroup
+					data["enabled"] = loadSharingGroup is not None
+					if loadSharingGroup is not None:
+						data.update( loadSharingGroup.getState() )
+					del loadSharingGroup
+				elif path=="/api/getBuses":
+					data["buses"] = canBuses is not None and list( canBuses.keys() ) or []
+					data["bus"] = canBus.busName
+				elif path=="/api/getBaudRateCalibration":
+					baudRateCalibration = canBus.getBaudRateCalibration()
+					data["calibrated"] = baudRateCalibration is not None and baudRateCalibration["baudRate"] is not None
+					if baudRateCalibration is not None:
+						data.update( baudRateCalibration )
+					del baudRateCalibration
 				else:
 					raise StatusNotFound()
 			except Status as e:
 				response = e.status
 				errorString = e.text
+			except NotImplementedError as e:
+				# Feature not available with this kind of adapter:
+				response = HTTPStatus.NOT_IMPLEMENTED
+				errorString = str( e )
 			except Exception as e:
 				printT( format_exc() )
 				response = HTTPStatus.INTERNAL_SERVER_ERROR
@@ -397,7 +590,11 @@ class ThreadedHTTPServer(ThreadingMixIn, http.server.HTTPServer):
 class CANCaptureHTTPServerThread( threading.Thread ):
 	daemon = True # exit immediatly on program exit
 	
-	def __init__( self, vehicleData, canBus, ipAddress="127.0.0.1", tcpPort=8327 ):
+	def __init__( self, vehicleData, canBus, ipAddress="127.0.0.1", tcpPort=8327, canBuses=None ):
+		"""
+		- canBus: bus served at the root
+		- canBuses: buses by name served under /bus/<name>/ (multi-bus mode), None otherwise
+		"""
 		threading.Thread.__init__( self )
 		if ":" in ipAddress:
 			# IPv6
@@ -406,6 +603,7 @@ class CANCaptureHTTPServerThread( threading.Thread ):
 			# IPv4
 			self.name = "%s:%u"%(ipAddress, tcpPort)
 		self.canBus = canBus
+		self.canBuses = canBuses
 		self.ipAddress = ipAddress
 		self.tcpPort = tcpPort
 	
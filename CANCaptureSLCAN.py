@@ -0,0 +1,409 @@
+import threading
+import serial
+
+from time import sleep
+from time import time
+from time import perf_counter
+from traceback import format_exc
+from threading import Lock
+from binascii import unhexlify
+from binascii import hexlify
+from CANCaptureFrameHandler import CANCaptureFrameHandler
+from CANCaptureELM327 import CANCaptureELM327Thread
+from CANCaptureELM327 import CANFrame
+from FilterPlanner import IdentifierRateMeter
+from CANTransmitQueue import CANTransmitQueue
+
+from utility import execfileIfNeeded
+from utility import printT
+from utility import setConsoleColorWindows
+from utility import setConsoleTitle
+from utility import timeNs
+
+from configselector import parametersFile as defaultParametersFile
+from configselector import sequenceFile as defaultSequenceFile
+
+SLCAN_BITRATES = { # CAN bit rate in kb/s: command
+	10: b"S0",
+	20: b"S1",
+	50: b"S2",
+	100: b"S3",
+	125: b"S4",
+	250: b"S5",
+	500: b"S6",
+	800: b"S7",
+	1000: b"S8",
+}
+
+class SLCANClock():
+	"""
+	Conversion of SLCAN timestamps (milliseconds, wrapping at 60000) to nanoseconds since the epoch
+	The clock is anchored on the arrival time of frames: a frame cannot arrive before it happened, so the anchor moves back
+	whenever a timestamp would be later than its arrival, and it is reset when timestamps fall behind by more than maxDriftNs
+	(drift of the adapter clock, or gap longer than the wrapping period).
+	"""
+	
+	wrap = 60000
+	
+	def __init__( self, maxDriftNs=50000000 ):
+		self.maxDriftNs = maxDriftNs
+		self.anchorNs = None # time of the elapsed milliseconds 0
+		self.lastTimestamp = None
+		self.elapsedMs = 0 # milliseconds elapsed since the first timestamp
+		self.resets = 0
+	
+	def toTimeNs( self, timestamp, arrivalNs ):
+		if self.anchorNs is None:
+			self.anchorNs = arrivalNs
+		else:
+			self.elapsedMs += ( timestamp-self.lastTimestamp )%self.wrap
+		self.lastTimestamp = timestamp
+		frameTimeNs = self.anchorNs+self.elapsedMs*1000000
+		if frameTimeNs>arrivalNs:
+			# Anchored too late:
+			self.anchorNs -= frameTimeNs-arrivalNs
+			frameTimeNs = arrivalNs
+		elif arrivalNs-frameTimeNs>self.maxDriftNs:
+			self.anchorNs += arrivalNs-frameTimeNs
+			frameTimeNs = arrivalNs
+			self.resets += 1
+		return frameTimeNs
+
+class SLCANParser():
+	"""
+	Parser of the records sent by an SLCAN adapter: t (11-bit), T (29-bit), r & R (remote frames), with or without timestamps (Z1)
+	Records are parsed from whole chunks received from the serial port, the incomplete last record is kept for the next chunk.
+	Frames without timestamp get the arrival time of their chunk.
+	"""
+	
+	def __init__( self, clock=None ):
+		self.clock = clock or SLCANClock()
+		self.pending = b""
+		self.stats = {
+			"frames": 0,
+			"invalid": 0, # invalid records
+			"errors": 0, # BEL: command rejected by the adapter
+			"transmitted": 0, # z & Z: transmission acknowledged by the adapter
+		}
+	
+	def feed( self, chunk, arrivalNs ):
+		""" Parse received bytes, return the list of CANFrame """
+		records = ( self.pending+chunk ).split( b"\x0D" )
+		self.pending = records.pop()
+		frames = []
+		stats = self.stats
+		clock = self.clock
+		for record in records:
+			if not record:
+				continue # reply of a command
+			if record[0]==0x07:
+				stripped = record.lstrip( b"\x07" )
+				stats["errors"] += len( record )-len( stripped )
+				record = stripped
+				if not record:
+					continue
+			kind = record[0]
+			if kind==0x74 or kind==0x72: # t & r
+				headerLength = 4
+				isExtended = False
+			elif kind==0x54 or kind==0x52: # T & R
+				headerLength = 9
+				isExtended = True
+			elif kind==0x7A or kind==0x5A: # z & Z
+				stats["transmitted"] += 1
+				continue
+			else:
+				stats["invalid"] += 1
+				continue
+			try:
+				DLC = record[headerLength]-0x30
+				if DLC<0 or DLC>8:
+					raise ValueError()
+				isRTR = ( kind==0x72 or kind==0x52 )
+				dataEnd = headerLength+1
+				if not isRTR:
+					dataEnd += 2*DLC
+				recordLength = len( record )
+				if recordLength==dataEnd:
+					frameTimeNs = arrivalNs
+				elif recordLength==dataEnd+4:
+					frameTimeNs = clock.toTimeNs( int( record[dataEnd:], 16 ), arrivalNs )
+				else:
+					raise ValueError()
+				frames.append( CANFrame(
+					int( record[1:headerLength], 16 ),
+					isExtended,
+					isRTR,
+					DLC,
+					( not isRTR ) and unhexlify( record[headerLength+1:dataEnd] ) or b"",
+					frameTimeNs,
+				) )
+			except (ValueError, IndexError):
+				stats["invalid"] += 1
+		stats["frames"] += len( frames )
+		return frames
+
+class CANCaptureSLCANThread( threading.Thread ):
+	"""
+	Capture of CAN frames from an SLCAN (Lawicel) adapter, as an alternative to CANCaptureELM327Thread
+	Frames go to the same CANCaptureFrameHandler, so the HTTP API, the WebSockets & the exporters work the same way.
+	SLCAN adapters stream frames without the limits of ELM327 chips (no BUFFER FULL, no interruption for transmitting),
+	but their acceptance filters differ between adapters: the filters are applied computer-side only.
+	"""
+	daemon = True # exit immediatly on program exit
+	
+	def __init__( self, vehicleData, parametersFile=None, sequenceFile=None, busName=None ):
+		"""
+		- parametersFile, sequenceFile: files of this bus, the ones selected on the command line by default
+		- busName: name of this bus in multi-bus mode, None otherwise
+		"""
+		threading.Thread.__init__( self )
+		self.parametersFile = parametersFile or defaultParametersFile
+		self.sequenceFile = sequenceFile or defaultSequenceFile
+		self.busName = busName
+		if busName is not None:
+			self.name = "CAN bus "+busName
+		self.parametersFileInfo = {}
+		self.sequenceFileInfo = {}
+		self.ser = None
+		self.parser = None
+		self.adapterVersion = None
+		self.receivedBytesCount = 0
+		self.filter1RemoteLock = Lock()
+		self.identifierRateMeter = IdentifierRateMeter() # frames per second of each identifier, fed by frameHandler
+		self.transmitQueue = CANTransmitQueue()
+		self.frameHandler = CANCaptureFrameHandler( self )
+		try:
+			self.frameHandler.start()
+		except RuntimeError:
+			pass
+	
+	canExporter = None
+	canExporterBusIndex = None
+	loadSharingGroup = None
+	attachCanExporter = CANCaptureELM327Thread.attachCanExporter
+	getFrameHandlerStats = CANCaptureELM327Thread.getFrameHandlerStats
+	
+	def reloadParameters( self ):
+		parameters = {}
+		if execfileIfNeeded( self.parametersFile, parameters, self.parametersFileInfo ):
+			self.serialPort = parameters["serialPort"]
+			self.serialBaudRate = parameters.get( "serialBaudRate", 115200 ) # ignored by USB adapters
+			self.serialShowSentBytes = parameters.get( "serialShowSentBytes", False )
+			self.slcanBitRate = parameters.get( "slcanBitRate", 500 )
+			self.slcanListenOnly = parameters.get( "slcanListenOnly", True )
+			self.slcanTimestamps = parameters.get( "slcanTimestamps", True )
+			self.canBusIsExtended = parameters.get( "slcanExtendedByDefault", False )
+			self.inactivityTimeout = parameters.get( "canBusInactivityTimeout", 20. )
+			if self.inactivityTimeout is None:
+				self.inactivityTimeout = 20.
+			if self.canExporter is not None and self.canExporterBusIndex is None:
+				self.canExporter.setParameters( parameters )
+			self.frameHandler.setParameters( parameters )
+			printT( "[CANCaptureSLCAN.py] Parameters have been reloaded." )
+	
+	reloadSequence = CANCaptureELM327Thread.reloadSequence
+	
+	## Filters
+	# Same API as CANCaptureELM327Thread, the ELM327-side filter being applied computer-side.
+	
+	maskOver = 0x1FFFFFFF
+	filter1RemoteChanged = False
+	filter1RemoteMask = 0x00000000
+	filter1RemoteResult = 0x00000000
+	filter1Whitelist = None
+	filter2Blacklist = None
+	survey = None
+	setFilter1Remote = CANCaptureELM327Thread.setFilter1Remote
+	getFilter1Remote = CANCaptureELM327Thread.getFilter1Remote
+	setFilter1Local = CANCaptureELM327Thread.setFilter1Local
+	getFilter1Local = CANCaptureELM327Thread.getFilter1Local
+	setFilter1 = CANCaptureELM327Thread.setFilter1
+	setFilter2 = CANCaptureELM327Thread.setFilter2
+	getFilter2 = CANCaptureELM327Thread.getFilter2
+	filterSnapshot = CANCaptureELM327Thread.filterSnapshot
+	updateFilterSnapshot = CANCaptureELM327Thread.updateFilterSnapshot
+	passesFilters = CANCaptureELM327Thread.passesFilters
+	planFilter1 = CANCaptureELM327Thread.planFilter1
+	getIdentifierRates = CANCaptureELM327Thread.getIdentifierRates
+	
+	def updateParserProcessFilters( self ):
+		pass # no parser process
+	
+	## END Filters
+	
+	## CAN transmission
+	
+	allowMixedIdentifiers = True
+	queueTransmit = CANCaptureELM327Thread.queueTransmit
+	
+	def transmitIfQueued( self ):
+		""" Send the queued CAN frames, they are dropped in listen-only mode """
+		transmitQueue = self.transmitQueue
+		if not len( transmitQueue ):
+			return False
+		startedAt = perf_counter()
+		records = []
+		while True:
+			entry = transmitQueue.pop()
+			if entry is None:
+				break
+			identifier, isExtended, data = entry
+			if self.slcanListenOnly:
+				transmitQueue.countSent( False, False )
+				continue
+			if isExtended:
+				record = "T%.8X%u"%(identifier, len( data ))
+			else:
+				record = "t%.3X%u"%(identifier, len( data ))
+			records.append( record.encode( "ascii" )+hexlify( data ).upper()+b"\x0D" )
+			transmitQueue.countSent( True, False )
+		if records:
+			self.write( b"".join( records ) )
+		transmitQueue.countWindow( perf_counter()-startedAt )
+		return True
+	
+	def getTransmitStats( self ):
+		""" Get the counters of transmitted frames """
+		stats = self.transmitQueue.getStats()
+		parser = self.parser
+		stats["acknowledged"] = ( parser is not None ) and parser.stats["transmitted"] or 0
+		return stats
+	
+	## END CAN transmission
+	
+	## Features of ELM327 scanners
+	
+	def notAvailable( self, *arguments, **keywords ):
+		raise NotImplementedError( "Not available with SLCAN adapters" )
+	setObdPids = notAvailable
+	setPidResponseCallback = notAvailable
+	getObdPolling = notAvailable
+	startSurvey = notAvailable
+	stopSurvey = notAvailable
+	getSurvey = notAvailable
+	getSerialReaderStats = notAvailable
+	getParserProcessStats = notAvailable
+	getAccumulationTuning = notAvailable
+	getMonitoringDowntime = notAvailable
+	getBaudRateCalibration = notAvailable
+	
+	## END Features of ELM327 scanners
+	
+	def write( self, data ):
+		if self.serialShowSentBytes:
+			printT( "    PC :", data.decode( "ascii", "replace" ) )
+		self.ser.write( data )
+	
+	def command( self, command, timeout=1. ):
+		"""
+		Send a command while the CAN channel is closed, return its reply without the final <CR>
+		Throws a ValueError if the adapter rejected it (BEL)
+		Throws a TimeoutError if there is no reply
+		"""
+		self.write( command+b"\x0D" )
+		reply = bytearray()
+		deadline = perf_counter()+timeout
+		while perf_counter()<deadline:
+			byte = self.ser.read( 1 )
+			if byte==b"\x0D":
+				return bytes( reply )
+			elif byte==b"\x07":
+				raise ValueError( "The SLCAN adapter rejected the command "+command.decode( "ascii" ) )
+			reply.extend( byte )
+		raise TimeoutError( "No reply from the SLCAN adapter to the command "+command.decode( "ascii" ) )
+	
+	def openChannel( self ):
+		""" Configure the adapter and open the CAN channel """
+		# Close the channel if it was left open, then drop its frames:
+		self.write( b"\x0D\x0D\x0DC\x0D" )
+		sleep( 0.1 )
+		self.ser.reset_input_buffer()
+		self.adapterVersion = self.command( b"V" ).decode( "ascii", "replace" )
+		printT( "SLCAN adapter version: "+self.adapterVersion )
+		commandBitRate = SLCAN_BITRATES.get( self.slcanBitRate )
+		if commandBitRate is None:
+			raise ValueError( "Unsupported slcanBitRate: %s"%(self.slcanBitRate,) )
+		self.command( commandBitRate )
+		try:
+			self.command( self.slcanTimestamps and b"Z1" or b"Z0" )
+		except ValueError:
+			if self.slcanTimestamps:
+				printT( "The SLCAN adapter does not support timestamps." )
+		self.command( self.slcanListenOnly and b"L" or b"O" )
+	
+	def receive( self ):
+		""" Read CAN frames until a communication error """
+		parser = SLCANParser()
+		self.parser = parser
+		ser = self.ser
+		frameHandler = self.frameHandler
+		lastReceivedAt = perf_counter()
+		lastReloadAttempt = int( time() )
+		counter = 0
+		while True:
+			chunk = ser.read( max( 1, ser.in_waiting ) )
+			if chunk:
+				self.receivedBytesCount += len( chunk )
+				frames = parser.feed( chunk, timeNs() )
+				if frames:
+					frameHandler.handleNewFrames( frames )
+				lastReceivedAt = perf_counter()
+			elif perf_counter()-lastReceivedAt>self.inactivityTimeout:
+				raise TimeoutError( "Nothing received from the SLCAN adapter" )
+			# Live-refresh of configuration:
+			if int( time() )!=lastReloadAttempt:
+				if counter%2==0:
+					self.reloadSequence()
+				else:
+					self.reloadParameters()
+				counter += 1
+				lastReloadAttempt = int( time() )
+				self.identifierRateMeter.update( perf_counter(), self.filter1RemoteMask&self.maskOver, self.filter1RemoteResult&self.maskOver )
+			self.transmitIfQueued()
+	
+	def getSLCANStats( self ):
+		""" Get the counters of the SLCAN link """
+		parser = self.parser
+		stats = {
+			"version": self.adapterVersion,
+			"receivedBytes": self.receivedBytesCount,
+		}
+		if parser is not None:
+			stats.update( parser.stats )
+			stats["clockResets"] = parser.clock.resets
+		return stats
+	
+	def handleNewFrame( self, frame ):
+		self.frameHandler.handleNewFrame( frame )
+	
+	def run( self ):
+		self.reloadParameters()
+		self.reloadSequence()
+		self.ser = serial.Serial( port=None, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, xonxoff=False, rtscts=False, write_timeout=None, dsrdtr=False, inter_byte_timeout=None )
+		self.ser.exclusive = True # silently fails if "exclusive" does not exist
+		isFirstAttempt = True
+		while True:
+			setConsoleColorWindows( "4F" )
+			setConsoleTitle( "SLCAN "+self.serialPort+": Disconnected" )
+			if self.ser.is_open:
+				self.ser.close()
+			if not isFirstAttempt:
+				sleep( 1 )
+			isFirstAttempt = False
+			try:
+				self.reloadParameters()
+				printT( "New connection to "+self.serialPort+"..." )
+				self.ser.port = self.serialPort
+				self.ser.baudrate = self.serialBaudRate
+				self.ser.timeout = 0.1
+				self.ser.open()
+				self.openChannel()
+				printT( "Connected to CAN bus: %u kb/s (SLCAN%s)"%(self.slcanBitRate, self.slcanListenOnly and ", listen-only" or "") )
+				setConsoleColorWindows( "2F" )
+				setConsoleTitle( "SLCAN "+self.serialPort+" CAN: %u kb/s"%(self.slcanBitRate,) )
+				self.receive()
+			except serial.SerialException as e:
+				printT( e )
+			except:
+				printT( format_exc() )
@@ -0,0 +1,215 @@
+from ATMAParserProcess import FRAME_RECORD
+from ATMAParserProcess import FRAME_FLAG_EXTENDED
+from ATMAParserProcess import FRAME_FLAG_RTR
+from ATMAParserProcess import FRAME_FLAG_FILTERED
+from FilterSnapshot import IDENTIFIERS_11_BIT
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+if numpy is not None:
+	# Frame record, same layout as ATMAParserProcess.FRAME_RECORD: identifier, flags, DLC, data (padded to 8 bytes), time (ns)
+	FRAME_DTYPE = numpy.dtype( {
+		"names": ["identifier", "flags", "DLC", "data", "timeNs"],
+		"formats": ["<u4", "u1", "u1", ("u1", 8), "<i8"],
+		"offsets": [0, 4, 5, 8, 16],
+		"itemsize": FRAME_RECORD.size,
+	} )
+	# Libpcap record of CANToNetwork.pcaprec_CAN with 8 bytes of data, truncated to the data length on output
+	PCAP_RECORD_DTYPE = numpy.dtype( [
+		("ts_sec", ">u4"),
+		("ts_usec", ">u4"),
+		("incl_len", ">u4"),
+		("orig_len", ">u4"),
+		("canFlagsId", ">u4"),
+		("DLC", "u1"),
+		("reserved", "u1", 3),
+		("data", "u1", 8),
+	] )
+	# CAN-ETH packet of 1 CAN frame, same as CANToNetwork.canEthPacket
+	CANETH_PACKET_DTYPE = numpy.dtype( [
+		("magicId", "S8"),
+		("version", "u1"),
+		("cnt", "u1"),
+		("identifier", "<u4"),
+		("DLC", "u1"),
+		("data", "u1", 8),
+		("extFlag", "u1"),
+		("rtrFlag", "u1"),
+	] )
+
+class CANFrameBatch():
+	"""
+	Batch of CAN frames in a NumPy structured array (FRAME_DTYPE), handled with array operations instead of 1 object per frame
+	Batches are not modified once created (thread-safety). NumPy is only required to create them.
+	"""
+	
+	available = numpy is not None
+	
+	def __init__( self, records, frameClass ):
+		"""
+		- records: array of FRAME_DTYPE, owned by the batch
+		- frameClass: class of the frames returned by toFrames()
+		"""
+		if numpy is None:
+			raise NotImplementedError( "Frame batches require NumPy" )
+		self.records = records
+		self.frameClass = frameClass
+		self.frames = None
+	
+	@classmethod
+	def fromRing( cls, ring, count, frameClass ):
+		""" Copy the next count records of a ATMAParserProcess.SharedMemoryRing of frame records, before they are released """
+		slotCount = ring.slotCount
+		slots = numpy.frombuffer( ring.buf, dtype=FRAME_DTYPE, count=slotCount, offset=ring.headerSize )
+		start = ring.read%slotCount
+		if start+count<=slotCount:
+			records = slots[start:start+count].copy()
+		else:
+			records = numpy.concatenate( (slots[start:], slots[:start+count-slotCount]) )
+		del slots # no reference to the shared memory left
+		return cls( records, frameClass )
+	
+	@classmethod
+	def fromFrames( cls, frames ):
+		""" Build a batch from a list of frames """
+		records = numpy.zeros( len( frames ), dtype=FRAME_DTYPE )
+		records["identifier"] = [frame.identifier for frame in frames]
+		records["flags"] = [( frame.isExtended and FRAME_FLAG_EXTENDED or 0 )|( frame.isRTR and FRAME_FLAG_RTR or 0 ) for frame in frames]
+		records["DLC"] = [frame.DLC for frame in frames]
+		records["data"] = numpy.frombuffer( b"".join( frame.data[:8].ljust( 8, b"\x00" ) for frame in frames ), dtype=numpy.uint8 ).reshape( -1, 8 )
+		records["timeNs"] = [frame.timeNs for frame in frames]
+		return cls( records, frames and type( frames[0] ) or None )
+	
+	def __len__( self ):
+		return len( self.records )
+	
+	def dataLengths( self ):
+		""" Array of the data lengths: DLC truncated to 8, 0 for RTR frames """
+		records = self.records
+		return numpy.where( ( records["flags"]&FRAME_FLAG_RTR )!=0, 0, numpy.minimum( records["DLC"], 8 ) ).astype( numpy.uint32 )
+	
+	def toFrames( self ):
+		""" Get the list of frames (frameClass objects), built once """
+		frames = self.frames
+		if frames is None:
+			records = self.records
+			frameClass = self.frameClass
+			identifiers = records["identifier"].tolist()
+			flags = records["flags"].tolist()
+			DLCs = records["DLC"].tolist()
+			times = records["timeNs"].tolist()
+			data = records["data"].tobytes()
+			lengths = self.dataLengths().tolist()
+			frames = []
+			for index in range( len( identifiers ) ):
+				offset = 8*index
+				frames.append( frameClass(
+					identifiers[index],
+					( flags[index]&FRAME_FLAG_EXTENDED )!=0,
+					( flags[index]&FRAME_FLAG_RTR )!=0,
+					DLCs[index],
+					data[offset:offset+lengths[index]],
+					times[index],
+				) )
+			self.frames = frames
+		return frames
+	
+	def splitFilteredCounts( self ):
+		""" Split the counts of rejected frames of the parser process (FRAME_FLAG_FILTERED): return (batch of the frames, list of (identifier, count)) """
+		records = self.records
+		isCount = ( records["flags"]&FRAME_FLAG_FILTERED )!=0
+		if not isCount.any():
+			return self, []
+		counts = records[isCount]
+		return type( self )( records[~isCount], self.frameClass ), list( zip( counts["identifier"].tolist(), counts["timeNs"].tolist() ) )
+	
+	def select( self, selection ):
+		""" Get a batch with the selected frames (array of booleans) """
+		return type( self )( self.records[selection], self.frameClass )
+	
+	## Filters
+	
+	def passesFilters( self, filterSnapshot ):
+		""" Same filtering as FilterSnapshot.passes(), return an array of booleans """
+		identifiers = self.records["identifier"]
+		table11 = numpy.frombuffer( filterSnapshot.table11, dtype=numpy.uint8 )
+		is11Bit = identifiers<IDENTIFIERS_11_BIT
+		if is11Bit.all():
+			return table11[identifiers]==1
+		selection = numpy.zeros( len( identifiers ), dtype=bool )
+		selection[is11Bit] = table11[identifiers[is11Bit]]==1
+		others = identifiers[~is11Bit]
+		othersSelection = ( others&filterSnapshot.mask )==filterSnapshot.maskingResult
+		if filterSnapshot.whitelist is not None:
+			othersSelection &= self.contains( filterSnapshot.whitelist, others )
+		if filterSnapshot.blacklist is not None:
+			othersSelection &= ~self.contains( filterSnapshot.blacklist, others )
+		selection[~is11Bit] = othersSelection
+		return selection
+	
+	@staticmethod
+	def contains( identifierSet, identifiers ):
+		""" Same as the operator in of an IdentifierSet for an array of identifiers, return an array of booleans """
+		contained = numpy.isin( identifiers, numpy.fromiter( identifierSet.identifiers, dtype=numpy.uint32, count=len( identifierSet.identifiers ) ) )
+		if identifierSet.ranges:
+			rangeFirsts = numpy.array( identifierSet.rangeFirsts, dtype=numpy.uint32 )
+			rangeLasts = numpy.array( identifierSet.rangeLasts, dtype=numpy.uint32 )
+			indexes = numpy.searchsorted( rangeFirsts, identifiers, side="right" )-1
+			contained |= ( indexes>=0 )&( identifiers<=rangeLasts[numpy.maximum( indexes, 0 )] )
+		for mask, maskingResult in identifierSet.masks:
+			contained |= ( identifiers&mask )==maskingResult
+		return contained
+	
+	def identifierCounts( self ):
+		""" Get the count of frames of each identifier: list of (identifier, count) """
+		identifiers, counts = numpy.unique( self.records["identifier"], return_counts=True )
+		return list( zip( identifiers.tolist(), counts.tolist() ) )
+	
+	## END Filters
+	
+	## Output
+	
+	def pcapRecords( self ):
+		""" Get the libpcap records of all frames (LINKTYPE_CAN_SOCKETCAN), same bytes as a pcaprec_CAN per frame """
+		records = self.records
+		count = len( records )
+		flags = records["flags"]
+		lengths = self.dataLengths()
+		output = numpy.zeros( count, dtype=PCAP_RECORD_DTYPE )
+		timesUs = records["timeNs"]//1000
+		output["ts_sec"] = timesUs//1000000
+		output["ts_usec"] = timesUs%1000000
+		output["incl_len"] = 8+lengths
+		output["orig_len"] = 8+lengths
+		output["canFlagsId"] = (
+			records["identifier"]|
+			numpy.where( ( flags&FRAME_FLAG_RTR )!=0, numpy.uint32( 0x40000000 ), numpy.uint32( 0 ) )|
+			numpy.where( ( flags&FRAME_FLAG_EXTENDED )!=0, numpy.uint32( 0x80000000 ), numpy.uint32( 0 ) )
+		)
+		output["DLC"] = records["DLC"]
+		output["data"] = records["data"]
+		# Truncate each record to its data length:
+		recordSize = PCAP_RECORD_DTYPE.itemsize
+		outputBytes = output.view( numpy.uint8 ).reshape( count, recordSize )
+		return outputBytes[numpy.arange( recordSize )<( recordSize-8+lengths )[:, None]].tobytes()
+	
+	def canEthPackets( self ):
+		""" Get the CAN-ETH packets of all frames: array with 1 packet per row, same bytes as a canEthPacket per frame """
+		records = self.records
+		count = len( records )
+		flags = records["flags"]
+		output = numpy.zeros( count, dtype=CANETH_PACKET_DTYPE )
+		output["magicId"] = b"ISO11898"
+		output["version"] = 1
+		output["cnt"] = 1
+		output["identifier"] = records["identifier"]
+		output["DLC"] = records["DLC"]
+		output["data"] = records["data"]*( numpy.arange( 8 )<self.dataLengths()[:, None] )
+		output["extFlag"] = ( flags&FRAME_FLAG_EXTENDED )!=0
+		output["rtrFlag"] = ( flags&FRAME_FLAG_RTR )!=0
+		return output.view( numpy.uint8 ).reshape( count, CANETH_PACKET_DTYPE.itemsize )
+	
+	## END Output
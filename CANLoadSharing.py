@@ -0,0 +1,149 @@
+import threading
+from collections import OrderedDict
+from time import sleep
+from traceback import format_exc
+from utility import printT
+from FilterPlanner import planLoadSharing
+
+class CANLoadSharingGroup( threading.Thread ):
+	"""
+	Scanners attached to the same CAN bus, sharing its identifiers with complementary ELM327-side filters
+	The filters are planned from the rates measured by all scanners, and planned again when the serial load becomes unbalanced.
+	Frames received by several scanners (while filters change) are deduplicated, so the scanners give a single stream of frames.
+	The group owns the ELM327-side filter (filter1) of its scanners.
+	"""
+	
+	daemon = True
+	
+	def __init__( self, busName, adapters ):
+		threading.Thread.__init__( self )
+		self.name = "CAN bus "+busName+" load sharing"
+		self.busName = busName
+		self.adapters = list( adapters )
+		self.lock = threading.Lock()
+		self.recentFrames = OrderedDict() # (identifier, isExtended, isRTR, data): (adapter, time in ns)
+		self.duplicatesCount = 0
+		self.rebalancesCount = 0
+		self.rebalanceInterval = 10.
+		self.rebalanceThreshold = 0.2
+		self.dedupWindowNs = 20000000
+		self.plan = None
+		for adapter in self.adapters:
+			adapter.loadSharingGroup = self
+		# Initial filters on the least significant bits, installed before monitoring starts:
+		self.applyPlan( planLoadSharing( {}, len( self.adapters ) ) )
+	
+	def setParameters( self, parameters ):
+		self.rebalanceInterval = parameters.get( "canBusLoadSharingRebalanceInterval", 10. )
+		self.rebalanceThreshold = parameters.get( "canBusLoadSharingRebalanceThreshold", 0.2 )
+		self.dedupWindowNs = int( parameters.get( "canBusLoadSharingDedupWindow", 0.02 )*1000000000 )
+	
+	## Filters
+	
+	def getRates( self ):
+		"""
+		Merge the rates measured by the scanners: {identifier: frames per second}
+		The rate of an identifier comes from the scanner admitting it, or else from its last measure by another scanner.
+		"""
+		rates = {}
+		admittedRates = {}
+		for adapter in self.adapters:
+			mask, maskingResult = adapter.getFilter1Remote()
+			for identifier, rate in adapter.getIdentifierRates().items():
+				if ( identifier&mask )==maskingResult:
+					admittedRates[identifier] = rate
+				elif rate>rates.get( identifier, 0. ):
+					rates[identifier] = rate
+		rates.update( admittedRates )
+		return rates
+	
+	def getInstalledRates( self, rates ):
+		""" Get the expected rate of each scanner with its installed filter """
+		installedRates = []
+		for adapter in self.adapters:
+			mask, maskingResult = adapter.getFilter1Remote()
+			installedRates.append( sum( rate for identifier, rate in rates.items() if ( identifier&mask )==maskingResult ) )
+		return installedRates
+	
+	def applyPlan( self, plan ):
+		for adapter, entry in zip( self.adapters, plan ):
+			adapter.setFilter1Remote( entry["mask"], entry["maskingResult"] )
+		self.plan = plan
+	
+	def rebalance( self, force=False ):
+		"""
+		Plan the filters from the measured rates, and install them if the busiest scanner would be relieved enough
+		The filters are installed anyway if they are not the ones of the group anymore.
+		Return True if new filters have been installed
+		"""
+		maskOver = getattr( self.adapters[0], "maskOver", 0x1FFFFFFF )
+		rates = self.getRates()
+		plan = planLoadSharing( rates, len( self.adapters ), maskOver )
+		installedFilters = [adapter.getFilter1Remote() for adapter in self.adapters]
+		if self.plan is None or installedFilters!=[(entry["mask"], entry["maskingResult"]) for entry in self.plan]:
+			force = True
+		installedMaxRate = max( self.getInstalledRates( rates ) )
+		plannedMaxRate = max( entry["rate"] for entry in plan )
+		if not force and installedMaxRate<=plannedMaxRate*( 1.+self.rebalanceThreshold ):
+			return False
+		self.applyPlan( plan )
+		self.rebalancesCount += 1
+		printT( "[CANLoadSharing.py] Load sharing of %s: new filters, %.0f frames/s for the busiest scanner instead of %.0f"%(self.busName, plannedMaxRate, installedMaxRate) )
+		return True
+	
+	def run( self ):
+		while True:
+			sleep( self.rebalanceInterval )
+			try:
+				self.rebalance()
+			except Exception:
+				printT( format_exc() )
+	
+	## END Filters
+	
+	## Deduplication
+	
+	def isDuplicate( self, adapter, frame ):
+		"""
+		Indicates if a frame has already been received by another scanner of the group within the deduplication window
+		This method must be thread-safe!
+		"""
+		key = (frame.identifier, frame.isExtended, frame.isRTR, bytes( frame.data ))
+		frameTimeNs = frame.timeNs
+		windowNs = self.dedupWindowNs
+		recentFrames = self.recentFrames
+		with self.lock:
+			# Forget frames out of the window:
+			while recentFrames:
+				oldestKey, oldest = next( iter( recentFrames.items() ) )
+				if oldest[1]>=frameTimeNs-windowNs:
+					break
+				del recentFrames[oldestKey]
+			previous = recentFrames.get( key )
+			if previous is not None and previous[0] is not adapter and abs( frameTimeNs-previous[1] )<=windowNs:
+				self.duplicatesCount += 1
+				return True
+			recentFrames[key] = (adapter, frameTimeNs)
+			recentFrames.move_to_end( key )
+		return False
+	
+	## END Deduplication
+	
+	def getState( self ):
+		rates = self.getRates()
+		installedRates = self.getInstalledRates( rates )
+		adapters = []
+		for adapter, installedRate in zip( self.adapters, installedRates ):
+			mask, maskingResult = adapter.getFilter1Remote()
+			adapters.append( {
+				"serialPort": getattr( adapter, "serialPort", None ),
+				"mask": mask,
+				"maskingResult": maskingResult,
+				"rate": installedRate,
+			} )
+		return {
+			"adapters": adapters,
+			"totalRate": sum( rates.values() ),
+			"rebalances": self.rebalancesCount,
+			"duplicates": self.duplicatesCount,
+		}
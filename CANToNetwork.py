@@ -1,7 +1,12 @@
 import threading
+import heapq
 from datetime import datetime
+from itertools import count
 from utility import printT
+from utility import timeNs
 from traceback import format_exc
+from CANFrameBatch import CANFrameBatch
+from FrameEncoding import frameEncoder
 
 try:
 	import socket
@@ -29,8 +34,9 @@ class pcaprec_CAN( bytearray ):
 		super().__init__( 24+dataLen )
 		
 		# Portion pcaprec_hdr_t
-		self[0:4]   = ( int( frame.time ) ).to_bytes( 4, "big", signed=False ) # ts_sec
-		self[4:8]   = ( int( ( frame.time%1 )*1000000 ) ).to_bytes( 4, "big", signed=False ) # ts_usec
+		frameTimeUs = frame.timeNs//1000
+		self[0:4]   = ( frameTimeUs//1000000 ).to_bytes( 4, "big", signed=False ) # ts_sec
+		self[4:8]   = ( frameTimeUs%1000000 ).to_bytes( 4, "big", signed=False ) # ts_usec
 		self[8:12]  = ( 8+dataLen ).to_bytes( 4, "big", signed=False ) # incl_len
 		self[12:16] = ( 8+dataLen ).to_bytes( 4, "big", signed=False )  # orig_len
 		
@@ -45,6 +51,43 @@ class pcaprec_CAN( bytearray ):
 		if dataLen:
 			self[24:24+dataLen] = frame.data # Payload
 
+# Pcapng - used in multi-bus mode, with 1 interface per bus
+# https://www.ietf.org/archive/id/draft-tuexen-opsawg-pcapng-05.html
+def pcapngBlock( blockType, body ):
+	body += bytes( -len( body )%4 ) # padding to 32 bits
+	blockTotalLength = ( 12+len( body ) ).to_bytes( 4, "big", signed=False )
+	return ( blockType ).to_bytes( 4, "big", signed=False )+blockTotalLength+body+blockTotalLength
+def pcapngOption( code, value ):
+	return ( code ).to_bytes( 2, "big", signed=False )+( len( value ) ).to_bytes( 2, "big", signed=False )+value+bytes( -len( value )%4 )
+# Section Header Block
+pcapng_shb = pcapngBlock( 0x0A0D0D0A, (
+	( 0x1A2B3C4D ).to_bytes( 4, "big", signed=False )+ # Byte-Order Magic
+	( 1 ).to_bytes( 2, "big", signed=False )+ # Major Version
+	( 0 ).to_bytes( 2, "big", signed=False )+ # Minor Version
+	( -1 ).to_bytes( 8, "big", signed=True ) # Section Length: unspecified
+) )
+# Interface Description Block
+def pcapng_idb( busName ):
+	return pcapngBlock( 0x00000001, (
+		( 227 ).to_bytes( 2, "big", signed=False )+ # LinkType = LINKTYPE_CAN_SOCKETCAN
+		bytes( 2 )+ # Reserved
+		( 32 ).to_bytes( 4, "big", signed=False )+ # SnapLen
+		pcapngOption( 2, busName.encode( "utf_8", errors="replace" ) )+ # if_name
+		pcapngOption( 9, bytes( (9,) ) )+ # if_tsresol = nanoseconds
+		pcapngOption( 0, b"" ) # opt_endofopt
+	) )
+# Enhanced Packet Block
+def pcapng_epb( busIndex, frame ):
+	packet = frameEncoder.pcapContent( frame ) # LINKTYPE_CAN_SOCKETCAN content
+	return pcapngBlock( 0x00000006, (
+		( busIndex ).to_bytes( 4, "big", signed=False )+ # Interface ID
+		( frame.timeNs>>32 ).to_bytes( 4, "big", signed=False )+ # Timestamp (High)
+		( frame.timeNs&0xFFFFFFFF ).to_bytes( 4, "big", signed=False )+ # Timestamp (Low)
+		( len( packet ) ).to_bytes( 4, "big", signed=False )+ # Captured Packet Length
+		( len( packet ) ).to_bytes( 4, "big", signed=False )+ # Original Packet Length
+		packet
+	) )
+
 # CAN-ETH - Packet of 1 CAN frame
 # https://www.proconx.com/assets/files/products/caneth/canframe.pdf
 canEthBasePacket = bytearray( 25 )
@@ -75,6 +118,9 @@ class CANToNetworkThread( threading.Thread ):
 	Depending on the configuration:
 	- It dispatches CAN-ETH packets to an IP address:port destination.
 	- It generates CAN libpcap files (compatible with Wireshark).
+	Frames are encoded by the shared frameEncoder (cached per identifier & payload), batches of frames (CANFrameBatch) with array operations.
+	In multi-bus mode, frames are tagged with their bus: the file is a pcapng file with 1 interface per bus,
+	and frames are held for a short delay in order to write the frames of all buses in time order.
 	"""
 	daemon = False
 	
@@ -93,10 +139,20 @@ class CANToNetworkThread( threading.Thread ):
 		self.logOutputDataFile = None
 		self.netOutputConfig = None
 		self.netOutputSocket = None
+		
+		self.busNames = None # multi-bus mode: names of buses, by index
+		self.mergeDelayNs = 0
+		self.mergeHeap = [] # (timeNs, sequence, busIndex, frame) of frames held for time ordering
+		self.mergeSequence = count() # tie-breaker keeping the order of frames with the same time
+	
+	def setBuses( self, busNames ):
+		""" Enable multi-bus mode, before setting parameters """
+		self.busNames = list( busNames )
 	
 	def setParameters( self, parameters ):
 		with self.parametersLock:
 			pcapOutputFile = parameters["pcapOutputFile"]
+			self.mergeDelayNs = int( parameters.get( "canBusesMergeDelay", 0.5 )*1000000000 )
 			if pcapOutputFile!=self.logOutputDataFileName:
 				self.logOutputDataFileName = pcapOutputFile
 				# Close any open file:
@@ -110,7 +166,12 @@ class CANToNetworkThread( threading.Thread ):
 				if self.logOutputDataFileName is not None:
 					try:
 						self.logOutputDataFile = open( self.logOutputDataFileName, mode="wb" )
-						self.logOutputDataFile.write( pcap_hdr_t )
+						if self.busNames is None:
+							self.logOutputDataFile.write( pcap_hdr_t )
+						else:
+							self.logOutputDataFile.write( pcapng_shb )
+							for busName in self.busNames:
+								self.logOutputDataFile.write( pcapng_idb( busName ) )
 					except Exception as e:
 						self.logOutputDataFile = None
 						printT( "Unable to open the pcapOutputFile file:", e )
@@ -155,10 +216,23 @@ class CANToNetworkThread( threading.Thread ):
 								pass
 					self.netOutputConfig = netOutputConfig
 	
-	def logFrame( self, frame ):
+	def logFrame( self, frame, busIndex=0 ):
 		if self.logOutputDataFile is not None:
 			with self.pendingDataLock:
-				self.pendingData.append( frame )
+				self.pendingData.append( (busIndex, frame) )
+			try:
+				self.continueProcessLock.release()
+			except RuntimeError:
+				pass
+	
+	def logBatch( self, batch, busIndex=0 ):
+		""" Same as logFrame() for a CANFrameBatch, split into frames in multi-bus mode (time ordering) """
+		if self.logOutputDataFile is not None:
+			with self.pendingDataLock:
+				if self.busNames is None:
+					self.pendingData.append( (busIndex, batch) )
+				else:
+					self.pendingData.extend( (busIndex, frame) for frame in batch.toFrames() )
 			try:
 				self.continueProcessLock.release()
 			except RuntimeError:
@@ -171,9 +245,66 @@ class CANToNetworkThread( threading.Thread ):
 		except RuntimeError:
 			pass
 	
+	def mergePendingData( self, pendingData, flush=False ):
+		""" Multi-bus mode: hold frames for mergeDelayNs, return the frames ready to be written in time order """
+		mergeHeap = self.mergeHeap
+		for busIndex, frame in pendingData:
+			heapq.heappush( mergeHeap, (frame.timeNs, next( self.mergeSequence ), busIndex, frame) )
+		readyData = []
+		readyTimeNs = timeNs()-self.mergeDelayNs
+		while mergeHeap and ( flush or mergeHeap[0][0]<=readyTimeNs ):
+			entry = heapq.heappop( mergeHeap )
+			readyData.append( (entry[2], entry[3]) )
+		return readyData
+	
+	def writePendingData( self, pendingData ):
+		if self.netOutputSocket:
+			for busIndex, frame in pendingData:
+				try:
+					if isinstance( frame, CANFrameBatch ):
+						for packet in frame.canEthPackets():
+							self.netOutputSocket.sendto( packet, self.canEthUdpDst )
+					else:
+						self.netOutputSocket.sendto( frameEncoder.canEthPacket( frame ), self.canEthUdpDst )
+				except OSError as e:
+					# network error silently discarded
+					pass
+				except Exception as e:
+					printT( "CAN-ETH converter error, stopping:", format_exc() )
+					try:
+						netOutputSocket = self.netOutputSocket
+						self.netOutputSocket = None
+						netOutputSocket.close()
+					except:
+						pass
+					break
+		if self.logOutputDataFile:
+			multiBus = self.busNames is not None
+			for busIndex, frame in pendingData:
+				try:
+					if isinstance( frame, CANFrameBatch ):
+						self.logOutputDataFile.write( frame.pcapRecords() )
+					elif multiBus:
+						self.logOutputDataFile.write( pcapng_epb( busIndex, frame ) )
+					else:
+						self.logOutputDataFile.write( frameEncoder.pcapRecord( frame ) )
+				except Exception as e:
+					printT( "LibPCAP logging error, stopping:", format_exc() )
+					try:
+						logOutputDataFile = self.logOutputDataFile
+						self.logOutputDataFile = None
+						logOutputDataFile.close()
+					except:
+						pass
+	
 	def run( self ):
 		while not self.terminating:
-			self.continueProcessLock.acquire()
+			mergeHeap = self.mergeHeap
+			if mergeHeap:
+				# Wake up when the oldest held frame is due:
+				self.continueProcessLock.acquire( timeout=max( 0.01, ( mergeHeap[0][0]+self.mergeDelayNs-timeNs() )/1000000000 ) )
+			else:
+				self.continueProcessLock.acquire()
 			presentPendingData = True
 			with self.parametersLock:
 				while presentPendingData:
@@ -181,35 +312,17 @@ class CANToNetworkThread( threading.Thread ):
 						pendingData = self.pendingData
 						self.pendingData = [] # cleanup
 					presentPendingData = len( pendingData )!=0
-					if self.netOutputSocket:
-						for frame in pendingData:
-							try:
-								self.netOutputSocket.sendto( canEthPacket( frame ), self.canEthUdpDst )
-							except OSError as e:
-								# network error silently discarded
-								pass
-							except Exception as e:
-								printT( "CAN-ETH converter error, stopping:", format_exc() )
-								try:
-									netOutputSocket = self.netOutputSocket
-									self.netOutputSocket = None
-									netOutputSocket.close()
-								except:
-									pass
-								break
-					packet = None
-					if self.logOutputDataFile:
-						for frame in pendingData:
-							try:
-								self.logOutputDataFile.write( pcaprec_CAN( frame ) )
-							except Exception as e:
-								printT( "LibPCAP logging error, stopping:", format_exc() )
-								try:
-									logOutputDataFile = self.logOutputDataFile
-									self.logOutputDataFile = None
-									logOutputDataFile.close()
-								except:
-									pass
+					if self.busNames is not None:
+						pendingData = self.mergePendingData( pendingData )
+					self.writePendingData( pendingData )
+		with self.parametersLock:
+			# Write held frames & frames received during termination:
+			with self.pendingDataLock:
+				pendingData = self.pendingData
+				self.pendingData = []
+			if self.busNames is not None:
+				pendingData = self.mergePendingData( pendingData, flush=True )
+			self.writePendingData( pendingData )
 		try:
 			self.logOutputDataFile.close() # properly flush & close
 		except:
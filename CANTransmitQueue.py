@@ -0,0 +1,93 @@
+from collections import OrderedDict
+from collections import deque
+from threading import Lock
+
+class CANTransmitQueue():
+	"""
+	Queue of CAN frames to transmit between ATMA monitoring sessions
+	Frames are grouped by identifier, so that the header (ATSH) changes only once per group:
+	groups are sent in the order of their oldest frame, frames of a group keep their order.
+	Frames are queued by any thread, they are sent by the capture thread.
+	"""
+	
+	def __init__( self, maxSize=1024 ):
+		self.maxSize = maxSize
+		self.lock = Lock()
+		self.groups = OrderedDict() # (identifier, isExtended): deque of data
+		self.size = 0
+		self.stats = {
+			"queued": 0,
+			"dropped": 0, # queue full
+			"sent": 0,
+			"failed": 0, # rejected by the ELM327 (like "CAN ERROR")
+			"headerChanges": 0,
+			"windows": 0,
+			"windowTime": 0., # cumulative duration of transmission windows (seconds)
+		}
+	
+	def push( self, frames ):
+		"""
+		Queue frames: iterable of (identifier, isExtended, data)
+		Return the count of queued frames (the others are dropped when the queue is full)
+		"""
+		queuedCount = 0
+		with self.lock:
+			groups = self.groups
+			for identifier, isExtended, data in frames:
+				if self.size>=self.maxSize:
+					self.stats["dropped"] += 1
+					continue
+				key = (identifier, isExtended)
+				group = groups.get( key )
+				if group is None:
+					group = deque()
+					groups[key] = group
+				group.append( data )
+				self.size += 1
+				queuedCount += 1
+			self.stats["queued"] += queuedCount
+		return queuedCount
+	
+	def pop( self, preferredKey=None ):
+		"""
+		Take the next frame to send: (identifier, isExtended, data), None if the queue is empty
+		- preferredKey: (identifier, isExtended) of the current header, taken first to avoid a header change
+		"""
+		with self.lock:
+			groups = self.groups
+			if not groups:
+				return None
+			key = preferredKey
+			group = groups.get( key )
+			if group is None:
+				key, group = next( iter( groups.items() ) )
+			data = group.popleft()
+			if not group:
+				del groups[key]
+			self.size -= 1
+		return (key[0], key[1], data)
+	
+	def __len__( self ):
+		return self.size
+	
+	def countSent( self, success, headerChanged ):
+		with self.lock:
+			if success:
+				self.stats["sent"] += 1
+			else:
+				self.stats["failed"] += 1
+			if headerChanged:
+				self.stats["headerChanges"] += 1
+	
+	def countWindow( self, duration ):
+		with self.lock:
+			self.stats["windows"] += 1
+			self.stats["windowTime"] += duration
+	
+	def getStats( self ):
+		""" Get the counters, with the throughput during transmission windows in frames per second """
+		with self.lock:
+			stats = dict( self.stats )
+			stats["pending"] = self.size
+		stats["throughput"] = ( stats["windowTime"]>0. ) and stats["sent"]/stats["windowTime"] or 0.
+		return stats
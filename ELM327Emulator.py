@@ -0,0 +1,494 @@
+#!/usr/bin/python3
+# ELM327 emulator on a pseudo-terminal (Linux), to run and load-test the capture without any scanner
+# Usage: ELM327Emulator.py [--link=<path>] [--frameRate=<frames/s>] [--identifiers=<count or list like 7E8:10,123:100>]
+#        [--maxBaudRate=<b/s>] [--bufferSize=<bytes>] [--bufferFull=<probability>] [--reset=<probability>]
+#        [--nulls=<probability>] [--splice=<probability>] [--seed=<integer>]
+# Probabilities of faults apply to each frame sent. The capture is pointed to the emulator with the parameter serialPort.
+
+import threading
+import select
+import os
+
+from time import sleep
+from time import perf_counter
+from random import Random
+from bisect import bisect_right
+from collections import deque
+from utility import printT
+
+TCGETS2 = 0x802C542A # ioctl reading the termios2 structure, with the actual baud rates (Linux, x86 & ARM)
+PROTOCOLS = { # ATSP protocol: (description, extended identifiers, CAN rate in kb/s or None for ATPB)
+	"6": ("ISO 15765-4", False, 500),
+	"7": ("ISO 15765-4", True, 500),
+	"8": ("ISO 15765-4", False, 250),
+	"9": ("ISO 15765-4", True, 250),
+	"A": ("SAE J1939", True, 250),
+	"B": ("USER1", None, None),
+	"C": ("USER2", None, None),
+}
+
+class ELM327Emulator( threading.Thread ):
+	"""
+	Emulated ELM327 on the slave side of a pseudo-terminal, generating CAN traffic for ATMA
+	The output is paced at the emulated serial baud rate: when the CAN traffic exceeds it, the internal buffer fills up until BUFFER FULL.
+	If the baud rate of the pseudo-terminal set by the program differs from the emulated one, the output is garbled like with a real UART.
+	Faults can be injected: BUFFER FULL alerts, resets, \\x00 bytes and spliced lines (end of a line lost).
+	Simplification: a single <CR> received out of ATMA only returns a prompt (a real ELM327 repeats the last command).
+	"""
+	
+	daemon = True
+	version = b"ELM327 v1.5"
+	defaultBaudRate = 38400
+	ecuDelay = 0.01 # seconds before the answer to an OBD request
+	
+	def __init__( self, frameRate=2000., identifiers=60, maxBaudRate=500000, bufferSize=512, faults=None, seed=327 ):
+		"""
+		- frameRate: frames per second on the CAN bus (before the ELM327-side filter)
+		- identifiers: count of random identifiers, or dict {identifier: relative frequency}
+		- maxBaudRate: highest baud rate accepted by ATBRD
+		- bufferSize: size in bytes of the output buffer of the ELM327 during ATMA
+		- faults: {"bufferFull", "reset", "nulls", "splice"}: probability of each fault per frame sent
+		"""
+		threading.Thread.__init__( self )
+		self.name = "ELM327Emulator"
+		self.frameRate = frameRate
+		self.maxBaudRate = maxBaudRate
+		self.bufferSize = bufferSize
+		self.faults = dict( faults or {} )
+		self.seed = seed
+		self.random = Random( seed )
+		self.identifiers = identifiers
+		self.master, self.slave = os.openpty()
+		import tty
+		tty.setraw( self.slave )
+		self.port = os.ttyname( self.slave )
+		self.stats = {
+			"commands": 0,
+			"generatedFrames": 0,
+			"sentFrames": 0,
+			"filteredFrames": 0,
+			"bufferFull": 0,
+			"injectedBufferFull": 0,
+			"injectedResets": 0,
+			"injectedNulls": 0,
+			"injectedSplices": 0,
+			"transmittedFrames": 0,
+		}
+		self.transmittedFrames = deque( maxlen=1024 ) # (identifier, data) sent on the bus with ATR0
+		self.reset()
+	
+	def reset( self ):
+		""" Restore the settings of a powered-up ELM327 """
+		self.baudRate = self.defaultBaudRate
+		self.baudRateTimeout = 0.075 # ATBRT
+		self.echo = True
+		self.linefeeds = False
+		self.spaces = True
+		self.headers = False
+		self.dlc = False
+		self.filterMask = 0x00000000
+		self.filterResult = 0x00000000
+		self.protocol = "0"
+		self.protocolB = 0x0000 # ATPB
+		self.header = 0x7DF # ATSH
+		self.priority = 0x18 # ATCP
+		self.responses = True # ATR
+		self.autoFormatting = True # ATCAF
+		self.buildBus()
+	
+	def buildBus( self ):
+		""" Setup the generated traffic for the selected protocol """
+		description, extended, rate = PROTOCOLS.get( self.protocol, ("ISO 15765-4", False, 500) )
+		if extended is None:
+			# USER1 & USER2: from ATPB
+			extended = not ( self.protocolB&0x8000 )
+			rate = 500/max( 1, self.protocolB&0xFF )
+		if self.protocol=="0":
+			description = "AUTO, "+description
+		self.busDescription = "%s (CAN %u/%u)"%(description, extended and 29 or 11, rate)
+		self.extended = extended
+		random = Random( "%s-%u"%(self.seed, extended) ) # same bus after resets
+		if type( self.identifiers ) is dict:
+			frequencies = self.identifiers
+		else:
+			# Periods between 10 ms & 1 s, log-uniform like on real buses
+			frequencies = {}
+			while len( frequencies )<self.identifiers:
+				frequencies[random.randrange( extended and 0x20000000 or 0x800 )] = 1./( 10.**random.uniform( -2., 0. ) )
+		self.busIdentifiers = list( frequencies.keys() )
+		self.busPayloads = [bytearray( random.randrange( 256 ) for i in range( 8 ) ) for identifier in self.busIdentifiers]
+		cumulative = 0.
+		self.busCumulativeWeights = []
+		for identifier in self.busIdentifiers:
+			cumulative += frequencies[identifier]
+			self.busCumulativeWeights.append( cumulative )
+	
+	## Serial link
+	
+	def getHostBaudRate( self ):
+		""" Baud rate of the pseudo-terminal set by the program, None if unknown """
+		try:
+			import fcntl
+			import struct
+			return struct.unpack( "4IB19s2I", fcntl.ioctl( self.slave, TCGETS2, bytes( 44 ) ) )[-1]
+		except (ImportError, OSError):
+			return None
+	
+	def isBaudRateMatching( self ):
+		hostBaudRate = self.getHostBaudRate()
+		return hostBaudRate is None or abs( hostBaudRate-self.baudRate )<=self.baudRate*0.03
+	
+	def output( self, data ):
+		""" Send bytes at the emulated baud rate (garbled if the program uses another baud rate) """
+		if not data:
+			return
+		if not self.isBaudRateMatching():
+			data = bytes( self.random.randrange( 256 ) for i in range( len( data ) ) )
+		os.write( self.master, data )
+		sleep( len( data )*10./self.baudRate )
+	
+	def waitInput( self, timeout ):
+		""" Return the received bytes, empty if none before timeout (garbage is dropped at a wrong baud rate) """
+		if not select.select( (self.master,), (), (), timeout )[0]:
+			return b""
+		data = os.read( self.master, 4096 )
+		if not self.isBaudRateMatching():
+			return b"\x00"
+		return data
+	
+	## END Serial link
+	
+	## Commands
+	
+	def run( self ):
+		pending = bytearray()
+		while True:
+			data = self.waitInput( None )
+			if data==b"\x00":
+				continue # garbage
+			pending.extend( data )
+			while b"\x0D" in pending:
+				end = pending.index( b"\x0D" )
+				line = bytes( pending[:end] )
+				del pending[:end+1]
+				if self.echo:
+					self.output( line+b"\x0D" )
+				leftover = self.handleCommand( line.replace( b" ", b"" ).replace( b"\x0A", b"" ).upper() )
+				if leftover:
+					pending[0:0] = leftover
+	
+	def endOfLine( self ):
+		return self.linefeeds and b"\x0D\x0A" or b"\x0D"
+	
+	def answer( self, text ):
+		""" Send the answer of a command followed by the prompt """
+		endOfLine = self.endOfLine()
+		self.output( ( text and text+endOfLine or b"" )+endOfLine+b">" )
+	
+	def handleCommand( self, command ):
+		""" Execute a command line, return the bytes received after the one that stopped ATMA """
+		self.stats["commands"] += 1
+		if not command:
+			self.output( b">" )
+		elif command[:2]!=b"AT":
+			self.handleRequest( command )
+		elif command in (b"ATZ", b"ATWS"):
+			self.reset()
+			endOfLine = self.endOfLine()
+			self.output( endOfLine+endOfLine+self.version+endOfLine+endOfLine+b">" )
+		elif command==b"ATD":
+			baudRate = self.baudRate
+			self.reset()
+			self.baudRate = baudRate
+			self.answer( b"OK" )
+		elif command in (b"ATI", b"AT@1"):
+			self.answer( self.version )
+		elif command==b"ATRV":
+			self.answer( b"12.6V" )
+		elif command==b"ATDP":
+			self.answer( self.busDescription.encode( "ascii" ) )
+		elif command==b"ATDPN":
+			self.answer( self.protocol.encode( "ascii" ) )
+		elif command==b"ATMA":
+			return self.monitor()
+		elif command[:5]==b"ATBRD":
+			self.switchBaudRate( command[5:] )
+		elif command[:5]==b"ATBRT":
+			try:
+				self.baudRateTimeout = ( int( command[5:], 16 ) or 256 )*0.005
+				self.answer( b"OK" )
+			except ValueError:
+				self.answer( b"?" )
+		elif command[:4] in (b"ATCF", b"ATCM", b"ATSH", b"ATPB", b"ATCP"):
+			try:
+				value = int( command[4:], 16 )
+			except ValueError:
+				self.answer( b"?" )
+				return
+			if command[:4]==b"ATCF":
+				self.filterResult = value
+			elif command[:4]==b"ATCM":
+				self.filterMask = value
+			elif command[:4]==b"ATSH":
+				self.header = value
+			elif command[:4]==b"ATCP":
+				self.priority = value&0x1F
+			else:
+				self.protocolB = value
+				self.buildBus()
+			self.answer( b"OK" )
+		elif command==b"ATAR" or command==b"ATCRA":
+			self.filterMask = 0x00000000
+			self.filterResult = 0x00000000
+			self.answer( b"OK" )
+		elif command[:5]==b"ATCRA":
+			try:
+				self.filterResult = int( command[5:], 16 )
+			except ValueError:
+				self.answer( b"?" )
+				return
+			self.filterMask = ( len( command )>8 ) and 0x1FFFFFFF or 0x7FF
+			self.answer( b"OK" )
+		elif command in (b"ATCAF0", b"ATCAF1"):
+			self.autoFormatting = ( command==b"ATCAF1" )
+			self.answer( b"OK" )
+		elif command[:4]==b"ATSP" or command[:4]==b"ATTP":
+			protocol = command[4:].lstrip( b"A" ).decode( "ascii", "replace" ) or "0"
+			if protocol!="0" and protocol not in PROTOCOLS:
+				self.answer( b"?" )
+				return
+			self.protocol = protocol
+			self.buildBus()
+			self.answer( b"OK" )
+		elif command[:3] in (b"ATE", b"ATL", b"ATS", b"ATH") and command[3:] in (b"0", b"1"):
+			value = ( command[3:]==b"1" )
+			if command[:3]==b"ATE":
+				self.echo = value
+			elif command[:3]==b"ATL":
+				self.linefeeds = value
+			elif command[:3]==b"ATS":
+				self.spaces = value
+			else:
+				self.headers = value
+			self.answer( b"OK" )
+		elif command in (b"ATD0", b"ATD1"):
+			self.dlc = ( command==b"ATD1" )
+			self.answer( b"OK" )
+		elif command in (b"ATR0", b"ATR1"):
+			self.responses = ( command==b"ATR1" )
+			self.answer( b"OK" )
+		else:
+			self.answer( b"OK" ) # other settings accepted without effect
+	
+	def handleRequest( self, command ):
+		""" Answer an OBD request (hexadecimal bytes) like an ECU at 7E8, through the ELM327-side filter, or only transmit it with ATR0 """
+		try:
+			request = bytes.fromhex( command.decode( "ascii" ) )
+		except ValueError:
+			self.answer( b"?" )
+			return
+		if not self.responses:
+			# ATR0: the frame is sent without waiting for any answer
+			identifier = self.header
+			if self.extended and identifier<=0xFFFFFF:
+				identifier |= self.priority<<24
+			self.transmittedFrames.append( (identifier, request) )
+			self.stats["transmittedFrames"] += 1
+			self.output( b">" )
+			return
+		if not self.autoFormatting:
+			# Raw CAN data formatting: single-frame PCI byte & padding sent by the program
+			request = request[1:1+( request[:1] or b"\x00" )[0]]
+		sleep( self.ecuDelay )
+		identifier = self.extended and 0x18DAF110 or 0x7E8
+		if ( identifier&self.filterMask )!=( self.filterResult&self.filterMask ):
+			self.answer( b"NO DATA" )
+			return
+		if len( request )<2 or request[0] not in (0x01, 0x09, 0x22):
+			self.answer( b"NO DATA" )
+			return
+		payload = bytes( (request[0]+0x40,) )+request[1:]+bytes( self.random.randrange( 256 ) for i in range( 4 ) )
+		payload = bytes( (len( payload ),) )+payload
+		payload = payload[:8]+bytes( 8-min( len( payload ), 8 ) )
+		self.answer( self.formatFrame( identifier, payload ) )
+	
+	def switchBaudRate( self, argument ):
+		""" ATBRD: OK, switch, send the version, wait for <CR> at the new baud rate or restore the previous one """
+		try:
+			baudRate = round( 4000000/int( argument, 16 ) )
+		except (ValueError, ZeroDivisionError):
+			self.answer( b"?" )
+			return
+		if baudRate>self.maxBaudRate:
+			self.answer( b"?" )
+			return
+		self.output( b"OK"+self.endOfLine() )
+		previousBaudRate = self.baudRate
+		self.baudRate = baudRate
+		# Give the program some time to switch (a real ELM327 does not wait)
+		switchDeadline = perf_counter()+0.05
+		while not self.isBaudRateMatching() and perf_counter()<switchDeadline:
+			sleep( 0.001 )
+		self.output( self.version+b"\x0D" )
+		confirmation = self.waitInput( self.baudRateTimeout )
+		if confirmation[:1]!=b"\x0D":
+			self.baudRate = previousBaudRate
+		self.output( self.endOfLine()+b">" )
+	
+	## END Commands
+	
+	## Monitoring
+	
+	def formatFrame( self, identifier, data ):
+		""" Line of a received frame according to ATH, ATS & ATD """
+		spaces = self.spaces
+		parts = []
+		if self.headers:
+			if self.extended:
+				identifierBytes = identifier.to_bytes( 4, "big" )
+				if spaces:
+					parts.extend( "%.2X"%(byte,) for byte in identifierBytes )
+				else:
+					parts.append( "%.8X"%(identifier,) )
+			else:
+				parts.append( "%.3X"%(identifier,) )
+			if self.dlc:
+				parts.append( "%u"%(len( data ),) )
+		parts.extend( "%.2X"%(byte,) for byte in data )
+		return ( spaces and " " or "" ).join( parts ).encode( "ascii" )
+	
+	def nextFrame( self ):
+		""" Generate the next frame of the bus, None if rejected by the ELM327-side filter """
+		random = self.random
+		index = bisect_right( self.busCumulativeWeights, random.random()*self.busCumulativeWeights[-1] )
+		index = min( index, len( self.busIdentifiers )-1 )
+		identifier = self.busIdentifiers[index]
+		payload = self.busPayloads[index]
+		payload[7] = ( payload[7]+1 )&0xFF # counter
+		self.stats["generatedFrames"] += 1
+		if ( identifier&self.filterMask )!=( self.filterResult&self.filterMask ):
+			self.stats["filteredFrames"] += 1
+			return None
+		return self.formatFrame( identifier, payload )
+	
+	def injectFaults( self, line ):
+		"""
+		Apply the faults to the line of a frame
+		Return (line, alert): alert is "bufferFull" or "reset" if monitoring must end
+		"""
+		faults = self.faults
+		random = self.random
+		if faults.get( "bufferFull" ) and random.random()<faults["bufferFull"]:
+			self.stats["injectedBufferFull"] += 1
+			return line, "bufferFull"
+		if faults.get( "reset" ) and random.random()<faults["reset"]:
+			self.stats["injectedResets"] += 1
+			return line, "reset"
+		if faults.get( "nulls" ) and random.random()<faults["nulls"]:
+			self.stats["injectedNulls"] += 1
+			position = random.randrange( len( line )+1 )
+			line = line[:position]+b"\x00"+line[position:]
+		if faults.get( "splice" ) and random.random()<faults["splice"]:
+			self.stats["injectedSplices"] += 1
+			return line[:random.randrange( 1, len( line ) )], None # no end of line: joined with the next line
+		return line+self.endOfLine(), None
+	
+	def monitor( self ):
+		"""
+		ATMA: send frames at frameRate until a byte is received, or BUFFER FULL
+		Return the bytes received after the one that stopped monitoring
+		"""
+		endOfLine = self.endOfLine()
+		frameRate = self.frameRate
+		buffered = bytearray() # generated but not sent yet
+		startedAt = perf_counter()
+		sentUntil = startedAt # time until which the serial link is busy
+		generatedCount = 0
+		alert = None
+		lineEnded = True # nothing sent after the last end of line
+		while True:
+			if select.select( (self.master,), (), (), 0.001 )[0]:
+				received = os.read( self.master, 4096 ) # any byte stops monitoring
+				self.output( ( not lineEnded and endOfLine or b"" )+b">" )
+				return received[1:]
+			now = perf_counter()
+			dueCount = int( ( now-startedAt )*frameRate )
+			if dueCount-generatedCount>frameRate:
+				generatedCount = dueCount-int( frameRate ) # emulator too slow: skip over 1 s of traffic
+			while generatedCount<dueCount and alert is None:
+				generatedCount += 1
+				line = self.nextFrame()
+				if line is None:
+					continue
+				line, alert = self.injectFaults( line )
+				if len( buffered )+len( line )>self.bufferSize:
+					alert = "bufferFull"
+					self.stats["bufferFull"] += 1
+				else:
+					buffered.extend( line )
+					self.stats["sentFrames"] += 1
+			# Send what the serial link allows:
+			byteRate = self.baudRate/10.
+			if sentUntil<now-0.001:
+				sentUntil = now-0.001 # no credit accumulated while idle
+			sendCount = min( len( buffered ), int( ( now-sentUntil )*byteRate ) )
+			if sendCount:
+				data = bytes( buffered[:sendCount] )
+				del buffered[:sendCount]
+				if not self.isBaudRateMatching():
+					data = bytes( self.random.randrange( 256 ) for i in range( len( data ) ) )
+				os.write( self.master, data )
+				sentUntil += sendCount/byteRate
+				lineEnded = data.endswith( endOfLine )
+			if alert is not None and not buffered:
+				if alert=="bufferFull":
+					self.output( b"BUFFER FULL"+endOfLine+endOfLine+b">" ) # after the end of the last line
+				else:
+					self.reset()
+					self.output( endOfLine+endOfLine+self.version+endOfLine+endOfLine+b">" )
+				return
+	
+	## END Monitoring
+	
+	def getStats( self ):
+		stats = dict( self.stats )
+		stats["baudRate"] = self.baudRate
+		stats["hostBaudRate"] = self.getHostBaudRate()
+		return stats
+
+if __name__=="__main__":
+	from sys import argv
+	options = {}
+	for argument in argv[1:]:
+		if argument[:2]=="--" and "=" in argument:
+			name, value = argument[2:].split( "=", 1 )
+			options[name] = value
+	identifiers = options.get( "identifiers", "60" )
+	if ":" in identifiers:
+		identifiers = {int( identifier, 16 ): float( frequency ) for identifier, frequency in ( pair.split( ":" ) for pair in identifiers.split( "," ) )}
+	else:
+		identifiers = int( identifiers )
+	emulator = ELM327Emulator(
+		frameRate=float( options.get( "frameRate", 2000 ) ),
+		identifiers=identifiers,
+		maxBaudRate=int( options.get( "maxBaudRate", 500000 ) ),
+		bufferSize=int( options.get( "bufferSize", 512 ) ),
+		faults={fault: float( options[fault] ) for fault in ("bufferFull", "reset", "nulls", "splice") if fault in options},
+		seed=int( options.get( "seed", 327 ) ),
+	)
+	link = options.get( "link" )
+	if link is not None:
+		if os.path.lexists( link ):
+			os.remove( link )
+		os.symlink( emulator.port, link )
+	printT( "ELM327 emulator on "+emulator.port+( link and " ("+link+")" or "" ) )
+	emulator.start()
+	try:
+		while True:
+			sleep( 5 )
+			printT( emulator.getStats() )
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if link is not None and os.path.islink( link ):
+			os.remove( link )
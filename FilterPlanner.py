@@ -0,0 +1,289 @@
+from threading import Lock
+from utility import bytes_hex
+
+class IdentifierRateMeter():
+	"""
+	Measure of the frame rate of each CAN identifier received from the scanner (before computer-side filters)
+	Frames are counted by the frame handler thread, rates are updated about once per second by the capture thread.
+	Only identifiers admitted by the ELM327-side filter can be measured: the others keep their last measured rate.
+	"""
+	
+	smoothing = 0.5 # weight of the newest measurement in moving averages
+	expiry = 60. # seconds without frames before an admitted identifier is forgotten
+	
+	def __init__( self ):
+		self.lock = Lock()
+		self.counts = {} # identifier: count of frames since the last update
+		self.rates = {} # identifier: frames per second
+		self.lastSeen = {} # identifier: time of the last update with frames
+		self.lastUpdate = None
+	
+	def countFrames( self, frames ):
+		""" Count received frames (frame handler thread) """
+		with self.lock:
+			counts = self.counts
+			for frame in frames:
+				identifier = frame.identifier
+				counts[identifier] = counts.get( identifier, 0 )+1
+	
+	def countIdentifiers( self, identifierCounts ):
+		""" Count received frames given as (identifier, count of frames) (frame handler thread) """
+		with self.lock:
+			counts = self.counts
+			for identifier, count in identifierCounts:
+				counts[identifier] = counts.get( identifier, 0 )+count
+	
+	def update( self, now, mask, maskingResult ):
+		"""
+		Update the rates from the counted frames
+		- now: current time in seconds
+		- mask, maskingResult: ELM327-side filter in place during the measurement
+		"""
+		with self.lock:
+			counts = self.counts
+			self.counts = {}
+		lastUpdate = self.lastUpdate
+		self.lastUpdate = now
+		if lastUpdate is None or now<=lastUpdate:
+			return
+		elapsed = now-lastUpdate
+		smoothing = self.smoothing
+		rates = dict( self.rates )
+		lastSeen = self.lastSeen
+		for identifier, count in counts.items():
+			rate = count/elapsed
+			if identifier in rates:
+				rates[identifier] += smoothing*( rate-rates[identifier] )
+			else:
+				rates[identifier] = rate
+			lastSeen[identifier] = now
+		for identifier in list( rates.keys() ):
+			if identifier not in counts and ( identifier&mask )==maskingResult:
+				# Admitted but not received:
+				if now-lastSeen.get( identifier, now )>self.expiry:
+					del rates[identifier]
+					lastSeen.pop( identifier, None )
+				else:
+					rates[identifier] -= smoothing*rates[identifier]
+		self.rates = rates # replaced at once for readers
+	
+	def getRates( self ):
+		""" Get the measured rates: {identifier: frames per second} """
+		return dict( self.rates )
+
+def planFilter( rates, wanted, maskOver=0x1FFFFFFF ):
+	"""
+	Plan the ELM327-side filter (ATCF & ATCM) that admits all wanted identifiers
+	With a single mask / masking result pair, the mask made of all the bits on which wanted identifiers agree is optimal:
+	any other pair admitting them has fewer bits in its mask, so it admits a superset of identifiers.
+	The expected rates come from measured rates, so unknown identifiers count as 0.
+	- rates: {identifier: frames per second}
+	- wanted: set of identifiers to admit
+	- maskOver: bits of identifiers compared by the ELM327
+	Throws a ValueError if wanted is empty
+	"""
+	if not wanted:
+		raise ValueError( "No wanted identifier to plan a filter" )
+	allOnes = maskOver
+	allZeros = maskOver
+	anyOnes = 0x00000000
+	for identifier in wanted:
+		allOnes &= identifier
+		allZeros &= ~identifier
+		anyOnes |= identifier
+	mask = ( allOnes|allZeros )&maskOver
+	maskingResult = anyOnes&mask
+	admittedRate = 0.
+	wantedRate = 0.
+	excludedRate = 0.
+	admittedUnwanted = []
+	for identifier, rate in rates.items():
+		if ( identifier&mask )!=maskingResult:
+			excludedRate += rate
+		else:
+			admittedRate += rate
+			if identifier in wanted:
+				wantedRate += rate
+			else:
+				admittedUnwanted.append( (identifier, rate) )
+	admittedUnwanted.sort( key=lambda pair: pair[1], reverse=True )
+	return {
+		"mask": mask,
+		"maskingResult": maskingResult,
+		"admittedRate": admittedRate,
+		"wantedRate": wantedRate,
+		"excludedRate": excludedRate,
+		"admittedUnwanted": [{"identifier": identifier, "rate": rate} for identifier, rate in admittedUnwanted],
+	}
+
+def planLoadSharing( rates, adaptersCount, maskOver=0x1FFFFFFF ):
+	"""
+	Plan complementary ELM327-side filters (ATCF & ATCM) sharing the identifiers of a bus between several scanners
+	The filters are the leaves of a binary tree splitting identifiers on 1 bit per level, so each identifier is admitted by exactly 1 filter.
+	At each level, the bit is chosen so that the rates of both sides are in proportion to the count of scanners given to them.
+	Without measured rates, the least significant bits are chosen.
+	- rates: {identifier: frames per second}
+	- adaptersCount: count of filters to plan
+	- maskOver: bits of identifiers compared by the ELM327
+	Return a list of {"mask", "maskingResult", "rate"}
+	Throws a ValueError if there are not enough bits in maskOver
+	"""
+	plan = []
+	def split( mask, maskingResult, identifiers, count ):
+		rate = sum( rates[identifier] for identifier in identifiers )
+		if count==1:
+			plan.append( {"mask": mask, "maskingResult": maskingResult, "rate": rate} )
+			return
+		countOnes = count//2
+		countZeros = count-countOnes
+		targetRate = rate*countOnes/count
+		bestError = None
+		for bitIndex in range( 29 ):
+			bit = 1<<bitIndex
+			if not ( maskOver&bit ) or ( mask&bit ):
+				continue
+			rateOnes = sum( rates[identifier] for identifier in identifiers if identifier&bit )
+			# The side with fewer scanners may be either value of the bit:
+			for oneSideSmaller in (True, False):
+				if oneSideSmaller:
+					error = abs( rateOnes-targetRate )
+				else:
+					error = abs( rate-rateOnes-targetRate )
+				if bestError is None or error<bestError:
+					bestError = error
+					bestBit = bit
+					bestOneSideSmaller = oneSideSmaller
+		if bestError is None:
+			raise ValueError( "Not enough identifier bits to share between %u scanners"%adaptersCount )
+		ones = [identifier for identifier in identifiers if identifier&bestBit]
+		zeros = [identifier for identifier in identifiers if not identifier&bestBit]
+		if bestOneSideSmaller:
+			split( mask|bestBit, maskingResult|bestBit, ones, countOnes )
+			split( mask|bestBit, maskingResult, zeros, countZeros )
+		else:
+			split( mask|bestBit, maskingResult, zeros, countOnes )
+			split( mask|bestBit, maskingResult|bestBit, ones, countZeros )
+	split( 0x00000000, 0x00000000, list( rates.keys() ), adaptersCount )
+	return plan
+
+class FilterSurvey():
+	"""
+	Inventory of the identifiers of a bus too busy for the serial link, by rotation of ELM327-side filters
+	The identifier space is split into partitions (by their most significant bits), installed in turn for a dwell time each.
+	The rate of an identifier is its count of frames divided by the monitoring time of its partition, so rates of all partitions are comparable.
+	Frames are counted by the frame handler thread, the rotation is driven by the capture thread.
+	"""
+	
+	maxPartitionBits = 12 # 4096 partitions
+	
+	def __init__( self, identifierBits, partitionBits, dwell, rounds ):
+		"""
+		Throws a ValueError if partitionBits is not between 0 and maxPartitionBits
+		"""
+		if partitionBits<0 or partitionBits>self.maxPartitionBits:
+			raise ValueError( "The count of partition bits must be between 0 and %u"%(self.maxPartitionBits,) )
+		partitionBits = min( partitionBits, identifierBits )
+		self.identifierBits = identifierBits
+		self.partitionBits = partitionBits
+		self.shift = identifierBits-partitionBits
+		self.mask = ( ( 1<<partitionBits )-1 )<<self.shift
+		self.partitionsCount = 1<<partitionBits
+		self.dwell = dwell
+		self.rounds = rounds
+		self.lock = Lock()
+		self.index = 0 # partition to monitor
+		self.round = 0
+		self.finished = False
+		self.monitoredIndex = None # partition installed during the current monitoring
+		self.monitoringSince = None
+		self.visitTime = 0. # monitoring time of the current visit of the partition
+		self.monitoringTime = [0.]*self.partitionsCount # cumulative monitoring time of each partition
+		self.bufferFullCount = [0]*self.partitionsCount
+		self.identifiers = {} # identifier: {"frames", "isExtended", "DLC", "data", "time"}
+	
+	def getFilter( self ):
+		""" Get the mask & masking result of the partition to monitor """
+		return (self.mask, self.index<<self.shift)
+	
+	def getPartition( self, identifier ):
+		return ( identifier>>self.shift )&( self.partitionsCount-1 )
+	
+	def countFrames( self, frames ):
+		""" Record received frames (frame handler thread) """
+		with self.lock:
+			identifiers = self.identifiers
+			for frame in frames:
+				entry = identifiers.get( frame.identifier )
+				if entry is None:
+					entry = {"frames": 0}
+					identifiers[frame.identifier] = entry
+				entry["frames"] += 1
+				entry["isExtended"] = frame.isExtended
+				entry["DLC"] = frame.DLC
+				entry["data"] = frame.data
+				entry["time"] = frame.time
+	
+	def resume( self, now ):
+		""" Note that monitoring started with the partition to monitor """
+		self.monitoredIndex = self.index
+		self.monitoringSince = now
+	
+	def pause( self, now, reason=None ):
+		""" Note that monitoring stopped (capture thread, or thread stopping the survey) """
+		with self.lock:
+			monitoringSince = self.monitoringSince
+			if monitoringSince is None:
+				return
+			self.monitoringSince = None
+			duration = now-monitoringSince
+			monitoredIndex = self.monitoredIndex
+			self.monitoringTime[monitoredIndex] += duration
+			if reason=="BUFFER FULL":
+				self.bufferFullCount[monitoredIndex] += 1
+			if monitoredIndex==self.index:
+				self.visitTime += duration
+	
+	def isDwellOver( self, now ):
+		monitoringSince = self.monitoringSince
+		if monitoringSince is None or self.monitoredIndex!=self.index:
+			return False
+		return self.visitTime+now-monitoringSince>=self.dwell
+	
+	def next( self ):
+		""" Select the next partition to monitor, return False if the survey is finished """
+		self.visitTime = 0.
+		self.index += 1
+		if self.index>=self.partitionsCount:
+			self.index = 0
+			self.round += 1
+			if self.round>=self.rounds:
+				self.finished = True
+		return not self.finished
+	
+	def getTable( self ):
+		""" Get the table of surveyed identifiers, with their rates in frames per second """
+		with self.lock:
+			monitoringTime = list( self.monitoringTime )
+			table = []
+			for identifier in sorted( self.identifiers.keys() ):
+				entry = dict( self.identifiers[identifier] )
+				entry["identifier"] = identifier
+				partitionTime = monitoringTime[self.getPartition( identifier )]
+				entry["rate"] = ( partitionTime>0. ) and entry["frames"]/partitionTime or 0.
+				entry["data"] = bytes_hex( entry["data"] )
+				table.append( entry )
+		return table
+	
+	def getState( self ):
+		with self.lock:
+			return {
+				"finished": self.finished,
+				"round": self.round,
+				"rounds": self.rounds,
+				"partition": self.index,
+				"partitionsCount": self.partitionsCount,
+				"mask": self.mask,
+				"dwell": self.dwell,
+				"monitoringTime": list( self.monitoringTime ),
+				"bufferFull": list( self.bufferFullCount ),
+			}
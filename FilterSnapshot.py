@@ -0,0 +1,128 @@
+from bisect import bisect_right
+
+IDENTIFIERS_11_BIT = 0x800 # count of 11-bit identifiers, looked up in the table of a FilterSnapshot
+
+class IdentifierSet():
+	"""
+	Immutable set of CAN identifiers: explicit identifiers, ranges of identifiers & mask/maskingResult pairs
+	Identifiers are tested with the operator in. Ranges are merged into a sorted table, searched by bisection.
+	"""
+	
+	def __init__( self, identifiers=(), ranges=(), masks=() ):
+		"""
+		- identifiers: iterable of identifiers
+		- ranges: iterable of (first, last) identifiers, both included
+		- masks: iterable of (mask, maskingResult), for identifiers such as ( identifier&mask )==maskingResult
+		Throws a ValueError if a range is reversed
+		"""
+		self.identifiers = frozenset( identifiers )
+		mergedRanges = []
+		for first, last in sorted( ranges ):
+			if first>last:
+				raise ValueError( "Reversed range of identifiers: 0x%X-0x%X"%(first, last) )
+			if mergedRanges and first<=mergedRanges[-1][1]+1:
+				mergedRanges[-1][1] = max( mergedRanges[-1][1], last )
+			else:
+				mergedRanges.append( [first, last] )
+		self.ranges = tuple( (first, last) for first, last in mergedRanges )
+		self.rangeFirsts = tuple( first for first, last in mergedRanges )
+		self.rangeLasts = tuple( last for first, last in mergedRanges )
+		self.masks = tuple( (mask, maskingResult) for mask, maskingResult in masks )
+		# Object for the operator in: the frozenset itself (C-level lookup) when there are only explicit identifiers
+		if self.ranges or self.masks:
+			self.lookup = self
+		else:
+			self.lookup = self.identifiers
+	
+	@classmethod
+	def build( cls, identifiers, ranges=(), masks=() ):
+		"""
+		Get an IdentifierSet, or None if identifiers is None without ranges nor masks
+		identifiers can already be an IdentifierSet, then ranges & masks must be empty.
+		"""
+		if isinstance( identifiers, cls ) and not ranges and not masks:
+			return identifiers
+		if identifiers is None:
+			if not ranges and not masks:
+				return None
+			identifiers = ()
+		return cls( identifiers, ranges, masks )
+	
+	def __contains__( self, identifier ):
+		if identifier in self.identifiers:
+			return True
+		rangeFirsts = self.rangeFirsts
+		if rangeFirsts:
+			index = bisect_right( rangeFirsts, identifier )-1
+			if index>=0 and identifier<=self.rangeLasts[index]:
+				return True
+		for mask, maskingResult in self.masks:
+			if ( identifier&mask )==maskingResult:
+				return True
+		return False
+	
+	def getCommonBits( self, maskOver=0x1FFFFFFF ):
+		""" Get (bits set in all identifiers, bits cleared in all identifiers) within maskOver """
+		allSet = maskOver
+		allCleared = maskOver
+		for identifier in self.identifiers:
+			allSet &= identifier
+			allCleared &= ~identifier
+		for first, last in self.ranges:
+			varying = ( 1<<( first^last ).bit_length() )-1
+			allSet &= first&~varying
+			allCleared &= ~first&~varying
+		for mask, maskingResult in self.masks:
+			allSet &= maskingResult&mask
+			allCleared &= ~maskingResult&mask
+		return (allSet, allCleared)
+	
+	def getState( self ):
+		return {
+			"identifiers": sorted( self.identifiers ),
+			"ranges": [[first, last] for first, last in self.ranges],
+			"masks": [[mask, maskingResult] for mask, maskingResult in self.masks],
+		}
+
+class FilterSnapshot():
+	"""
+	Immutable compiled filters: ELM327-side filter (mask, maskingResult), whitelist & blacklist (IdentifierSet or None)
+	The result of all filters for the 11-bit identifiers is stored in a table (1 byte per identifier), others go through the filters.
+	A snapshot is replaced by a new one with the next version when filters change, so it is read without any lock.
+	"""
+	
+	def __init__( self, mask=0x00000000, maskingResult=0x00000000, whitelist=None, blacklist=None, version=0 ):
+		self.mask = mask
+		self.maskingResult = maskingResult
+		self.whitelist = whitelist
+		self.blacklist = blacklist
+		self.version = version
+		self.whitelistLookup = None if whitelist is None else whitelist.lookup
+		self.blacklistLookup = None if blacklist is None else blacklist.lookup
+		self.table11 = bytes( self.passesFilters( identifier ) and 1 or 0 for identifier in range( IDENTIFIERS_11_BIT ) )
+	
+	def passesFilters( self, identifier ):
+		""" Indicates if a frame with the given identifier passes the filters, without the table """
+		if ( identifier&self.mask )!=self.maskingResult:
+			return False
+		whitelistLookup = self.whitelistLookup
+		if ( whitelistLookup is not None ) and ( identifier not in whitelistLookup ):
+			return False
+		blacklistLookup = self.blacklistLookup
+		if ( blacklistLookup is not None ) and ( identifier in blacklistLookup ):
+			return False
+		return True
+	
+	def passes( self, identifier ):
+		""" Indicates if a frame with the given identifier passes the filters """
+		if identifier<IDENTIFIERS_11_BIT:
+			return self.table11[identifier]==1
+		if ( identifier&self.mask )!=self.maskingResult:
+			return False
+		whitelistLookup = self.whitelistLookup
+		if ( whitelistLookup is not None ) and ( identifier not in whitelistLookup ):
+			return False
+		blacklistLookup = self.blacklistLookup
+		if ( blacklistLookup is not None ) and ( identifier in blacklistLookup ):
+			return False
+		return True
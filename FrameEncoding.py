@@ -0,0 +1,112 @@
+from struct import Struct
+from utility import simpleDictionaryToJSON
+from utility import bytes_hex
+
+pcapRecordHeader = Struct( ">IIII" ) # ts_sec, ts_usec, incl_len, orig_len
+pcapContentHeader = Struct( ">IB3x" ) # CAN ID and flags, payload length, reserved
+canEthHeader = b"ISO11898\x01\x01" # MagicId, Version, Cnt
+canEthIdentifier = Struct( "<IB" ) # Id, DLC
+
+def jsonFields( fields ):
+	""" Encode a dict object (bytes keys) into JSON members, to be appended to the members of a message of simpleDictionaryToJSON() """
+	return b",\n"+simpleDictionaryToJSON( fields )[2:-2]
+
+class PayloadEncodings():
+	"""
+	Encodings of the portion of a frame that does not depend on its time: (identifier, isExtended, isRTR, DLC, data)
+	Each encoding is built on first use, then shared by every frame with the same key & by every output.
+	"""
+	__slots__ = ("key", "_json", "_canEthPacket", "_pcapContent")
+	
+	def __init__( self, key ):
+		self.key = key
+		self._json = None
+		self._canEthPacket = None
+		self._pcapContent = None
+	
+	def json( self ):
+		""" JSON members of the frame for WebSocket_frames, after the time member """
+		json = self._json
+		if json is None:
+			identifier, isExtended, isRTR, DLC, data = self.key
+			json = jsonFields( {
+				b"i": identifier,
+				b"e": isExtended,
+				b"r": isRTR,
+				b"l": DLC,
+				b"d": bytes_hex( data ),
+			} )
+			self._json = json
+		return json
+	
+	def canEthPacket( self ):
+		""" Same bytes as CANToNetwork.canEthPacket """
+		packet = self._canEthPacket
+		if packet is None:
+			identifier, isExtended, isRTR, DLC, data = self.key
+			packet = canEthHeader+canEthIdentifier.pack( identifier, DLC )+data.ljust( 8, b"\x00" )+bytes( (isExtended and 1 or 0, isRTR and 1 or 0) )
+			self._canEthPacket = packet
+		return packet
+	
+	def pcapContent( self ):
+		""" LINKTYPE_CAN_SOCKETCAN content, same bytes as CANToNetwork.pcaprec_CAN without its record header """
+		content = self._pcapContent
+		if content is None:
+			identifier, isExtended, isRTR, DLC, data = self.key
+			canFlagsId = identifier
+			if isRTR:
+				canFlagsId |= 0x40000000
+			if isExtended:
+				canFlagsId |= 0x80000000
+			content = pcapContentHeader.pack( canFlagsId, DLC )+data
+			self._pcapContent = content
+		return content
+
+class FrameEncoder():
+	"""
+	Serialization of CAN frames for the outputs (WebSocket JSON, CAN-ETH, libpcap), shared by all of them
+	The encodings of the last payload of each identifier are cached, so periodic frames with an unchanged payload
+	only cost the encoding of their time. The cache is used by several threads without lock:
+	entries are replaced, never modified, and concurrent builds of an encoding give the same bytes.
+	"""
+	
+	def __init__( self, maxIdentifiers=65536 ):
+		"""
+		- maxIdentifiers: count of cached identifiers, the cache is emptied when reached
+		"""
+		self.maxIdentifiers = maxIdentifiers
+		self.payloads = {} # identifier: PayloadEncodings of the last payload
+	
+	def getPayload( self, frame ):
+		""" Get the PayloadEncodings of a CANFrame """
+		key = frame[:5]
+		payload = self.payloads.get( key[0] )
+		if payload is None or payload.key!=key:
+			payloads = self.payloads
+			if len( payloads )>=self.maxIdentifiers:
+				payloads.clear()
+			payload = PayloadEncodings( key )
+			payloads[key[0]] = payload
+		return payload
+	
+	def json( self, frame, extraFields=b"" ):
+		""" Get the JSON message of a frame, same bytes as simpleDictionaryToJSON() with the members t, i, e, r, l, d
+		extraFields: JSON members appended to the message, from jsonFields() """
+		return b'{\n"t":'+str( frame.time ).encode( "ascii" )+self.getPayload( frame ).json()+extraFields+b"\n}"
+	
+	def canEthPacket( self, frame ):
+		""" Get the CAN-ETH packet of a frame """
+		return self.getPayload( frame ).canEthPacket()
+	
+	def pcapContent( self, frame ):
+		""" Get the LINKTYPE_CAN_SOCKETCAN content of a frame """
+		return self.getPayload( frame ).pcapContent()
+	
+	def pcapRecord( self, frame ):
+		""" Get the libpcap record of a frame, same bytes as a pcaprec_CAN """
+		content = self.getPayload( frame ).pcapContent()
+		frameTimeUs = frame.timeNs//1000
+		contentLen = len( content )
+		return pcapRecordHeader.pack( frameTimeUs//1000000, frameTimeUs%1000000, contentLen, contentLen )+content
+
+frameEncoder = FrameEncoder() # shared by all the outputs
@@ -0,0 +1,70 @@
+import os
+
+from json import dumps as json_dumps
+from json import loads as json_loads
+from threading import Lock
+from utility import printT
+
+class LinkStateCache():
+	"""
+	Persistent state of the links negotiated with ELM327 scanners, for each serial port (JSON file)
+	It remembers what worked last time (baud rate, CAN bus found with ATDP...) so that reconnecting tries it first.
+	The file is rewritten atomically, so a crash never leaves it half-written.
+	"""
+	
+	def __init__( self, filename ):
+		self.filename = filename
+		self.lock = Lock()
+		self.states = {}
+		try:
+			with open( filename, "r", encoding="utf_8" ) as f:
+				states = json_loads( f.read() )
+			if type( states ) is dict:
+				self.states = states
+		except FileNotFoundError:
+			pass
+		except ValueError:
+			printT( "Ignored the corrupted link state cache file "+filename )
+	
+	def get( self, serialPort ):
+		""" Return a copy of the link state of a serial port, or None if unknown """
+		with self.lock:
+			state = self.states.get( serialPort )
+			if state is not None:
+				state = dict( state )
+			return state
+	
+	def update( self, serialPort, **values ):
+		""" Update some values of the link state of a serial port and save the file """
+		with self.lock:
+			state = self.states.get( serialPort )
+			if state is None:
+				state = {}
+				self.states[serialPort] = state
+			state.update( values )
+			self.save()
+	
+	def forget( self, serialPort, *keys ):
+		""" Drop some values (all if no keys given) of the link state of a serial port (it did not work) and save the file """
+		with self.lock:
+			if not keys:
+				if self.states.pop( serialPort, None ) is not None:
+					self.save()
+				return
+			state = self.states.get( serialPort )
+			if state is not None:
+				changed = False
+				for key in keys:
+					if state.pop( key, None ) is not None:
+						changed = True
+				if changed:
+					self.save()
+	
+	def save( self ):
+		temporaryFilename = self.filename+".tmp"
+		try:
+			with open( temporaryFilename, "w", encoding="utf_8" ) as f:
+				f.write( json_dumps( self.states, indent="\t", sort_keys=True ) )
+			os.replace( temporaryFilename, self.filename )
+		except OSError as e:
+			printT( "Could not save the link state cache file:", e )
@@ -0,0 +1,119 @@
+class OBDPollingScheduler():
+	"""
+	Scheduler of OBD requests interleaved with ATMA monitoring
+	Each request (hexadecimal like b"010C") has a target refresh rate. Due requests are sent in batches, each batch leaving ATMA once.
+	The time out of ATMA (blind time) is paid from a token bucket filled at blindTimeBudget (fraction of time), up to maxBatchDuration.
+	A batch is sent when the bucket can pay for leaving ATMA and at least 1 request, with as many due requests as it can pay for.
+	When the budget is tight, the bucket fills up while requests are waiting, so batches get larger and the cost of leaving ATMA is shared.
+	Durations of requests and of leaving ATMA are measured (moving averages).
+	"""
+	
+	smoothing = 0.2 # weight of the newest measurement in moving averages
+	
+	def __init__( self, blindTimeBudget, maxBatchDuration ):
+		self.blindTimeBudget = blindTimeBudget
+		self.maxBatchDuration = maxBatchDuration
+		self.entries = {} # request: {"period", "nextDue", ...}
+		self.nextDue = None # earliest nextDue of entries
+		self.tokens = 0. # blind time that can be spent (seconds)
+		self.lastRefill = None
+		self.requestDuration = 0.05 # measured time of a request
+		self.overheadDuration = 0.02 # measured time of leaving & resuming ATMA, without requests
+		self.batchesCount = 0
+		self.blindTimeTotal = 0.
+		self.startedAt = None
+	
+	def setRequests( self, requests, now ):
+		"""
+		Replace the polled requests, keeping the statistics of the remaining ones
+		- requests: {request: target refresh rate in Hz}
+		"""
+		entries = {}
+		for request, rate in requests.items():
+			entry = self.entries.get( request )
+			if entry is None:
+				entry = {
+					"nextDue": now,
+					"responses": 0,
+					"failures": 0,
+					"lastResponse": None,
+					"interval": None, # average time between answers
+				}
+			entry["period"] = 1./rate
+			entry["targetRate"] = rate
+			entries[request] = entry
+		self.entries = entries
+		self.updateNextDue()
+		if self.startedAt is None:
+			self.startedAt = now
+			self.lastRefill = now
+	
+	def updateNextDue( self ):
+		self.nextDue = min( ( entry["nextDue"] for entry in self.entries.values() ), default=None )
+	
+	def refill( self, now ):
+		if self.lastRefill is not None:
+			self.tokens = min( self.maxBatchDuration, self.tokens+( now-self.lastRefill )*self.blindTimeBudget )
+		self.lastRefill = now
+	
+	def planBatch( self, now ):
+		""" Return the requests to send now (most late in periods first), or None """
+		nextDue = self.nextDue
+		if nextDue is None or now<nextDue:
+			return None
+		self.refill( now )
+		affordable = int( ( self.tokens-self.overheadDuration )/self.requestDuration )
+		if affordable<1:
+			if self.tokens<self.maxBatchDuration:
+				return None
+			affordable = 1 # a single request exceeds maxBatchDuration: still polled when the bucket is full
+		# When the budget is short, refresh rates are reduced in proportion to their targets:
+		due = [(( entry["nextDue"]-now )/entry["period"], request) for request, entry in self.entries.items() if entry["nextDue"]<=now]
+		due.sort()
+		return [request for lateness, request in due[:affordable]]
+	
+	def requestDone( self, request, now, duration, success ):
+		""" Note the result of a request of a batch """
+		self.requestDuration += self.smoothing*( duration-self.requestDuration )
+		entry = self.entries.get( request )
+		if entry is None:
+			return # removed meanwhile
+		if success:
+			entry["responses"] += 1
+			lastResponse = entry["lastResponse"]
+			if lastResponse is not None:
+				if entry["interval"] is None:
+					entry["interval"] = now-lastResponse
+				else:
+					entry["interval"] += self.smoothing*( now-lastResponse-entry["interval"] )
+			entry["lastResponse"] = now
+		else:
+			entry["failures"] += 1
+		# No burst to catch up if late:
+		entry["nextDue"] = max( entry["nextDue"]+entry["period"], now )
+		self.updateNextDue()
+	
+	def batchDone( self, blindTime, requestsDuration ):
+		""" Pay for a batch, once monitoring has resumed """
+		self.tokens -= blindTime
+		self.overheadDuration += self.smoothing*( max( 0., blindTime-requestsDuration )-self.overheadDuration )
+		self.batchesCount += 1
+		self.blindTimeTotal += blindTime
+	
+	def getState( self, now ):
+		elapsed = ( self.startedAt is not None ) and now-self.startedAt or 0.
+		return {
+			"blindTimeBudget": self.blindTimeBudget,
+			"blindTimeRatio": ( elapsed>0. ) and self.blindTimeTotal/elapsed or 0.,
+			"maxBatchDuration": self.maxBatchDuration,
+			"batches": self.batchesCount,
+			"requestDuration": self.requestDuration,
+			"overheadDuration": self.overheadDuration,
+			"requests": [{
+				"request": request.decode( "ascii" ),
+				"targetRate": entry["targetRate"],
+				"rate": ( entry["interval"] ) and 1./entry["interval"] or 0.,
+				"responses": entry["responses"],
+				"failures": entry["failures"],
+			} for request, entry in self.entries.items()],
+		}
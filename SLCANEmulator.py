@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+# SLCAN (Lawicel) adapter emulator on a pseudo-terminal (Linux), to run and load-test the SLCAN capture without any adapter
+# Usage: SLCANEmulator.py [--link=<path>] [--frameRate=<frames/s>] [--identifiers=<count or list like 7E8:10,123:100>]
+#        [--extended=<0 or 1>] [--linkRate=<b/s>] [--bufferSize=<bytes>] [--seed=<integer>]
+# The capture is pointed to the emulator with the parameter serialPort.
+
+import threading
+import select
+import os
+
+from time import sleep
+from time import perf_counter
+from random import Random
+from bisect import bisect_right
+from collections import deque
+from binascii import hexlify
+from utility import printT
+
+class SLCANEmulator( threading.Thread ):
+	"""
+	Emulated SLCAN adapter on the slave side of a pseudo-terminal, generating CAN traffic while the CAN channel is open
+	The output is paced at linkRate like a USB-serial adapter: when the CAN traffic exceeds it, the internal buffer fills up
+	and frames are dropped, reported by the data overrun flag of the F command.
+	"""
+	
+	daemon = True
+	version = b"V1013"
+	
+	def __init__( self, frameRate=2000., identifiers=60, extended=False, linkRate=1000000, bufferSize=4096, seed=327 ):
+		"""
+		- frameRate: frames per second on the CAN bus
+		- identifiers: count of random identifiers, or dict {identifier: relative frequency}
+		- extended: generate 29-bit identifiers instead of 11-bit ones
+		- linkRate: speed of the serial link in b/s (10 bits per byte)
+		- bufferSize: size in bytes of the output buffer of the adapter
+		"""
+		threading.Thread.__init__( self )
+		self.name = "SLCANEmulator"
+		self.frameRate = frameRate
+		self.extended = extended
+		self.linkRate = linkRate
+		self.bufferSize = bufferSize
+		self.random = Random( seed )
+		self.master, self.slave = os.openpty()
+		import tty
+		tty.setraw( self.slave )
+		self.port = os.ttyname( self.slave )
+		self.stats = {
+			"commands": 0,
+			"generatedFrames": 0,
+			"sentFrames": 0,
+			"droppedFrames": 0,
+			"transmittedFrames": 0,
+		}
+		self.transmittedFrames = deque( maxlen=1024 ) # (identifier, data) sent on the bus
+		self.bitRateCommand = None
+		self.isOpen = False
+		self.listenOnly = False
+		self.timestamps = False
+		self.overrun = False
+		# Periods between 10 ms & 1 s, log-uniform like on real buses
+		random = Random( "%s-%u"%(seed, extended) )
+		if type( identifiers ) is dict:
+			frequencies = identifiers
+		else:
+			frequencies = {}
+			while len( frequencies )<identifiers:
+				frequencies[random.randrange( extended and 0x20000000 or 0x800 )] = 1./( 10.**random.uniform( -2., 0. ) )
+		self.busIdentifiers = list( frequencies.keys() )
+		self.busPayloads = [bytearray( random.randrange( 256 ) for i in range( 8 ) ) for identifier in self.busIdentifiers]
+		cumulative = 0.
+		self.busCumulativeWeights = []
+		for identifier in self.busIdentifiers:
+			cumulative += frequencies[identifier]
+			self.busCumulativeWeights.append( cumulative )
+	
+	def nextFrame( self, timestamp ):
+		""" Generate the record of the next frame of the bus, with the given timestamp in milliseconds """
+		random = self.random
+		index = bisect_right( self.busCumulativeWeights, random.random()*self.busCumulativeWeights[-1] )
+		index = min( index, len( self.busIdentifiers )-1 )
+		identifier = self.busIdentifiers[index]
+		payload = self.busPayloads[index]
+		payload[7] = ( payload[7]+1 )&0xFF # counter
+		self.stats["generatedFrames"] += 1
+		if identifier>0x7FF:
+			record = "T%.8X8"%(identifier,)
+		else:
+			record = "t%.3X8"%(identifier,)
+		record = record.encode( "ascii" )+hexlify( payload ).upper()
+		if self.timestamps:
+			record += ( "%.4X"%(timestamp%60000,) ).encode( "ascii" )
+		return record+b"\x0D"
+	
+	def handleCommand( self, command ):
+		""" Execute a command, return its reply """
+		self.stats["commands"] += 1
+		kind = command[:1]
+		if kind in (b"t", b"T"):
+			if not self.isOpen or self.listenOnly:
+				return b"\x07"
+			try:
+				headerLength = ( kind==b"T" ) and 9 or 4
+				identifier = int( command[1:headerLength], 16 )
+				length = int( command[headerLength:headerLength+1] )
+				data = bytes.fromhex( command[headerLength+1:].decode( "ascii" ) )
+				if length!=len( data ) or length>8:
+					raise ValueError()
+			except ValueError:
+				return b"\x07"
+			self.transmittedFrames.append( (identifier, data) )
+			self.stats["transmittedFrames"] += 1
+			return ( kind==b"T" ) and b"Z\x0D" or b"z\x0D"
+		elif kind==b"V":
+			return self.version+b"\x0D"
+		elif kind==b"N":
+			return b"NA327\x0D"
+		elif kind==b"F":
+			flags = self.overrun and 0x08 or 0x00
+			self.overrun = False
+			return ( "F%.2X\x0D"%(flags,) ).encode( "ascii" )
+		elif self.isOpen:
+			if command==b"C":
+				self.isOpen = False
+				return b"\x0D"
+			return b"\x07" # settings only while closed
+		elif kind==b"S" and len( command )==2 and b"0"<=command[1:]<=b"8":
+			self.bitRateCommand = command
+			return b"\x0D"
+		elif command in (b"Z0", b"Z1"):
+			self.timestamps = ( command==b"Z1" )
+			return b"\x0D"
+		elif command in (b"O", b"L"):
+			if self.bitRateCommand is None:
+				return b"\x07"
+			self.isOpen = True
+			self.listenOnly = ( command==b"L" )
+			return b"\x0D"
+		return b"\x07"
+	
+	def run( self ):
+		pending = bytearray()
+		buffered = bytearray() # generated but not sent yet
+		sentUntil = perf_counter() # time until which the serial link is busy
+		openedAt = None
+		generatedCount = 0
+		while True:
+			if select.select( (self.master,), (), (), 0.001 )[0]:
+				pending.extend( os.read( self.master, 4096 ) )
+				while b"\x0D" in pending:
+					end = pending.index( b"\x0D" )
+					command = bytes( pending[:end] )
+					del pending[:end+1]
+					if command:
+						buffered.extend( self.handleCommand( command ) )
+					else:
+						buffered.extend( b"\x0D" )
+			now = perf_counter()
+			if not self.isOpen:
+				openedAt = None
+			else:
+				if openedAt is None:
+					openedAt = now
+					generatedCount = 0
+				dueCount = int( ( now-openedAt )*self.frameRate )
+				if dueCount-generatedCount>self.frameRate:
+					generatedCount = dueCount-int( self.frameRate ) # emulator too slow: skip over 1 s of traffic
+				while generatedCount<dueCount:
+					record = self.nextFrame( int( ( openedAt+generatedCount/self.frameRate )*1000 ) )
+					generatedCount += 1
+					if len( buffered )+len( record )>self.bufferSize:
+						self.overrun = True
+						self.stats["droppedFrames"] += 1
+					else:
+						buffered.extend( record )
+						self.stats["sentFrames"] += 1
+			# Send what the serial link allows:
+			byteRate = self.linkRate/10.
+			if sentUntil<now-0.001:
+				sentUntil = now-0.001 # no credit accumulated while idle
+			sendCount = min( len( buffered ), int( ( now-sentUntil )*byteRate ) )
+			if sendCount:
+				os.write( self.master, bytes( buffered[:sendCount] ) )
+				del buffered[:sendCount]
+				sentUntil += sendCount/byteRate
+	
+	def getStats( self ):
+		return dict( self.stats )
+
+if __name__=="__main__":
+	from sys import argv
+	options = {}
+	for argument in argv[1:]:
+		if argument[:2]=="--" and "=" in argument:
+			name, value = argument[2:].split( "=", 1 )
+			options[name] = value
+	identifiers = options.get( "identifiers", "60" )
+	if ":" in identifiers:
+		identifiers = {int( identifier, 16 ): float( frequency ) for identifier, frequency in ( pair.split( ":" ) for pair in identifiers.split( "," ) )}
+	else:
+		identifiers = int( identifiers )
+	emulator = SLCANEmulator(
+		frameRate=float( options.get( "frameRate", 2000 ) ),
+		identifiers=identifiers,
+		extended=options.get( "extended", "0" )=="1",
+		linkRate=int( options.get( "linkRate", 1000000 ) ),
+		bufferSize=int( options.get( "bufferSize", 4096 ) ),
+		seed=int( options.get( "seed", 327 ) ),
+	)
+	link = options.get( "link" )
+	if link is not None:
+		if os.path.lexists( link ):
+			os.remove( link )
+		os.symlink( emulator.port, link )
+	printT( "SLCAN emulator on "+emulator.port+( link and " ("+link+")" or "" ) )
+	emulator.start()
+	try:
+		while True:
+			sleep( 5 )
+			printT( emulator.getStats() )
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if link is not None and os.path.islink( link ):
+			os.remove( link )
@@ -0,0 +1,351 @@
+import threading
+import select
+import os
+import struct
+
+from bisect import bisect_left
+from collections import deque
+from time import perf_counter
+from serial import SerialException
+from utility import printT
+from utility import timeNs
+
+TIOCGICOUNT = 0x545D # ioctl reading the error counters of a serial port driver (Linux)
+
+class SerialRingBuffer():
+	"""
+	Preallocated ring buffer of bytes received from a serial port
+	There must be 1 writer thread and 1 reader thread.
+	When the buffer is full, new bytes are dropped (like an overflowing UART) and counted.
+	"""
+	
+	def __init__( self, size ):
+		self.size = size
+		self.buffer = bytearray( size )
+		self.condition = threading.Condition( threading.Lock() )
+		self.writtenCount = 0 # total count of bytes written
+		self.readCount = 0 # total count of bytes read
+		self.error = None # exception of the writer, raised to the reader once the buffer is empty
+		self.anchors = deque() # (writtenCount, arrival time in ns) at the end of each write
+		self.readAnchors = [] # (offset, arrival time in ns) at the end of each chunk in the last read data
+		# Statistics:
+		self.highWaterMark = 0 # highest filling in bytes
+		self.overflowBytes = 0 # dropped bytes
+		self.overflowEvents = 0 # writes that dropped bytes
+	
+	@property
+	def in_waiting( self ):
+		return self.writtenCount-self.readCount
+	
+	def write( self, data, arrivalNs=None ):
+		""" Append received bytes (writer thread), optionally with their arrival time (ns) """
+		dataLen = len( data )
+		if not dataLen:
+			return
+		freeLen = self.size-( self.writtenCount-self.readCount )
+		if dataLen>freeLen:
+			self.overflowBytes += dataLen-freeLen
+			self.overflowEvents += 1
+			dataLen = freeLen
+			if not dataLen:
+				return
+		# The reader never goes beyond writtenCount so the copy is made unlocked.
+		buffer = self.buffer
+		start = self.writtenCount%self.size
+		firstLen = min( dataLen, self.size-start )
+		buffer[start:start+firstLen] = data[:firstLen]
+		if firstLen<dataLen:
+			buffer[0:dataLen-firstLen] = data[firstLen:dataLen]
+		with self.condition:
+			self.writtenCount += dataLen
+			if arrivalNs is not None:
+				self.anchors.append( (self.writtenCount, arrivalNs) )
+			fill = self.writtenCount-self.readCount
+			if fill>self.highWaterMark:
+				self.highWaterMark = fill
+			self.condition.notify()
+	
+	def setError( self, error ):
+		""" Transmit an exception of the writer thread to the reader thread """
+		with self.condition:
+			self.error = error
+			self.condition.notify()
+	
+	def read( self, minReadCount, timeout, idleTimeout=None ):
+		"""
+		Take out all awaiting bytes (reader thread)
+		The arrival times of the taken out bytes are put in readAnchors.
+		- minReadCount: wait for this number of bytes or a timeout (not a length guarantee)
+		- timeout: maximum waiting time in seconds, None for no limit
+		- idleTimeout: if nothing is received before timeout, keep waiting for the 1st byte up to this time (in seconds)
+		"""
+		with self.condition:
+			if ( self.writtenCount-self.readCount )<minReadCount and self.error is None:
+				self.condition.wait_for( lambda: ( self.writtenCount-self.readCount )>=minReadCount or self.error is not None, timeout )
+				if self.writtenCount==self.readCount and self.error is None \
+				and idleTimeout is not None and timeout is not None and idleTimeout>timeout:
+					self.condition.wait_for( lambda: self.writtenCount!=self.readCount or self.error is not None, idleTimeout-timeout )
+			dataLen = self.writtenCount-self.readCount
+			if not dataLen and self.error is not None:
+				raise self.error
+		if not dataLen:
+			self.readAnchors = []
+			return b""
+		# The writer never overwrites unread bytes so the copy is made unlocked.
+		buffer = self.buffer
+		readCount = self.readCount
+		start = readCount%self.size
+		firstLen = min( dataLen, self.size-start )
+		if firstLen<dataLen:
+			data = buffer[start:self.size]+buffer[0:dataLen-firstLen]
+		else:
+			data = buffer[start:start+dataLen]
+		readAnchors = []
+		with self.condition:
+			self.readCount += dataLen
+			anchors = self.anchors
+			while anchors and anchors[0][0]<=self.readCount:
+				anchorCount, arrivalNs = anchors.popleft()
+				readAnchors.append( (anchorCount-readCount, arrivalNs) )
+		self.readAnchors = readAnchors
+		return bytes( data )
+	
+	def clear( self ):
+		""" Drop all awaiting bytes (reader thread) """
+		with self.condition:
+			self.readCount = self.writtenCount
+			self.anchors.clear()
+	
+	def getStats( self ):
+		with self.condition:
+			return {
+				"size": self.size,
+				"fill": self.writtenCount-self.readCount,
+				"highWaterMark": self.highWaterMark,
+				"overflowBytes": self.overflowBytes,
+				"overflowEvents": self.overflowEvents,
+				"receivedBytes": self.writtenCount,
+			}
+
+def getSerialErrorCounters( ser ):
+	""" Get the error counters of the serial port driver (Linux), None if not available (like USB adapters without them) """
+	try:
+		import fcntl
+		counters = struct.unpack( "20i", fcntl.ioctl( ser.fileno(), TIOCGICOUNT, bytes( 80 ) ) )
+	except (ImportError, AttributeError, OSError, ValueError, SerialException):
+		return None
+	return {
+		"receivedBytes": counters[4],
+		"frame": counters[6],
+		"overrun": counters[7], # bytes lost by the UART (FIFO full)
+		"parity": counters[8],
+		"bufferOverrun": counters[10], # bytes lost by the driver (buffer full)
+	}
+
+def setThreadRealTime( cpu=None, priority=None ):
+	"""
+	Pin the calling thread to a CPU and raise its scheduling priority where permitted (Linux)
+	- cpu: CPU to pin the thread to, None for the last one allowed
+	- priority: SCHED_FIFO priority (1-99, needs CAP_SYS_NICE), the nice value is lowered instead if not permitted
+	Return the applied settings and the errors
+	"""
+	state = {"cpu": None, "policy": "other", "priority": None, "nice": None, "errors": []}
+	if not hasattr( os, "sched_setaffinity" ):
+		state["errors"].append( "CPU affinity is not supported on this system" )
+		return state
+	# Note: on Linux, pid 0 is the calling thread.
+	try:
+		if cpu is None:
+			cpu = max( os.sched_getaffinity( 0 ) )
+		os.sched_setaffinity( 0, {cpu} )
+		state["cpu"] = cpu
+	except (OSError, ValueError) as e:
+		state["errors"].append( "sched_setaffinity: %s"%(e,) )
+	if priority is not None:
+		try:
+			os.sched_setscheduler( 0, os.SCHED_FIFO, os.sched_param( priority ) )
+			state["policy"] = "fifo"
+			state["priority"] = priority
+		except (OSError, ValueError) as e:
+			state["errors"].append( "sched_setscheduler: %s"%(e,) )
+			try:
+				os.setpriority( os.PRIO_PROCESS, 0, -10 )
+				state["nice"] = -10
+			except OSError as e:
+				state["errors"].append( "setpriority: %s"%(e,) )
+	return state
+
+class SerialLatencyStats():
+	"""
+	Scheduling latency of the serial reader thread, estimated from each read operation
+	The bytes returned by a read have waited in the OS buffer, the oldest one for about (count-1) byte times.
+	Normally a single byte is returned: more bytes mean that the thread was not running when they arrived.
+	"""
+	
+	bucketLimits = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1) # seconds
+	
+	def __init__( self ):
+		self.count = 0
+		self.total = 0.
+		self.max = 0.
+		self.histogram = [0]*( len( self.bucketLimits )+1 )
+	
+	def record( self, latency ):
+		self.count += 1
+		self.total += latency
+		if latency>self.max:
+			self.max = latency
+		self.histogram[bisect_left( self.bucketLimits, latency )] += 1
+	
+	def getStats( self ):
+		histogram = list( self.histogram )
+		return {
+			"count": self.count,
+			"average": ( self.count>0 ) and self.total/self.count or 0.,
+			"max": self.max,
+			"histogram": [{"upTo": ( i<len( self.bucketLimits ) ) and self.bucketLimits[i] or None, "count": histogram[i]} for i in range( len( histogram ) )],
+		}
+
+class SerialReaderThread( threading.Thread ):
+	"""
+	Thread that only drains a serial port into a SerialRingBuffer
+	The serial port is read even while the consumer thread is busy, so the OS receive buffer does not overflow.
+	The consumer thread keeps writing to the serial port directly.
+	The scheduling latency of the thread is measured, and errors of the driver are counted from the start when available.
+	"""
+	
+	daemon = True
+	ioTimeout = 0.1 # how often the thread checks if it must stop
+	
+	def __init__( self, ser, ring, epollInput=None, realTime=None ):
+		"""
+		- realTime: None, or {"cpu", "priority"} for the real-time mode (see setThreadRealTime())
+		"""
+		threading.Thread.__init__( self )
+		self.name = "SerialReaderThread "+str( ser.port )
+		self.ser = ser
+		self.ring = ring
+		self.epollInput = epollInput # SerialEpollInput of the serial port, if enabled
+		self.stopping = False
+		self.realTime = realTime
+		self.realTimeState = None # settings applied by the real-time mode
+		self.latencyStats = SerialLatencyStats()
+		self.errorCountersInitial = getSerialErrorCounters( ser )
+	
+	def stop( self ):
+		""" Stop reading (the serial port can be closed afterwards) """
+		self.stopping = True
+		if self.is_alive() and self is not threading.current_thread():
+			self.join()
+	
+	def getErrorCounters( self ):
+		""" Get the errors counted by the driver since the start of the thread, None if not available """
+		initial = self.errorCountersInitial
+		counters = getSerialErrorCounters( self.ser )
+		if initial is None or counters is None:
+			return None
+		return {name: counters[name]-initial[name] for name in counters}
+	
+	def run( self ):
+		ser = self.ser
+		ring = self.ring
+		epollInput = self.epollInput
+		ser.timeout = self.ioTimeout
+		if self.realTime is not None:
+			self.realTimeState = setThreadRealTime( self.realTime.get( "cpu" ), self.realTime.get( "priority" ) )
+			for error in self.realTimeState["errors"]:
+				printT( "Real-time mode of the serial reader thread:", error )
+		recordLatency = self.latencyStats.record
+		try:
+			if epollInput is not None:
+				while not self.stopping:
+					data = epollInput.read( 1, self.ioTimeout )
+					if data:
+						recordLatency( ( len( data )-1 )*10./ser.baudrate ) # 10 bits per byte
+					ring.write( data, timeNs() )
+			else:
+				while not self.stopping:
+					data = ser.read( max( 1, ser.in_waiting ) )
+					if data:
+						recordLatency( ( len( data )-1 )*10./ser.baudrate ) # 10 bits per byte
+					ring.write( data, timeNs() )
+		except Exception as e:
+			if not self.stopping:
+				printT( "SerialReaderThread error:", repr( e ) )
+				ring.setError( e )
+
+class SerialEpollInput():
+	"""
+	Linux backend reading a serial port: waits with epoll and reads into a preallocated buffer
+	The serial port remains opened and configured by pySerial (baud rate, flush, write), only read operations are replaced.
+	Waiting happens in the kernel instead of polling, and received bytes are not allocated as new bytes objects.
+	"""
+	
+	bufferSize = 65536
+	
+	@staticmethod
+	def isSupported( ser ):
+		return hasattr( select, "epoll" ) and hasattr( os, "readv" ) and hasattr( ser, "fileno" )
+	
+	def __init__( self, ser ):
+		import fcntl
+		self.fd = ser.fileno()
+		fcntl.fcntl( self.fd, fcntl.F_SETFL, fcntl.fcntl( self.fd, fcntl.F_GETFL )|os.O_NONBLOCK )
+		self.epoll = select.epoll( 1 )
+		self.epoll.register( self.fd, select.EPOLLIN|select.EPOLLERR|select.EPOLLHUP )
+		self.buffer = bytearray( self.bufferSize )
+		self.bufferView = memoryview( self.buffer )
+	
+	def read( self, minReadCount, timeout, idleTimeout=None ):
+		"""
+		Read awaiting bytes into the preallocated buffer
+		- minReadCount: wait for this number of bytes or a timeout (not a length guarantee)
+		- timeout: maximum waiting time in seconds, None for no limit
+		- idleTimeout: if nothing is received before timeout, keep waiting for the 1st byte up to this time (in seconds)
+		Return a memoryview of the received bytes, only valid until the next call
+		Throws a SerialException if the device is disconnected
+		"""
+		fd = self.fd
+		bufferView = self.bufferView
+		bufferSize = self.bufferSize
+		minReadCount = min( minReadCount, bufferSize )
+		readCount = 0
+		deadline = None
+		ready = False # epoll reported the port ready
+		while True:
+			try:
+				newCount = os.readv( fd, (bufferView[readCount:],) )
+			except BlockingIOError:
+				newCount = 0
+			except OSError as e:
+				raise SerialException( "read failed: %s"%(e,) )
+			if newCount:
+				readCount += newCount
+				if readCount>=minReadCount:
+					break
+			elif ready:
+				# Note: with VMIN=0 (set by pySerial), an empty read is not an error by itself.
+				raise SerialException( "device reports readiness to read but returned no data (device disconnected or multiple access on port?)" )
+			# Wait for more bytes:
+			if timeout is None:
+				remaining = -1
+			elif deadline is None:
+				startedAt = perf_counter()
+				deadline = startedAt+timeout
+				remaining = timeout
+			else:
+				remaining = deadline-perf_counter()
+				if remaining<=0:
+					if readCount or idleTimeout is None or idleTimeout<=timeout:
+						break # timeout
+					# Nothing received yet: wait for the 1st byte only
+					minReadCount = 1
+					timeout = idleTimeout
+					deadline = startedAt+idleTimeout
+					remaining = deadline-perf_counter()
+			ready = bool( self.epoll.poll( remaining, 1 ) )
+		return bufferView[:readCount]
+	
+	def close( self ):
+		""" Stop using the serial port (it must be closed by pySerial afterwards) """
+		self.epoll.close()
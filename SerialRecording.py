@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+# Recording of the serial byte stream of CANCaptureELM327Thread, and replay of a recording without any scanner
+# Usage: SerialRecording.py <recording file> [--realtime] [--speed=<factor>] [--parameters=<file>] [--sequence=<file>]
+# The replay runs as fast as possible by default. It can be profiled with: python3 -m cProfile -s cumtime SerialRecording.py ...
+
+import struct
+import threading
+
+from time import sleep
+from time import perf_counter
+from time import process_time
+from serial import SerialException
+from utility import printT
+
+RECORDING_MAGIC = b"ELMREC\x01\x00"
+RECORD_HEADER = struct.Struct( "<qBI" ) # time in ns since the epoch, kind, length of the data
+RECORD_RECEIVED = 0
+RECORD_SENT = 1
+
+class SerialRecorder():
+	"""
+	Appends the chunks of the serial byte stream to a binary file, with their arrival time
+	Received chunks are recorded as they are consumed by the capture thread, sent chunks as they are written.
+	Writes are buffered, the file is flushed about once per second by the capture thread.
+	"""
+	
+	bufferSize = 1048576
+	
+	def __init__( self, filename ):
+		self.filename = filename
+		self.file = open( filename, "ab", buffering=self.bufferSize )
+		if self.file.tell()==0:
+			self.file.write( RECORDING_MAGIC )
+		self.recordedBytes = 0
+	
+	def recordReceived( self, data, arrivalNs ):
+		self.file.write( RECORD_HEADER.pack( arrivalNs, RECORD_RECEIVED, len( data ) ) )
+		self.file.write( data )
+		self.recordedBytes += len( data )
+	
+	def recordSent( self, data, sentNs ):
+		self.file.write( RECORD_HEADER.pack( sentNs, RECORD_SENT, len( data ) ) )
+		self.file.write( data )
+	
+	def flush( self ):
+		self.file.flush()
+	
+	def close( self ):
+		self.file.close()
+
+def readRecording( filename ):
+	"""
+	Load a recording
+	Return a list of (time in ns, kind, data)
+	Throws a ValueError if the file is not a recording (a truncated last record is ignored)
+	"""
+	with open( filename, "rb" ) as f:
+		content = f.read()
+	if content[:len( RECORDING_MAGIC )]!=RECORDING_MAGIC:
+		raise ValueError( "Not a serial recording: "+filename )
+	records = []
+	headerSize = RECORD_HEADER.size
+	pos = len( RECORDING_MAGIC )
+	contentLen = len( content )
+	while pos+headerSize<=contentLen:
+		timeNs, kind, dataLen = RECORD_HEADER.unpack_from( content, pos )
+		pos += headerSize
+		if pos+dataLen>contentLen:
+			break # truncated
+		records.append( (timeNs, kind, content[pos:pos+dataLen]) )
+		pos += dataLen
+	return records
+
+class ReplaySerial():
+	"""
+	Fake serial port returning the received chunks of a recording, with the interface of pySerial used by the capture thread
+	Timings follow the recording: a read operation waits for the next chunks until its timeout, like a real serial port.
+	- realtime=False: time is virtual, it jumps forward so the replay runs as fast as possible
+	- realtime=True: chunks are returned at their recorded time (divided by speed)
+	Received chunks that followed a sent chunk in the recording are returned only after the capture thread sent the same bytes.
+	If it sends bytes matching one of the next sent chunks instead, the replay skips to it (resynchronization).
+	If it sends nothing matching for syncTimeout (real time), the replay goes on anyway (desynchronization).
+	At the end of the recording, read operations throw a SerialException and finished is set.
+	"""
+	
+	syncLookahead = 64 # count of sent chunks of the recording searched for a match
+	syncTimeout = 2. # seconds
+	blockedPollDelay = 0.001 # real waiting time of a read operation blocked until bytes are sent (as fast as possible)
+	
+	def __init__( self, records, realtime=False, speed=1. ):
+		received = [(timeNs, data) for timeNs, kind, data in records if kind==RECORD_RECEIVED and data]
+		if not received:
+			raise ValueError( "No received bytes in the recording" )
+		firstNs = received[0][0]
+		self.chunkTimes = [( timeNs-firstNs )/1000000000. for timeNs, data in received] # seconds since the 1st chunk
+		self.chunks = [data for timeNs, data in received]
+		self.chunkIndex = 0
+		self.chunkPos = 0 # position in the current chunk
+		self.sentChunks = [] # (index of the next received chunk, data, time)
+		receivedCount = 0
+		for timeNs, kind, data in records:
+			if kind==RECORD_RECEIVED and data:
+				receivedCount += 1
+			elif kind==RECORD_SENT:
+				self.sentChunks.append( (receivedCount, data, ( timeNs-firstNs )/1000000000.) )
+		self.sentIndex = 0 # next sent chunk to match
+		self.blockedSince = None # perf_counter() when reading got blocked until the next sent chunk
+		self.syncCount = 0 # resynchronizations that skipped received chunks
+		self.desyncCount = 0 # sent chunks never matched
+		self.realtime = realtime
+		self.speed = speed
+		self.virtualTime = 0. # current time of the recording (seconds since the 1st chunk)
+		self.startedAt = None # perf_counter() at the beginning of a real time replay
+		self.finished = threading.Event()
+		self.port = None
+		self.baudrate = 38400
+		self.timeout = None
+		self.exclusive = False
+		self.is_open = False
+		self.sentBytes = 0
+	
+	def open( self ):
+		self.is_open = True
+		if self.startedAt is None:
+			self.startedAt = perf_counter()
+	
+	def close( self ):
+		self.is_open = False
+	
+	def getTime( self ):
+		if self.realtime:
+			return ( perf_counter()-self.startedAt )*self.speed
+		return self.virtualTime
+	
+	def waitUntil( self, replayTime ):
+		""" Let the time of the recording go up to replayTime """
+		if self.realtime:
+			delay = ( replayTime-self.getTime() )/self.speed
+			if delay>0.:
+				sleep( delay )
+		elif replayTime>self.virtualTime:
+			self.virtualTime = replayTime
+	
+	def getAvailableEnd( self ):
+		""" Index of the 1st received chunk that must wait for bytes to be sent """
+		sentChunks = self.sentChunks
+		while self.sentIndex<len( sentChunks ):
+			chunkIndex = sentChunks[self.sentIndex][0]
+			if chunkIndex>self.chunkIndex:
+				return chunkIndex
+			if self.blockedSince is None:
+				self.blockedSince = perf_counter()
+			if perf_counter()-self.blockedSince<=self.syncTimeout:
+				return chunkIndex
+			# Never sent by the capture thread:
+			self.sentIndex += 1
+			self.blockedSince = None
+			self.desyncCount += 1
+		return len( self.chunks )
+	
+	@property
+	def in_waiting( self ):
+		now = self.getTime()
+		availableEnd = self.getAvailableEnd()
+		count = 0
+		i = self.chunkIndex
+		pos = self.chunkPos
+		while i<availableEnd and self.chunkTimes[i]<=now:
+			count += len( self.chunks[i] )-pos
+			pos = 0
+			i += 1
+		return count
+	
+	def read( self, size=1 ):
+		""" Return up to size bytes, waiting for them until timeout """
+		chunks = self.chunks
+		chunkTimes = self.chunkTimes
+		if self.chunkIndex>=len( chunks ):
+			self.finished.set()
+			raise SerialException( "End of the replayed recording" )
+		deadline = None
+		if self.timeout is not None:
+			deadline = self.getTime()+self.timeout
+		data = bytearray()
+		while len( data )<size and self.chunkIndex<len( chunks ):
+			if self.chunkIndex>=self.getAvailableEnd():
+				# Waiting for bytes to be sent
+				if not self.realtime:
+					sleep( self.blockedPollDelay )
+				if deadline is None:
+					if self.realtime:
+						sleep( self.blockedPollDelay )
+					continue
+				break
+			chunkTime = chunkTimes[self.chunkIndex]
+			if deadline is not None and chunkTime>deadline:
+				break
+			self.waitUntil( chunkTime )
+			chunk = chunks[self.chunkIndex]
+			takenLen = min( size-len( data ), len( chunk )-self.chunkPos )
+			data.extend( chunk[self.chunkPos:self.chunkPos+takenLen] )
+			self.chunkPos += takenLen
+			if self.chunkPos>=len( chunk ):
+				self.chunkIndex += 1
+				self.chunkPos = 0
+		if len( data )<size and deadline is not None:
+			self.waitUntil( deadline ) # timeout
+		return bytes( data )
+	
+	def write( self, data ):
+		self.sentBytes += len( data )
+		sentChunks = self.sentChunks
+		for i in range( self.sentIndex, min( self.sentIndex+self.syncLookahead, len( sentChunks ) ) ):
+			chunkIndex, sentData, sentTime = sentChunks[i]
+			if sentData==data:
+				self.sentIndex = i+1
+				self.blockedSince = None
+				if chunkIndex>self.chunkIndex:
+					# Answers of the recording that were not read: skipped
+					self.chunkIndex = chunkIndex
+					self.chunkPos = 0
+					self.syncCount += 1
+				self.waitUntil( sentTime )
+				break
+		return len( data )
+	
+	def reset_input_buffer( self ):
+		pass # flushed bytes were not recorded
+
+if __name__=="__main__":
+	from sys import argv
+	filename = None
+	realtime = False
+	speed = 1.
+	for argument in argv[1:]:
+		if argument=="--realtime":
+			realtime = True
+		elif argument[:8]=="--speed=":
+			speed = float( argument[8:] )
+		elif argument[:2]!="--":
+			filename = argument
+	if filename is None:
+		print( "Usage: SerialRecording.py <recording file> [--realtime] [--speed=<factor>] [--parameters=<file>] [--sequence=<file>]" )
+		raise SystemExit( 1 )
+	from CANCaptureELM327 import CANCaptureELM327Thread
+	replaySerial = ReplaySerial( readRecording( filename ), realtime, speed )
+	
+	class CANCaptureELM327ReplayThread( CANCaptureELM327Thread ):
+		""" Capture thread reading a recording, counting the frames instead of handling them """
+		framesCount = 0
+		def createSerial( self ):
+			return replaySerial
+		def updateSerialRecorder( self ):
+			pass # no recording of a replay
+		def reloadParameters( self ):
+			CANCaptureELM327Thread.reloadParameters( self )
+			# Decisions must follow the recording, not the local state:
+			self.linkStateCache = None
+			self.serialBaudRateCalibration = False
+		def handleNewFrame( self, frame ):
+			self.framesCount += 1
+	
+	vehicleInterface = CANCaptureELM327ReplayThread( ({}, threading.Lock()) )
+	startedAt = perf_counter()
+	startedAtCpu = process_time()
+	vehicleInterface.start()
+	replaySerial.finished.wait()
+	duration = perf_counter()-startedAt
+	sleep( 0.5 ) # frames handled by the parser process
+	printT( "Replayed %.1f s of recording in %.3f s (CPU: %.3f s), %u frames, %.0f frames/s, %u resynchronizations, %u desynchronizations"%(
+		replaySerial.chunkTimes[-1],
+		duration,
+		process_time()-startedAtCpu,
+		vehicleInterface.framesCount,
+		vehicleInterface.framesCount/duration,
+		replaySerial.syncCount,
+		replaySerial.desyncCount,
+	) )
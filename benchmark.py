@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+# Benchmarks of the hot paths, running without any scanner
+# Usage: benchmark.py [<name> ...] (all benchmarks by default)
+
+from time import perf_counter
+from sys import argv
+from sys import getsizeof
+
+def measure( function, count ):
+	""" Return the duration of a call in microseconds """
+	startedAt = perf_counter()
+	function( count )
+	return ( perf_counter()-startedAt )*1000000./count
+
+def sampleATMALines( count, identifiersCount=60, extended=False, changingPayloads=0.1 ):
+	"""
+	Generate ATMA lines looking like periodic CAN traffic
+	Only a fraction of identifiers (changingPayloads) have a payload that changes on every frame.
+	"""
+	from random import Random
+	random = Random( 327 )
+	identifiers = [random.randrange( extended and 0x20000000 or 0x800 ) for i in range( identifiersCount )]
+	payloads = [bytes( random.randrange( 256 ) for j in range( 8 ) ) for i in range( identifiersCount )]
+	changing = [random.random()<changingPayloads for i in range( identifiersCount )]
+	identifierFormat = extended and b"%.8X" or b"%.3X"
+	lines = []
+	for i in range( count ):
+		k = i%identifiersCount
+		payload = payloads[k]
+		if changing[k]:
+			payload = payload[:7]+bytes( ( i&0xFF, ) )
+		lines.append( ( identifierFormat%(identifiers[k],) )+b"8"+payload.hex().upper().encode( "ascii" ) )
+	return lines
+
+def benchmarkDecoder():
+	""" ATMA line decoders: regular expressions versus table-driven (with and without cache) """
+	from ATMADecoder import ATMALineDecoder
+	from ATMADecoder import ATMALineDecoderRegex
+	count = 200000
+	for extended in (False, True):
+		lines = sampleATMALines( count, extended=extended )
+		decoders = (
+			("regex", ATMALineDecoderRegex( extended, True )),
+			("table, no cache", ATMALineDecoder( extended, True, 0 )),
+			("table, cache", ATMALineDecoder( extended, True, 1024 )),
+		)
+		for decoderName, decoder in decoders:
+			def run( count ):
+				decode = decoder.decode
+				for line in lines:
+					decode( line )
+			print( "decoder %2u-bit %-16s %7.3f us/line"%(extended and 29 or 11, decoderName, measure( run, count )) )
+
+def benchmarkSLCAN():
+	""" SLCAN parser on chunks of 4 kB, with and without timestamps (CANFrame creation included) """
+	from CANCaptureSLCAN import SLCANParser
+	count = 200000
+	for extended in (False, True):
+		lines = sampleATMALines( count, extended=extended )
+		kind = extended and b"T" or b"t"
+		for timestamps in (False, True):
+			records = b"".join( kind+line+( timestamps and ( "%.4X"%(i%60000,) ).encode( "ascii" ) or b"" )+b"\x0D" for i, line in enumerate( lines ) )
+			chunks = [records[i:i+4096] for i in range( 0, len( records ), 4096 )]
+			def run( count ):
+				parser = SLCANParser()
+				feed = parser.feed
+				for chunk in chunks:
+					feed( chunk, 0 )
+			print( "slcan %2u-bit %-16s %7.3f us/frame"%(extended and 29 or 11, timestamps and "timestamps" or "no timestamps", measure( run, count )) )
+
+def benchmarkFrame():
+	""" CANFrame: construction time, field access time & memory per retained frame, versus the former tuple with a dictionary """
+	import tracemalloc
+	from CANCaptureELM327 import CANFrame
+	from utility import timeNs
+	class CANFrameDict( tuple ):
+		""" Former design, for reference: lambda accessors & timestamp in the instance dictionary """
+		identifier = property( lambda self: self[0] )
+		isExtended = property( lambda self: self[1] )
+		isRTR = property( lambda self: self[2] )
+		DLC = property( lambda self: self[3] )
+		data = property( lambda self: self[4] )
+		timeNs = property( lambda self: self._timeNs )
+		def __new__( cls, identifier, isExtended, isRTR, DLC, data, timestamp=None ):
+			obj = super().__new__( cls, (int( identifier ), bool( isExtended ), bool( isRTR ), int( DLC ), bytes( data )) )
+			if timestamp is None:
+				obj._timeNs = timeNs()
+			else:
+				obj._timeNs = timestamp
+			return obj
+	count = 200000
+	data = bytes( range( 8 ) )
+	now = timeNs()
+	for className, frameClass in (("former", CANFrameDict), ("slots", CANFrame)):
+		def construct( count ):
+			for i in range( count ):
+				frameClass( 0x7E8, False, False, 8, data, now )
+		frames = [frameClass( 0x7E8, False, False, 8, data, now+i ) for i in range( 1000 )]
+		def access( count ):
+			for i in range( count//len( frames ) ):
+				for frame in frames:
+					frame.identifier; frame.isExtended; frame.isRTR; frame.data; frame.timeNs
+		tracemalloc.start()
+		startSize = tracemalloc.get_traced_memory()[0]
+		retained = [frameClass( 0x7E8, False, False, 8, data, now+i ) for i in range( count )]
+		retainedSize = tracemalloc.get_traced_memory()[0]-startSize-getsizeof( retained )
+		tracemalloc.stop()
+		del retained
+		print( "frame %-7s %7.3f us/construction %7.3f us/5 fields %5.0f B/frame"%(className, measure( construct, count ), measure( access, count ), retainedSize/count) )
+
+def benchmarkBatch():
+	""" Frame records of the parser process to filters, pcap records & CAN-ETH packets: frame by frame versus batches (NumPy) """
+	from types import SimpleNamespace
+	from ATMAParserProcess import FRAME_RECORD
+	from FilterSnapshot import IdentifierSet
+	from FilterSnapshot import FilterSnapshot
+	from CANCaptureELM327 import CANFrame
+	from CANFrameBatch import CANFrameBatch
+	from CANToNetwork import pcaprec_CAN
+	from CANToNetwork import canEthPacket
+	if not CANFrameBatch.available:
+		print( "batch: NumPy is not installed" )
+		return
+	count = 200000
+	batchSize = 256 # records drained from the ring at once
+	for extended in (False, True):
+		lines = sampleATMALines( batchSize, extended=extended )
+		identifierLength = extended and 8 or 3
+		ring = SimpleNamespace( buf=bytearray( FRAME_RECORD.size*batchSize ), slotCount=batchSize, headerSize=0, read=0 ) # like a SharedMemoryRing
+		for index, line in enumerate( lines ):
+			FRAME_RECORD.pack_into( ring.buf, FRAME_RECORD.size*index, int( line[:identifierLength], 16 ), extended and 1 or 0, 8, bytes.fromhex( line[identifierLength+1:].decode( "ascii" ) ), 1700000000000000000+index*100000 )
+		filters = FilterSnapshot( blacklist=IdentifierSet( {int( line[:identifierLength], 16 ) for line in lines[:5]} ) )
+		def runFrames( count ):
+			frameRecordUnpack = FRAME_RECORD.unpack_from
+			for i in range( count//batchSize ):
+				for index in range( batchSize ):
+					identifier, flags, DLC, data, frameTime = frameRecordUnpack( ring.buf, FRAME_RECORD.size*index )
+					frame = CANFrame( identifier, ( flags&1 )!=0, ( flags&2 )!=0, DLC, data[:DLC], frameTime )
+					if filters.passes( frame.identifier ):
+						pcaprec_CAN( frame )
+						canEthPacket( frame )
+		def runBatches( count ):
+			for i in range( count//batchSize ):
+				batch = CANFrameBatch.fromRing( ring, batchSize, CANFrame )
+				batch = batch.select( batch.passesFilters( filters ) )
+				batch.pcapRecords()
+				batch.canEthPackets()
+		for modeName, run in (("frames", runFrames), ("batches", runBatches)):
+			print( "batch %2u-bit %-8s %7.3f us/frame"%(extended and 29 or 11, modeName, measure( run, count )) )
+
+def benchmarkFilters():
+	""" Computer-side filters: former lock & sets versus compiled snapshot, with a blacklist & a whitelist """
+	from threading import Lock
+	from FilterSnapshot import IdentifierSet
+	from FilterSnapshot import FilterSnapshot
+	count = 200000
+	for extended in (False, True):
+		identifiers = [int( line[:extended and 8 or 3], 16 ) for line in sampleATMALines( 1000, extended=extended )]
+		blacklist = set( identifiers[:5] )
+		wantedRanges = [(identifier, identifier+0x10) for identifier in identifiers[:30]]
+		wantedIdentifiers = {identifier for identifier in identifiers if any( first<=identifier<=last for first, last in wantedRanges )}
+		lock = Lock()
+		def runFormer( count ):
+			# Former CANCaptureELM327Thread.passesFilters():
+			for i in range( count//len( identifiers ) ):
+				for identifier in identifiers:
+					with lock:
+						mask = 0x00000000
+						maskingResult = 0x00000000
+					if ( identifier&mask )!=maskingResult:
+						continue
+					if identifier not in wantedIdentifiers:
+						continue
+					if identifier in blacklist:
+						continue
+		snapshots = (
+			("snapshot, identifiers", FilterSnapshot( whitelist=IdentifierSet( wantedIdentifiers ), blacklist=IdentifierSet( blacklist ) )),
+			("snapshot, ranges", FilterSnapshot( whitelist=IdentifierSet( ranges=wantedRanges ), blacklist=IdentifierSet( blacklist ) )),
+		)
+		print( "filters %2u-bit %-21s %7.3f us/frame"%(extended and 29 or 11, "former, identifiers", measure( runFormer, count )) )
+		for snapshotName, snapshot in snapshots:
+			def runSnapshot( count ):
+				passes = snapshot.passes
+				for i in range( count//len( identifiers ) ):
+					for identifier in identifiers:
+						passes( identifier )
+			print( "filters %2u-bit %-21s %7.3f us/frame"%(extended and 29 or 11, snapshotName, measure( runSnapshot, count )) )
+	print( "filters snapshot compilation %.3f ms"%(measure( lambda count: [FilterSnapshot( whitelist=snapshot.whitelist, blacklist=snapshot.blacklist ) for i in range( count )], 100 )/1000.,) )
+
+def benchmarkEncoding():
+	""" Frame to WebSocket JSON, CAN-ETH packet & pcap record: former encoding per output versus frameEncoder, mostly unchanged & always changing payloads """
+	from utility import simpleDictionaryToJSON
+	from utility import bytes_hex
+	from CANCaptureELM327 import CANFrame
+	from CANToNetwork import pcaprec_CAN
+	from CANToNetwork import canEthPacket
+	from FrameEncoding import FrameEncoder
+	count = 200000
+	for changingPayloads in (0.1, 1.):
+		frames = []
+		for index, line in enumerate( sampleATMALines( 1000, changingPayloads=changingPayloads ) ):
+			frames.append( CANFrame( int( line[:3], 16 ), False, False, 8, bytes.fromhex( line[4:].decode( "ascii" ) ), 1700000000000000000+index*100000 ) )
+		def runFormer( count ):
+			for i in range( count//len( frames ) ):
+				for frame in frames:
+					simpleDictionaryToJSON( {
+						b"t": frame.time,
+						b"i": frame.identifier,
+						b"e": frame.isExtended,
+						b"r": frame.isRTR,
+						b"l": frame.DLC,
+						b"d": bytes_hex( frame.data ),
+					} )
+					canEthPacket( frame )
+					pcaprec_CAN( frame )
+		def runEncoder( count ):
+			frameEncoder = FrameEncoder()
+			for i in range( count//len( frames ) ):
+				for frame in frames:
+					frameEncoder.json( frame )
+					frameEncoder.canEthPacket( frame )
+					frameEncoder.pcapRecord( frame )
+		for modeName, run in (("former", runFormer), ("frameEncoder", runEncoder)):
+			print( "encoding %3.0f%% changing %-12s %7.3f us/frame"%(changingPayloads*100, modeName, measure( run, count )) )
+
+benchmarks = {
+	"decoder": benchmarkDecoder,
+	"slcan": benchmarkSLCAN,
+	"frame": benchmarkFrame,
+	"batch": benchmarkBatch,
+	"filters": benchmarkFilters,
+	"encoding": benchmarkEncoding,
+}
+
+if __name__=="__main__":
+	selection = argv[1:] or list( benchmarks.keys() )
+	for name in selection:
+		benchmarks[name]()
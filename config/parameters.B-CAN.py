@@ -6,7 +6,29 @@ httpBindings = [
 	{"address": "0.0.0.0", "port": 18328},
 ]
 
+### Multiple CAN buses ###
+#~ Monitor several CAN buses from this process? Enter None for the single bus described by this file, or a list of buses with their own parameters files (and optionally their sequence files).
+#~ The buses share the HTTP servers: the pages and the API of each bus are under /bus/<name>/, the frames.ws of the root page merges the frames of all buses.
+#~ The frames of all buses are exported with the Libpcap & CAN-ETH parameters of this file, to a pcapng file with 1 interface per bus.
+canBuses = None
+# canBuses = [
+# 	{"name": "PT-CAN", "parameters": "parameters.py"},
+# 	{"name": "B-CAN", "parameters": "parameters.B-CAN.py", "sequence": "sequenceELM327_CAN.py"},
+# 	{"name": "K-CAN", "parameters": "parameters.SLCAN.py", "source": "SLCAN"},
+# ]
+#~ How many seconds to hold exported frames in multi-bus mode, for writing the frames of all buses in time order?
+canBusesMergeDelay = 0.5
+#~ Load sharing: a bus can be monitored by several scanners with a list of parameters files ("parameters": ["parameters.PT-1.py", "parameters.PT-2.py"]).
+#~ Their ELM327-side filters share the identifiers, balanced on the measured rates. Their frames are merged as a single bus.
+#~ Every how many seconds to check the balance of the scanners? Above which excess rate of the busiest scanner (0.2 = 20%) to install new filters?
+canBusLoadSharingRebalanceInterval = 10.
+canBusLoadSharingRebalanceThreshold = 0.2
+#~ Within how many seconds is a frame received by 2 scanners (while filters change) a duplicate?
+canBusLoadSharingDedupWindow = 0.02
+
 ### Serial port ###
+#~ Which kind of adapter? "ELM327" (described by this file) or "SLCAN" (see parameters.SLCAN.py). In multi-bus mode, each bus sets it with "source".
+captureSource = "ELM327"
 #~ Which serial port to choose?
 serialPort = "COM7"
 #~ What is the baud rate used by the ELM327 initially?
@@ -15,6 +37,18 @@ serialBaudRateInitial = 160000
 serialBaudRateDesired = 230400
 #~ Should the initialization restart when the desired baud rate could not be set?
 serialBaudRateDesiredForce = True
+#~ In which file should the link state negotiated on each serial port be cached, so that reconnecting tries it first? (baud rate, CAN bus found with ATDP) For example "logs/link state.json", None to disable. With a fixed ATSP, the cached CAN bus is reused without ECU contact nor ATDP, so clear the file after moving the adapter to another vehicle. With an automatic ATSP (0 or A...), it is only reused if ATDP reports the same bus.
+serialLinkStateFile = None
+#~ Should the initialization AT commands be sent back to back? Their prompts are read afterwards, which makes reconnecting faster. Some clones may lose commands sent while busy, so enable it after checking the ELM327.
+serialPipelinedInit = False
+#~ Should the fastest reliable baud rate be calibrated? At the 1st connection, ATMA runs for a while at each of serialBaudRateCalibrationRates, from the slowest one. The fastest baud rate without invalid lines replaces serialBaudRateDesired, and it is saved in serialLinkStateFile, like a failed calibration. Delete the file to calibrate again.
+serialBaudRateCalibration = False
+#~ If serialBaudRateCalibration, which baud rates should be tried? (ATBRD divisor = 4000000 / baud rate)
+serialBaudRateCalibrationRates = [115200, 230400, 250000, 333333, 400000, 500000]
+#~ If serialBaudRateCalibration, how many seconds should ATMA run at each baud rate?
+serialBaudRateCalibrationSoak = 3.
+#~ If serialBaudRateCalibration, what maximum ratio of invalid lines is acceptable?
+serialBaudRateCalibrationMaxInvalid = 0.001
 #~ Should serial read operations use a local buffer? This can help save CPU power at high baud rates and thus avoid lost bytes.
 serialLocalBufferEnabled = True
 #~ If serialLocalBufferEnabled, should ATMA result be accumulated? (adds delay but saves CPU power with high serial port flow - should be disabled with small serial flow / baudrate)
@@ -23,11 +57,33 @@ serialLocalBufferAccuATMA = True
 serialLocalBufferMinFillATMA = 64
 #~ If serialLocalBufferAccuATMA, how many seconds to wait during each read operation during ATMA? Default: 0.002
 serialLocalBufferWaitTimeATMA = 0.002
+#~ If serialLocalBufferAccuATMA, should serialLocalBufferMinFillATMA & serialLocalBufferWaitTimeATMA be retuned continuously from the measured flow? Their values are then only initial values. Watch the choices with /api/getAccumulationTuning.
+serialLocalBufferAutoTuneATMA = False
+#~ If serialLocalBufferAutoTuneATMA, how many seconds of latency can accumulation add at most? Default: 0.010
+serialLocalBufferMaxLatencyATMA = 0.010
+#~ If serialLocalBufferAutoTuneATMA, how many read operations per second are targeted at most during heavy load? (CPU usage) Default: 200
+serialLocalBufferMaxReadsATMA = 200
+#~ If serialLocalBufferEnabled, should ATMA result be split into whole lines taken from the local buffer? (much less CPU power than reading bytes one by one)
+serialLocalBufferLinesATMA = True
+#~ If serialLocalBufferEnabled, should a dedicated thread drain the serial port into a ring buffer? (the serial port is still read while frames are being processed)
+serialReaderThreadEnabled = False
+#~ If serialReaderThreadEnabled, what is the size in bytes of the ring buffer? Watch its high-water mark and overflows with /api/getSerialReaderStats.
+serialReaderRingSize = 65536
+#~ If serialReaderThreadEnabled, real-time mode (Linux): pin the serial reader thread to a CPU, raise its scheduling priority where permitted, freeze the startup heap and run the garbage collector at controlled points. Compare the scheduling latency and lost bytes with /api/getSerialReaderStats. Applied on the next connection.
+serialReaderRealTime = False
+#~ If serialReaderRealTime, CPU to pin the serial reader thread to. None = the last CPU.
+serialReaderRealTimeCpu = None
+#~ If serialReaderRealTime, SCHED_FIFO priority of the serial reader thread (1-99, requires root or CAP_SYS_NICE, otherwise its nice value is lowered if permitted). None = unchanged priority.
+serialReaderRealTimePriority = 10
+#~ If serialLocalBufferEnabled, should the serial port be read with epoll into a preallocated buffer? (Linux only, no polling and no allocation per read; pySerial is used otherwise)
+serialEpollEnabled = False
 #~ For debuggers: show everything that is sent to the ELM327?
 # serialShowSentBytes = False
 serialShowSentBytes = True
 #~ For debuggers: show everything that is received from the ELM327? (bad idea: huge flow making malfunction caused by slowdown)
 serialShowReceivedBytes = False
+#~ Record the serial byte stream (received & sent chunks with their time) to this binary file, to replay it later with SerialRecording.py (None to disable). Low overhead, unlike serialShowReceivedBytes. Example: "logs/serial "+datetime.now().strftime( "%Y-%m-%d %H-%M-%S" )+".bin"
+serialRecordFile = None
 
 ### CAN bus ###
 #~ Check if found buses are OBD-compliant? (No connectivity test otherwise)
@@ -36,16 +92,50 @@ canBusTestObdCompliant = False
 ATSP = b'B'
 #~ Allow decoding frames with a 29-bit identifier on an 11-bit CAN bus and vice-versa? Expect parasitic frames when "BUFFER FULL".
 canBusAllowMixedIdentifiers = True
+#~ Decode ATMA lines with the table-driven decoder? (False: decoder based on regular expressions, slower)
+canBusDecoderTableDriven = True
+#~ How many distinct ATMA lines should the table-driven decoder remember? Periodic frames often repeat identical lines. 0 disables the cache.
+canBusDecoderCacheSize = 1024
+#~ Decode & filter ATMA lines in a separate process (another CPU core)? Python 3.8+ only. Applied on the next connection.
+canBusParserProcessEnabled = False
+#~ With the parser process, hand frames over by batches of NumPy arrays? Filters, pcap records & CAN-ETH packets are then computed for a whole batch with array operations. Requires NumPy (ignored otherwise). Frames are still built one by one for the WebSocket clients, the survey, load sharing and the pcapng file of canBuses.
+canBusFrameBatchesEnabled = False
+#~ How many frames can wait for the frame handler thread (WebSocket broadcasting, filters & exports)? The queue is bounded to keep memory under control when the thread falls behind.
+#~ When the queue is full: "block" makes the capture wait (backpressure, the scanner may overflow), "dropOldest" drops the oldest pending frames, "dropWebSocket" keeps all frames for the exports but skips WebSocket delivery while over half of the queue is pending, then waits if the queue is full. /api/getFrameHandlerStats shows the depth of the queue & the dropped frames.
+frameHandlerQueueSize = 65536
+frameHandlerQueuePolicy = "dropWebSocket"
 #~ How many seconds to wait while scanning values from the sequence? Should be short (for config live-refresh) but reasonable (delay between frames). Should also be fast to quickly leave a buggy silent ATMA call. Adjustable with the API. Must be greater than 0.
 canBusInactivityTimeout = 0.3
 #~ How long to wait before considering an ATMA interruption attempt expired?
 canBusStopMonitoringWait = 1.5
 #~ After that number of ATMA inerruption attempts, resets the communication to exit from a stuck ATMA reading state.
 canBusStopMonitoringMaxAttempts = 20
+#~ Should ATCF, ATCM & ATMA be sent back to back when restarting ATMA after a filter change? Their prompts are read afterwards, which shortens the time out of ATMA. Some clones may lose commands sent while busy, so enable it after checking the ELM327. The downtime is reported by /api/getMonitoringDowntime.
+canBusPipelinedRestart = False
+#~ Survey of identifiers on buses too busy for the serial link (started with /api/survey/start, table in /api/survey/get): the identifier space is split by its most significant bits into 2^canBusSurveyPartitionBits partitions, each one installed as ELM327-side filter for canBusSurveyDwell seconds, for canBusSurveyRounds rounds. If partitions still get BUFFER FULL alerts, increase canBusSurveyPartitionBits (12 at most).
+canBusSurveyPartitionBits = 4
+canBusSurveyDwell = 2.
+canBusSurveyRounds = 1
 #~ If ATMA seems to return more than this number of invalid frames in a row then monitoring is interrupted. Under heavy CPU load the buffer gets randomly flushed so corrupted frames may be read.
 canBusMaxStraightInvalidFrames = 20
 #~ When setting ATCF & ATCM, mask chosen bits unconditionnally. Should be None except for buggy firmwares (Icar01 ELM327 V1.5 needs 0x1F00FFFF).
 canBusMaskOver = None
+#~ OBD requests declared in the sequence file are sent between ATMA monitoring sessions. Maximum fraction of the time spent out of ATMA for them (blind time).
+obdPollingBlindTimeBudget = 0.1
+#~ Maximum duration in seconds of a single interruption of ATMA for OBD requests.
+obdPollingMaxBatchDuration = 0.3
+#~ Time in seconds to wait for the answer to an OBD request.
+obdPollingTimeout = 0.2
+#~ Identifier of OBD requests. None = 0x7DF on 11-bit buses, 0x18DB33F1 on 29-bit buses.
+obdRequestAddress = None
+#~ Identifier of the ECU answering OBD requests. None = 0x7E8 on 11-bit buses, 0x18DAF110 on 29-bit buses.
+obdResponseAddress = None
+#~ Maximum count of CAN frames waiting to be transmitted (queued with canBus.queueTransmit() or /api/transmit).
+canBusTransmitQueueSize = 1024
+#~ Maximum duration in seconds of a single interruption of ATMA to transmit queued CAN frames.
+canBusTransmitWindowMaxDuration = 0.05
+#~ Minimum monitoring time in seconds between two interruptions of ATMA to transmit queued CAN frames.
+canBusTransmitMinMonitoringTime = 0.2
 #~ USER1 protocol: which is the common identifier length? 11-bit = True, 29-bit = False
 ATPB_11bit = False
 #~ USER1 protocol: can data frame have less than 8 data bytes?
@@ -0,0 +1,48 @@
+### HTTP servers ###
+#~ What IP address and TCP port do you need to bind each server to?
+httpBindings = [
+	{"address": "127.0.0.1", "port": 18329},
+	{"address": "0.0.0.0", "port": 18329},
+]
+
+### Multiple CAN buses ###
+#~ See parameters.py
+canBuses = None
+
+### Serial port ###
+#~ Which kind of adapter? "ELM327" (see parameters.py) or "SLCAN" (described by this file).
+captureSource = "SLCAN"
+#~ Which serial port to choose?
+serialPort = "COM10"
+#~ What is the baud rate of the adapter? Adapters on USB usually ignore it.
+serialBaudRate = 115200
+#~ For debuggers: show everything that is sent to the adapter?
+serialShowSentBytes = False
+
+### CAN bus ###
+#~ What is the CAN bit rate in kb/s? Choices are 10, 20, 50, 100, 125, 250, 500, 800, 1000.
+slcanBitRate = 500
+#~ Should the adapter stay silent on the bus (no acknowledgement, no transmission)?
+slcanListenOnly = True
+#~ Should the frames be timestamped by the adapter (Z1)? The time of frames is then independent from the latency of the serial link.
+slcanTimestamps = True
+#~ Are transmitted frames 29-bit by default?
+slcanExtendedByDefault = False
+#~ After how many seconds without any data should the adapter be reconnected? Adjustable with the API.
+canBusInactivityTimeout = 5.
+#~ How many frames can wait for the frame handler thread (WebSocket broadcasting, filters & exports)? The queue is bounded to keep memory under control when the thread falls behind.
+#~ When the queue is full: "block" makes the capture wait (backpressure, the scanner may overflow), "dropOldest" drops the oldest pending frames, "dropWebSocket" keeps all frames for the exports but skips WebSocket delivery while over half of the queue is pending, then waits if the queue is full. /api/getFrameHandlerStats shows the depth of the queue & the dropped frames.
+frameHandlerQueueSize = 65536
+frameHandlerQueuePolicy = "dropWebSocket"
+
+### Libpcap & CAN-ETH outputs ###
+#~ Log CAN frames to a libpcap file (Wireshark-compatible)? Enter a filename or None.
+from datetime import datetime
+pcapOutputFile = "logs/CAN "+datetime.now().strftime( "%Y-%m-%d %H-%M-%S" )+" "+serialPort.replace( "/",";" )+".pcap"
+#~ Send CAN frames on the network?
+canEthUdpEnabled = False
+canEthUdpIpVersion = 4
+canEthUdpAddrSrc = "192.168.56.1"
+canEthUdpPortSrc = 11898
+canEthUdpAddrDst = "192.168.56.255"
+canEthUdpPortDst = 11898
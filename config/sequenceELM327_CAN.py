@@ -4,3 +4,5 @@ pass
 # canBus.setFilter1( {0x01a01806} )
 # canBus.setFilter1( {0x0c28a000,0x0c20a000,0x0c24a000} )
 # canBus.setFilter2( {0x0220a006} )
+# canBus.setFilter2( None, ranges=[(0x700, 0x7FF)], masks=[(0x1FFFFF00, 0x18DAF100)] ) # ranges (first, last) & masks (mask, maskingResult)
+# canBus.setObdPids( {"010C": 10., "010D": 2.} ) # engine speed at 10 Hz, vehicle speed at 2 Hz, between ATMA monitoring sessions
@@ -1,6 +1,7 @@
 def _():
 	global parametersFile
 	global sequenceFile
+	global fixPath
 	
 	import inspect
 	from sys import argv
@@ -11,6 +12,7 @@ def _():
 	sequenceFile   = applicationDirectory+"config/sequenceELM327_CAN.py"
 	
 	def fixPath( filename ):
+		""" Locate a configuration file, given as is or relative to the config folder """
 		fixedPath = None
 		attemptedPaths = [
 			filename,
@@ -1,56 +1,111 @@
 #!/usr/bin/python3
 
-# Load parameters
-from utility import execfileIfNeeded
-from configselector import parametersFile
-parameters = {}
-parametersFileInfo = {}
-execfileIfNeeded( parametersFile, parameters, parametersFileInfo )
-
-# Initialize vehicle data with a multithread lock
-from threading import Lock
-vehicleData = ({},Lock())
-
-# Run the CAN frame exporters
-from CANToNetwork import CANToNetworkThread
-canExporter = CANToNetworkThread()
-canExporter.start()
-
-# Run the ELM327 manager
-from CANCaptureELM327 import CANCaptureELM327Thread
-vehicleInterface = CANCaptureELM327Thread( vehicleData )
-vehicleInterface.attachCanExporter( canExporter )
-vehicleInterface.start()
-
-# Run the HTTP server
-from CANCaptureHTTPServer import CANCaptureHTTPServerThread
-httpServers = []
-for httpBinding in parameters["httpBindings"]:
-	httpd = CANCaptureHTTPServerThread( vehicleData, vehicleInterface, ipAddress=httpBinding["address"], tcpPort=httpBinding["port"] )
-	httpServers.append( httpd )
-	httpd.start()
-del httpd
-
-# Reload the parameters
-from utility import printT
-def reloadParameters():
-	if execfileIfNeeded( parametersFile, parameters, parametersFileInfo ):
-		for httpBinding in parameters["httpBindings"]:
-			for httpd in httpServers:
-				httpdParameters = httpd.getParameters()
-				# Reload HTTP parameters for the HTTP server matching address & port:
-				if httpBinding["address"]==httpdParameters["ipAddress"] and httpBinding["port"]==httpdParameters["tcpPort"]:
-					break
-		printT( "[main.py] Parameters have been reloaded." )
-
-# Main work in an endless loop
-try:
-	from time import sleep
-	while True:
-		sleep( 3 )
-		reloadParameters()
-except KeyboardInterrupt:
-	printT( "Exiting..." )
-	canExporter.terminate()
-except BaseException as e:
-	printT( e )
+# The guard prevents child processes of multiprocessing from running the program again.
+if __name__=="__main__":
+	# Load parameters
+	from utility import execfileIfNeeded
+	from configselector import parametersFile
+	parameters = {}
+	parametersFileInfo = {}
+	execfileIfNeeded( parametersFile, parameters, parametersFileInfo )
+	
+	# Initialize vehicle data with a multithread lock
+	from threading import Lock
+	vehicleData = ({},Lock())
+	
+	# Multi-bus mode: 1 ELM327 manager per bus, sharing the HTTP servers & the CAN frame exporters
+	canBusDefinitions = parameters.get( "canBuses", None )
+	
+	# Run the CAN frame exporters
+	from CANToNetwork import CANToNetworkThread
+	canExporter = CANToNetworkThread()
+	if canBusDefinitions:
+		canExporter.setBuses( [canBusDefinition["name"] for canBusDefinition in canBusDefinitions] )
+		canExporter.setParameters( parameters )
+	canExporter.start()
+	
+	# Run the ELM327 managers
+	from CANCaptureELM327 import CANCaptureELM327Thread
+	from CANCaptureSLCAN import CANCaptureSLCANThread
+	captureThreadClasses = { # kind of adapter: capture thread class
+		"ELM327": CANCaptureELM327Thread,
+		"SLCAN": CANCaptureSLCANThread,
+	}
+	loadSharingGroups = []
+	if canBusDefinitions:
+		from configselector import fixPath
+		from CANLoadSharing import CANLoadSharingGroup
+		vehicleInterfaces = {} # 1st scanner of each bus
+		allVehicleInterfaces = []
+		for busIndex, canBusDefinition in enumerate( canBusDefinitions ):
+			busName = canBusDefinition["name"]
+			busSequenceFile = None
+			if canBusDefinition.get( "sequence", None ) is not None:
+				busSequenceFile = fixPath( canBusDefinition["sequence"] )
+				if busSequenceFile is None:
+					raise FileNotFoundError( "Could not locate the sequence file of the bus %s!"%busName )
+			busParametersFiles = canBusDefinition["parameters"]
+			if isinstance( busParametersFiles, str ):
+				busParametersFiles = [busParametersFiles]
+			busVehicleInterfaces = []
+			for busParametersFile in busParametersFiles:
+				busParametersFile = fixPath( busParametersFile )
+				if busParametersFile is None:
+					raise FileNotFoundError( "Could not locate a parameters file of the bus %s!"%busName )
+				vehicleInterface = captureThreadClasses[canBusDefinition.get( "source", "ELM327" )]( vehicleData, busParametersFile, busSequenceFile, busName=busName )
+				vehicleInterface.attachCanExporter( canExporter, busIndex )
+				busVehicleInterfaces.append( vehicleInterface )
+			if len( busVehicleInterfaces )>1:
+				# Load sharing: the scanners of the bus share its identifiers with complementary filters
+				loadSharingGroup = CANLoadSharingGroup( busName, busVehicleInterfaces )
+				loadSharingGroup.setParameters( parameters )
+				loadSharingGroups.append( loadSharingGroup )
+			vehicleInterfaces[busName] = busVehicleInterfaces[0]
+			allVehicleInterfaces += busVehicleInterfaces
+		for vehicleInterface in allVehicleInterfaces:
+			vehicleInterface.start()
+		for loadSharingGroup in loadSharingGroups:
+			loadSharingGroup.start()
+		vehicleInterface = next( iter( vehicleInterfaces.values() ) ) # default bus
+	else:
+		vehicleInterfaces = None
+		vehicleInterface = captureThreadClasses[parameters.get( "captureSource", "ELM327" )]( vehicleData )
+		vehicleInterface.attachCanExporter( canExporter )
+		vehicleInterface.start()
+	
+	# Run the HTTP server
+	from CANCaptureHTTPServer import CANCaptureHTTPServerThread
+	httpServers = []
+	for httpBinding in parameters["httpBindings"]:
+		httpd = CANCaptureHTTPServerThread( vehicleData, vehicleInterface, ipAddress=httpBinding["address"], tcpPort=httpBinding["port"], canBuses=vehicleInterfaces )
+		httpServers.append( httpd )
+		httpd.start()
+	del httpd
+	
+	# Reload the parameters
+	from utility import printT
+	def reloadParameters():
+		if execfileIfNeeded( parametersFile, parameters, parametersFileInfo ):
+			if canBusDefinitions:
+				canExporter.setParameters( parameters )
+				for loadSharingGroup in loadSharingGroups:
+					loadSharingGroup.setParameters( parameters )
+			for httpBinding in parameters["httpBindings"]:
+				for httpd in httpServers:
+					httpdParameters = httpd.getParameters()
+					# Reload HTTP parameters for the HTTP server matching address & port:
+					if httpBinding["address"]==httpdParameters["ipAddress"] and httpBinding["port"]==httpdParameters["tcpPort"]:
+						break
+			printT( "[main.py] Parameters have been reloaded." )
+	
+	# Main work in an endless loop
+	try:
+		from time import sleep
+		while True:
+			sleep( 3 )
+			reloadParameters()
+	except KeyboardInterrupt:
+		printT( "Exiting..." )
+		canExporter.terminate()
+	except BaseException as e:
+		printT( e )
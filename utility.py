@@ -3,6 +3,20 @@ from datetime import datetime
 def printT( *arguments ):
 	print( datetime.now().strftime( "%H:%M:%S" ), *arguments )
 
+# Current time in nanoseconds since the epoch, from a monotonic clock anchored to the wall-clock time at startup
+# Changes of the system time do not make it jump, so durations between timestamps are reliable.
+try:
+	from time import time_ns
+	from time import perf_counter_ns
+except ImportError: # Python < 3.7
+	from time import time as _time
+	from time import perf_counter as _perf_counter
+	time_ns = lambda: int( _time()*1000000000 )
+	perf_counter_ns = lambda: int( _perf_counter()*1000000000 )
+clockAnchorNs = time_ns()-perf_counter_ns()
+def timeNs():
+	return perf_counter_ns()+clockAnchorNs
+
 # Include a Python script in Python 3
 def execfile( filename, globalEnv ):
 	f = open( filename )
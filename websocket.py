@@ -93,18 +93,34 @@ class WebSocket():
 			self.wfile.write( content )
 	
 	@classmethod
-	def broadcastMessageRaw( self, content ): # thread-safe
-		""" Send a raw frame on all instances of the given WebSocket class (including inherited)
-		This function is a possible bottleneck """
+	def hasActiveInstances( self ): # thread-safe
+		""" Indicates if there are instances of the given WebSocket class (including inherited) """
 		with WebSocket.activeInstancesLock:
 			activeInstances = set( WebSocket.activeInstances.keys() )
 		for instance in activeInstances:
 			if isinstance( instance, self ):
-				try:
-					instance.sendMessageRaw( content )
-				except:
-					# Exceptions are captured because we might try to write on an inactive instance.
-					pass
+				return True
+		return False
+	
+	@classmethod
+	def getActiveInstances( self ): # thread-safe
+		""" Get the list of instances of the given WebSocket class (including inherited) """
+		with WebSocket.activeInstancesLock:
+			activeInstances = list( WebSocket.activeInstances.keys() )
+		return [instance for instance in activeInstances if isinstance( instance, self )]
+	
+	@classmethod
+	def broadcastMessageRaw( self, content, instances=None ): # thread-safe
+		""" Send a raw frame on all instances of the given WebSocket class (including inherited), or on the given instances
+		This function is a possible bottleneck """
+		if instances is None:
+			instances = self.getActiveInstances()
+		for instance in instances:
+			try:
+				instance.sendMessageRaw( content )
+			except:
+				# Exceptions are captured because we might try to write on an inactive instance.
+				pass
 	
 	@classmethod
 	def buildMessageText( self, content ): # thread-safe
@@ -113,7 +113,7 @@ if( true ){
 
 
 if( true ){
-	var obdRelayUrl = "ws://"+document.location.host+"/frames.ws";
+	var obdRelayUrl = "ws://"+document.location.host+document.location.pathname.replace( /\/[^\/]*$/, "" )+"/frames.ws";
 	
 	// Get a suitable WebSocket constructor:
 	let _WebSocket;
@@ -36,7 +36,8 @@ if( true ){
 		};
 	}
 	
-	var locationOrigin = document.location.protocol+"//"+document.location.host;
+	// Relative to the folder of the page, such as /bus/<name>/ in multi-bus mode:
+	var locationOrigin = document.location.protocol+"//"+document.location.host+document.location.pathname.replace( /\/[^\/]*$/, "" );
 	
 	var JSON_parse;
 	if( window.JSON && JSON.parse ){